@@ -0,0 +1,136 @@
+"""Acoustic fingerprints for spotting the same recording uploaded twice.
+
+Audio is decoded to 8 kHz mono PCM (by ffmpeg, or the wave module for WAV files) and
+turned into a log-magnitude spectrogram with one vectorized NumPy FFT over all frames.
+Local spectral peaks survive re-encoding at another bitrate or format; pairs of nearby
+peaks become integer hashes of (anchor bin, target bin, frame gap), each stored with
+the anchor's frame. Two copies of a song share many hashes at one constant frame
+difference, which is what best_alignment() counts.
+
+Only pure functions live here: the app runs fingerprint_file() in a process pool and
+the workers import this module, not the app.
+"""
+import os
+import shutil
+import subprocess
+import wave
+from collections import Counter, defaultdict
+
+try:
+    import numpy as np  # optional: fingerprinting is disabled without it
+except ImportError:
+    np = None
+
+SAMPLE_RATE = 8000
+FRAME = 1024  # samples per FFT window (128 ms)
+HOP = 512  # samples between windows, so one frame is 64 ms
+PEAK_FREQ_RADIUS = 5  # bins either side a peak must dominate
+PEAK_TIME_RADIUS = 5  # frames either side a peak must dominate
+PEAK_PERCENTILE = 95  # peaks must also be louder than this share of the spectrogram
+FAN_OUT = 5  # later peaks paired with each anchor
+MAX_FRAME_GAP = 63  # fits the 6 gap bits of a hash
+MAX_SECONDS = 600  # decode at most this much of a file
+
+class FingerprintError(Exception):
+    pass
+
+def available():
+    return np is not None
+
+def decode_pcm(path, ffmpeg='ffmpeg', max_seconds=MAX_SECONDS):
+    """Mono float samples at SAMPLE_RATE."""
+    binary = shutil.which(ffmpeg)
+    if binary:
+        result = subprocess.run(
+            [binary, '-v', 'error', '-nostdin', '-i', path, '-t', str(max_seconds),
+             '-ac', '1', '-ar', str(SAMPLE_RATE), '-f', 's16le', '-'],
+            capture_output=True, timeout=300
+        )
+        if result.returncode != 0:
+            message = result.stderr.decode(errors='replace').strip()[:200]
+            raise FingerprintError(f"ffmpeg could not decode {os.path.basename(path)}: {message}")
+        return np.frombuffer(result.stdout, dtype='<i2').astype(np.float32) / 32768
+    if path.lower().endswith('.wav'):
+        return _decode_wav(path, max_seconds)
+    raise FingerprintError('ffmpeg is not installed; only WAV files can be fingerprinted without it')
+
+def _decode_wav(path, max_seconds):
+    with wave.open(path, 'rb') as w:
+        channels, width, rate = w.getnchannels(), w.getsampwidth(), w.getframerate()
+        raw = w.readframes(min(w.getnframes(), rate * max_seconds))
+    if width not in (1, 2, 4):
+        raise FingerprintError(f"Unsupported WAV sample width: {width} bytes")
+    samples = np.frombuffer(raw, dtype={1: np.uint8, 2: '<i2', 4: '<i4'}[width]).astype(np.float32)
+    if width == 1:
+        samples -= 128
+    samples = samples[:len(samples) // channels * channels].reshape(-1, channels).mean(axis=1)
+    # Linear interpolation is a crude resampler, but only strong peaks are kept
+    n = int(len(samples) * SAMPLE_RATE / rate)
+    return np.interp(np.arange(n) * (rate / SAMPLE_RATE), np.arange(len(samples)), samples)
+
+def spectrogram(samples):
+    """Log magnitudes, one row per frame, one column per frequency bin."""
+    if len(samples) < FRAME:
+        return np.zeros((0, FRAME // 2 + 1))
+    frames = np.lib.stride_tricks.sliding_window_view(samples, FRAME)[::HOP]
+    return np.log1p(np.abs(np.fft.rfft(frames * np.hanning(FRAME), axis=1)))
+
+def _sliding_max(a, radius, axis):
+    # radius shifted maximums instead of one (2r+1)-wide window view, to keep memory flat
+    out = a.copy()
+    for k in range(1, radius + 1):
+        if axis == 0:
+            np.maximum(out[k:], a[:-k], out=out[k:])
+            np.maximum(out[:-k], a[k:], out=out[:-k])
+        else:
+            np.maximum(out[:, k:], a[:, :-k], out=out[:, k:])
+            np.maximum(out[:, :-k], a[:, k:], out=out[:, :-k])
+    return out
+
+def peaks(spec):
+    """(frames, bins) of the spectrogram's local maxima."""
+    if not spec.size:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    local = _sliding_max(_sliding_max(spec, PEAK_FREQ_RADIUS, 1), PEAK_TIME_RADIUS, 0)
+    mask = (spec == local) & (spec > np.percentile(spec, PEAK_PERCENTILE))
+    mask[:, 0] = False  # DC
+    return np.nonzero(mask)
+
+def peak_hashes(frames, bins):
+    """Unique (hash, anchor frame) pairs for each peak and its next FAN_OUT peaks."""
+    order = np.lexsort((bins, frames))
+    frames, bins = frames[order].astype(np.int64), bins[order].astype(np.int64)
+    hashes, anchors = [], []
+    for k in range(1, FAN_OUT + 1):
+        gap = frames[k:] - frames[:-k]
+        keep = (gap > 0) & (gap <= MAX_FRAME_GAP)
+        hashes.append((bins[:-k][keep] << 16) | (bins[k:][keep] << 6) | gap[keep])
+        anchors.append(frames[:-k][keep])
+    if not hashes:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    pairs = np.unique(np.stack([np.concatenate(hashes), np.concatenate(anchors)], axis=1), axis=0)
+    return pairs[:, 0], pairs[:, 1]
+
+def fingerprint_file(path, ffmpeg='ffmpeg'):
+    """(hashes, anchor frames, duration in ms) for an audio file; runs in pool workers."""
+    if np is None:
+        raise FingerprintError('numpy is not installed')
+    samples = decode_pcm(path, ffmpeg)
+    hashes, anchors = peak_hashes(*peaks(spectrogram(samples)))
+    return hashes.tolist(), anchors.tolist(), len(samples) * 1000 // SAMPLE_RATE
+
+def best_alignment(query, rows):
+    """Matching hashes at each track's best frame offset.
+
+    query maps hash -> [anchor frames] of the sample being checked; rows are
+    (track id, hash, frame) from the index. Offsets one frame apart are counted
+    together, since re-encoding can shift the audio by a few milliseconds.
+    """
+    histograms = defaultdict(Counter)
+    for track_id, h, frame in rows:
+        for anchor in query.get(h, ()):
+            histograms[track_id][frame - anchor] += 1
+    return {
+        track_id: max(n + hist.get(offset + 1, 0) for offset, n in hist.items())
+        for track_id, hist in histograms.items()
+    }
@@ -0,0 +1,18 @@
+"""Gunicorn settings for running the backend in production.
+
+Workers are gevent workers: every connection is a greenlet instead of an OS thread, so
+idle /api/events subscribers cost memory, not threads. Run from backend/ with:
+    gunicorn -c gunicorn.conf.py 'music_streaming_app:create_app()'
+"""
+import multiprocessing
+import os
+
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+worker_class = 'gevent'
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+# Open connections per worker, event streams included; keep it above EVENTS_MAX_SUBSCRIBERS
+worker_connections = int(os.environ.get('WORKER_CONNECTIONS', 10000))
+# A gevent worker heartbeats from its own loop, so long streams and downloads never hit this
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
@@ -0,0 +1,118 @@
+"""Schema migrations and the query-plan guard for the StreamMusic backend.
+
+music_app.sql and `flask init-db` create the current schema. Databases made from an
+older copy of the DDL get the missing pieces from `flask migrate-db`. Applied versions
+are recorded in SchemaMigration, so each migration runs once per database, and an
+index that already exists (e.g. made by create_all) is not created again.
+
+Index migrations name indexes declared in the models' __table_args__. The DDL is
+compiled from those Index objects, so models, init-db and migrations cannot drift apart.
+"""
+import logging
+import re
+from datetime import datetime
+
+from sqlalchemy import Column, DateTime, MetaData, String, Table, inspect, select, text
+from sqlalchemy.schema import CreateIndex
+
+logger = logging.getLogger(__name__)
+
+migration_metadata = MetaData()
+schema_migrations = Table(
+    'SchemaMigration', migration_metadata,
+    Column('Version', String(64), primary_key=True),
+    Column('AppliedAt', DateTime, nullable=False, default=datetime.utcnow),
+)
+
+# (version, description, index names, dialects to skip)
+# MySQL already keeps an index on every foreign key column, so plain FK indexes skip it.
+MIGRATIONS = [
+    ('0001_likes_track_time', 'Likes(TrackID, LikedAt) for per-track like counts', ['idx_likes_track_time'], ()),
+    ('0002_likes_user_time', 'Likes(UserID, LikedAt) for liked-tracks pages and exports', ['idx_likes_user_time'], ()),
+    ('0003_artist_name_lower', 'functional LOWER(Artist.Name) for upload artist matching', ['idx_artist_name_lower'], ()),
+    ('0004_album_artist_title', 'Album(ArtistID, Title) for upload album matching', ['idx_album_artist_title'], ()),
+    ('0005_trackplaylist_order', 'TrackPlaylist(PlaylistID, OrderNum) for ordered playlist reads', ['idx_trackplaylist_order'], ()),
+    ('0006_payment_user_date', 'Payment(UserID, Date) for user exports', ['idx_payment_user_date'], ()),
+    ('0007_foreign_key_indexes', 'indexes on Track, Playlist and TrackPlaylist foreign keys',
+     ['idx_track_artist', 'idx_track_album', 'idx_playlist_user', 'idx_trackplaylist_track'], ('mysql',)),
+    ('0008_likes_time', 'Likes(LikedAt) for incremental like rollups', ['idx_likes_time'], ()),
+    ('0009_playlist_parent', 'Playlist(ParentPlaylistID) for nested playlist expansion', ['idx_playlist_parent'], ('mysql',)),
+]
+
+def _indexes_by_name(metadata):
+    return {index.name: index for table in metadata.tables.values() for index in table.indexes}
+
+def applied_versions(connection):
+    migration_metadata.create_all(connection)
+    return {row[0] for row in connection.execute(select(schema_migrations.c.Version))}
+
+def existing_index_names(connection, table_name):
+    # Read the catalog directly: reflection skips functional indexes
+    if connection.dialect.name in ('mysql', 'mariadb'):
+        sql = ('SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS '
+               'WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = :table')
+    elif connection.dialect.name == 'sqlite':
+        sql = "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+    else:
+        return {index['name'] for index in inspect(connection).get_indexes(table_name)}
+    return {row[0] for row in connection.execute(text(sql), {'table': table_name})}
+
+def apply_migrations(engine, metadata):
+    """Run pending migrations in order; returns the versions that were applied."""
+    indexes = _indexes_by_name(metadata)
+    done = []
+    with engine.begin() as connection:
+        already = applied_versions(connection)
+        for version, description, index_names, skip_dialects in MIGRATIONS:
+            if version in already:
+                continue
+            if engine.dialect.name not in skip_dialects:
+                for name in index_names:
+                    index = indexes[name]
+                    if name not in existing_index_names(connection, index.table.name):
+                        connection.execute(CreateIndex(index))
+                logger.info(f"✅ Migration {version}: {description}")
+            connection.execute(schema_migrations.insert().values(Version=version, AppliedAt=datetime.utcnow()))
+            done.append(version)
+    return done
+
+# ============== QUERY PLAN GUARD ==============
+# EXPLAIN each hot statement and report tables read in full. A walk over a whole index
+# counts too: SQLite reports both as "SCAN <table>", MySQL as access type ALL or index.
+
+_SQLITE_SCAN = re.compile(r'^SCAN (\w+)(?: AS (\w+))?')
+
+def _explain_sqlite(connection, sql):
+    scans = []
+    for row in connection.execute(text('EXPLAIN QUERY PLAN ' + sql)):
+        match = _SQLITE_SCAN.match(row[-1])
+        if match and match.group(1) not in ('CONSTANT', 'SUBQUERY'):
+            scans.append(match.group(2) or match.group(1))
+    return scans
+
+def _explain_mysql(connection, sql, small_table_rows):
+    scans = []
+    for row in connection.execute(text('EXPLAIN ' + sql)).mappings():
+        # The optimizer may scan a table this small even when an index exists
+        if row['type'] in ('ALL', 'index') and (row['rows'] or 0) > small_table_rows:
+            scans.append(row['table'])
+    return scans
+
+def full_scans(connection, statement, small_table_rows=100):
+    """Tables the database would read in full to run statement."""
+    dialect = connection.dialect
+    sql = str(statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+    if dialect.name == 'sqlite':
+        return _explain_sqlite(connection, sql)
+    if dialect.name in ('mysql', 'mariadb'):
+        return _explain_mysql(connection, sql, small_table_rows)
+    raise NotImplementedError(f"No query plan check for {dialect.name}")
+
+def check_query_plans(connection, statements, small_table_rows=100):
+    """Return {name: [scanned tables]} for every (name, statement) that falls back to a full scan."""
+    failures = {}
+    for name, statement in statements:
+        scans = full_scans(connection, statement, small_table_rows)
+        if scans:
+            failures[name] = scans
+    return failures
@@ -206,7 +206,7 @@ CREATE TRIGGER before_like_insert
 BEFORE INSERT ON Likes
 FOR EACH ROW
 BEGIN
-    SET NEW.LikedAt = NOW();
+    SET NEW.LikedAt = UTC_TIMESTAMP();
 END $$
 DELIMITER ;
 -- PROCEDURES (returns all the playlists created by the user)
@@ -259,3 +259,161 @@ FROM UserAccount U
 JOIN Payment P ON U.UserID = P.UserID
 GROUP BY U.UserID;
 
+
+-- ARTIST SUMMARY TABLES (kept up to date by the backend on upload, delete and like;
+-- rebuild in bulk with: flask --app music_streaming_app rebuild-artist-stats)
+CREATE TABLE TrackStats (
+  TrackID INT PRIMARY KEY,
+  ArtistID INT,
+  AlbumID INT,
+  DurationSeconds INT NOT NULL DEFAULT 0,
+  LikesCount INT NOT NULL DEFAULT 0,
+  INDEX idx_trackstats_artist_likes (ArtistID, LikesCount),
+  INDEX idx_trackstats_album_likes (AlbumID, LikesCount),
+  FOREIGN KEY (TrackID) REFERENCES Track(TrackID) ON DELETE CASCADE
+);
+CREATE TABLE ArtistStats (
+  ArtistID INT PRIMARY KEY,
+  TrackCount INT NOT NULL DEFAULT 0,
+  AlbumCount INT NOT NULL DEFAULT 0,
+  TotalDuration INT NOT NULL DEFAULT 0,
+  TotalLikes INT NOT NULL DEFAULT 0,
+  UpdatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (ArtistID) REFERENCES Artist(ArtistID) ON DELETE CASCADE
+);
+
+-- RESUMABLE UPLOAD SESSIONS (chunks are staged on disk; expired rows are removed by
+-- flask --app music_streaming_app gc-uploads)
+CREATE TABLE UploadSession (
+  UploadID CHAR(32) PRIMARY KEY,
+  UserID INT,
+  Filename VARCHAR(255) NOT NULL,
+  TotalSize BIGINT NOT NULL,
+  ChunkSize INT NOT NULL,
+  Checksum VARCHAR(200),
+  Metadata TEXT,
+  CreatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  ExpiresAt DATETIME NOT NULL,
+  INDEX ix_UploadSession_ExpiresAt (ExpiresAt),
+  FOREIGN KEY (UserID) REFERENCES UserAccount(UserID) ON DELETE CASCADE
+);
+
+-- SEEK TABLES (time -> byte offset points for MP3/FLAC, built on upload;
+-- backfill with: flask --app music_streaming_app build-seek-indexes)
+CREATE TABLE TrackSeekIndex (
+  TrackID INT PRIMARY KEY,
+  Format VARCHAR(10) NOT NULL,
+  IntervalMs INT NOT NULL,
+  HeaderBytes INT NOT NULL DEFAULT 0,
+  SampleRate INT,
+  BlockSize INT,
+  DurationMs INT,
+  Points MEDIUMBLOB NOT NULL,
+  CreatedAt TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  FOREIGN KEY (TrackID) REFERENCES Track(TrackID) ON DELETE CASCADE
+);
+
+-- AUDIO FINGERPRINTS (spectral peak-pair hashes for duplicate detection, built on upload;
+-- backfill with: flask --app music_streaming_app fingerprint-tracks)
+CREATE TABLE TrackFingerprint (
+  TrackID INT PRIMARY KEY,
+  HashCount INT NOT NULL,
+  DurationMs INT,
+  CreatedAt DATETIME,
+  FOREIGN KEY (TrackID) REFERENCES Track(TrackID) ON DELETE CASCADE
+);
+CREATE TABLE FingerprintHash (
+  Hash INT NOT NULL,
+  TrackID INT NOT NULL,
+  Frame INT NOT NULL,
+  PRIMARY KEY (Hash, TrackID, Frame),
+  INDEX idx_fingerprinthash_track (TrackID),
+  FOREIGN KEY (TrackID) REFERENCES Track(TrackID) ON DELETE CASCADE
+);
+
+-- PLAY EVENTS (append-only, written in batches by the backend) AND HOURLY/DAILY ROLLUPS
+CREATE TABLE PlayEvent (
+  PlayEventID BIGINT AUTO_INCREMENT PRIMARY KEY,
+  UserID INT,
+  TrackID INT NOT NULL,
+  ArtistID INT,
+  PlayedAt DATETIME NOT NULL,
+  Source VARCHAR(20),
+  PlayedMs INT,
+  INDEX idx_playevent_track_time (TrackID, PlayedAt)
+);
+CREATE TABLE PlayRollup (
+  Scope VARCHAR(10) NOT NULL,
+  EntityID INT NOT NULL,
+  Granularity VARCHAR(5) NOT NULL,
+  BucketStart DATETIME NOT NULL,
+  Plays INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (Scope, EntityID, Granularity, BucketStart),
+  INDEX idx_playrollup_chart (Scope, Granularity, BucketStart, Plays)
+);
+
+-- LIKE ROLLUPS (likes per hour/day by LikedAt, filled incrementally by `flask rollup-likes`)
+CREATE TABLE LikeRollup (
+  Scope VARCHAR(10) NOT NULL,
+  EntityID INT NOT NULL,
+  Granularity VARCHAR(5) NOT NULL,
+  BucketStart DATETIME NOT NULL,
+  Likes INT NOT NULL DEFAULT 0,
+  PRIMARY KEY (Scope, EntityID, Granularity, BucketStart)
+);
+CREATE TABLE RollupWatermark (
+  Name VARCHAR(40) PRIMARY KEY,
+  Through DATETIME,
+  UpdatedAt DATETIME
+);
+-- Likes deleted while possibly ahead of the 'likes' watermark; `flask rollup-likes` settles them
+CREATE TABLE LikeTombstone (
+  TombstoneID INT AUTO_INCREMENT PRIMARY KEY,
+  UserID INT NOT NULL,
+  TrackID INT NOT NULL,
+  ArtistID INT,
+  LikedAt DATETIME NOT NULL,
+  INDEX ix_LikeTombstone_LikedAt (LikedAt)
+);
+-- Each user's latest plan change; access tokens claiming another plan are refused until refreshed
+CREATE TABLE PlanChange (
+  UserID INT PRIMARY KEY,
+  SubscriptionPlanID INT NOT NULL,
+  ChangedAt DATETIME NOT NULL,
+  INDEX ix_PlanChange_ChangedAt (ChangedAt),
+  FOREIGN KEY (UserID) REFERENCES UserAccount(UserID) ON DELETE CASCADE
+);
+
+-- SHARD MAP (hash bucket of a UserID -> database holding that user's Likes and playlist
+-- entries; buckets without a row live on the first of SHARD_BINDS. Shard databases get
+-- Likes and TrackPlaylist from `flask init-db`; move buckets with `flask rebalance-shards`)
+CREATE TABLE ShardMap (
+  Bucket INT PRIMARY KEY,
+  BindKey VARCHAR(64) NOT NULL,
+  UpdatedAt DATETIME
+);
+
+-- SECONDARY INDEXES FOR HOT QUERIES (databases built from an older copy of this file get
+-- them with: flask --app music_streaming_app migrate-db; verify with check-query-plans)
+CREATE INDEX idx_likes_track_time ON Likes (TrackID, LikedAt);
+CREATE INDEX idx_likes_user_time ON Likes (UserID, LikedAt);
+CREATE INDEX idx_artist_name_lower ON Artist ((LOWER(Name)));
+CREATE INDEX idx_album_artist_title ON Album (ArtistID, Title);
+CREATE INDEX idx_trackplaylist_order ON TrackPlaylist (PlaylistID, OrderNum);
+CREATE INDEX idx_payment_user_date ON Payment (UserID, Date);
+CREATE INDEX idx_likes_time ON Likes (LikedAt);
+
+CREATE TABLE SchemaMigration (
+  Version VARCHAR(64) PRIMARY KEY,
+  AppliedAt DATETIME NOT NULL
+);
+INSERT INTO SchemaMigration (Version, AppliedAt) VALUES
+('0001_likes_track_time', NOW()),
+('0002_likes_user_time', NOW()),
+('0003_artist_name_lower', NOW()),
+('0004_album_artist_title', NOW()),
+('0005_trackplaylist_order', NOW()),
+('0006_payment_user_date', NOW()),
+('0007_foreign_key_indexes', NOW()),
+('0008_likes_time', NOW()),
+('0009_playlist_parent', NOW());
@@ -1,17 +1,56 @@
 # music_streaming_app.py
 # COMPLETE FLASK BACKEND - PASTE THIS AS ONE FILE
 
-import os, json, logging, re
+import os, json, logging, re, threading, gzip, hashlib, hmac, shutil, tempfile, mimetypes, uuid, base64, binascii, struct, bisect, queue, atexit, mmap, random, traceback, multiprocessing, tarfile
+import click
+from types import MappingProxyType
+from time import perf_counter, sleep
+_IMPORT_STARTED = perf_counter()
 from datetime import datetime, timedelta, time, date
 from functools import wraps
+from urllib.parse import quote
+from collections import Counter, OrderedDict, defaultdict, deque
+from contextlib import contextmanager, ExitStack
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait
 
-from flask import Flask, request, jsonify, send_from_directory, make_response
+from flask import Flask, request, jsonify, send_from_directory, make_response, current_app, Response, stream_with_context, g, has_app_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity
+from flask_jwt_extended import JWTManager, create_access_token, jwt_required, get_jwt_identity, get_jwt, verify_jwt_in_request
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
-from sqlalchemy import func, desc
+from werkzeug.test import EnvironBuilder
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import func, desc, select, insert, delete, bindparam, extract, text, event, cast, literal, String, lambda_stmt
+from sqlalchemy import MetaData, Table, Column, Index
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import joinedload, aliased, Session as OrmSession
+from sqlalchemy import exc as sa_exc
+from migrations import apply_migrations, check_query_plans
+import fingerprint
+
+try:
+    import orjson  # optional: faster encoder for streamed responses
+except ImportError:
+    orjson = None
+try:
+    import brotli  # optional: enables Content-Encoding: br
+except ImportError:
+    brotli = None
+try:
+    import zstandard  # optional: enables Content-Encoding: zstd
+except ImportError:
+    zstandard = None
+try:
+    import fcntl  # POSIX only: cross-process locks for the shared cache
+except ImportError:
+    fcntl = None
+try:
+    import boto3  # optional: only needed for STORAGE_BACKEND = 's3'
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+    ClientError = Exception
 
 # ============== CONFIGURATION ==============
 class Config:
@@ -25,6 +64,101 @@ class Config:
     SECRET_KEY = 'secret'
     JWT_SECRET_KEY = 'jwt-secret'
     JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=24)
+    HOME_SECTION_TIMEOUT = 2.0  # seconds before /api/home gives up on a section
+    HOME_CACHE_TTL = 30  # seconds a home section stays cached
+    PLAYLIST_TREE_TTL = 300  # seconds a flattened nested playlist stays cached (edits invalidate it)
+    PLAYLIST_MAX_DEPTH = 16  # nesting levels followed when flattening a playlist
+    # Cache shared by all worker processes on a host; /dev/shm keeps it in memory
+    SHARED_CACHE_DIR = os.environ.get('SHARED_CACHE_DIR', '/dev/shm/streammusic-cache' if os.path.isdir('/dev/shm') else os.path.join(tempfile.gettempdir(), 'streammusic-cache'))
+    SHARED_CACHE_STALE_GRACE = 60  # seconds an expired entry may still be served while one worker refreshes it
+    SHARED_CACHE_LOCK_TIMEOUT = 10  # seconds to wait for another worker's rebuild before building without the lock
+    STREAM_YIELD_PER = 1000  # rows fetched per server-side cursor batch
+    STREAM_CHUNK_BYTES = 64 * 1024  # streamed responses flush roughly this much at a time
+    COMPRESS_MIN_SIZE = 1024  # bytes; smaller bodies are sent as-is
+    COMPRESS_MIMETYPES = ('application/json', 'text/html', 'text/plain', 'text/csv')
+    COMPRESS_LEVELS = {'zstd': 3, 'br': 5, 'gzip': 6}
+    COMPRESS_CACHE_ENTRIES = 512  # compressed bodies kept for repeated identical payloads
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'local')  # 'local' or 's3'
+    UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads'))
+    S3_BUCKET = os.environ.get('S3_BUCKET', 'streammusic-audio')
+    S3_PREFIX = os.environ.get('S3_PREFIX', 'uploads/')
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. http://localhost:9000 for MinIO
+    S3_REGION = os.environ.get('S3_REGION', 'us-east-1')
+    S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+    S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+    S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024  # bytes; larger uploads go through multipart
+    S3_PART_SIZE = 8 * 1024 * 1024
+    STORAGE_CACHE_DIR = os.environ.get('STORAGE_CACHE_DIR')  # enables the local read-through cache for remote storage
+    STORAGE_CACHE_MAX_BYTES = 2 * 1024 * 1024 * 1024
+    STORAGE_READ_CHUNK = 256 * 1024
+    HOT_CACHE_MAX_BYTES = 256 * 1024 * 1024  # memory for hot track segments; 0 turns the cache off
+    HOT_CACHE_SEGMENT_BYTES = 2 * 1024 * 1024  # leading bytes kept for tracks larger than HOT_CACHE_WHOLE_FILE_MAX
+    HOT_CACHE_WHOLE_FILE_MAX = 8 * 1024 * 1024
+    HOT_CACHE_MIN_FREQUENCY = 3  # recent requests before a track is considered for admission
+    UPLOAD_STAGING_FOLDER = os.environ.get('UPLOAD_STAGING_FOLDER', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'upload_staging'))
+    UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024  # default chunk size offered to resumable upload clients
+    UPLOAD_MAX_CHUNK_SIZE = 64 * 1024 * 1024
+    UPLOAD_MAX_SIZE = 2 * 1024 * 1024 * 1024
+    UPLOAD_SESSION_TTL = timedelta(hours=24)  # idle time before a partial upload is garbage-collected
+    SEEK_INDEX_INTERVAL_MS = 1000  # spacing of seek table points
+    SEEK_INDEX_ASYNC = True  # build seek tables in a background thread after upload
+    FINGERPRINT_ON_UPLOAD = True  # fingerprint uploads in the background and log likely duplicates
+    FINGERPRINT_WORKERS = 2  # processes decoding and fingerprinting audio
+    FINGERPRINT_QUERY_HASHES = 2000  # hashes of a track looked up in the index per duplicate check
+    FINGERPRINT_MIN_MATCHES = 20  # aligned matching hashes for a track to count as a duplicate candidate
+    FFMPEG_BINARY = os.environ.get('FFMPEG_BINARY', 'ffmpeg')
+    PREFETCH_NEXT_TRACKS = 2  # upcoming playlist/queue entries hinted and warmed per stream
+    PREFETCH_BYTES = 1024 * 1024  # leading bytes of each upcoming track pulled into the page cache
+    # Per-user streaming limits by plan name (lowercase); users without a known plan get 'free'.
+    # rate/burst are bytes per second and bytes; streams is concurrent stream requests.
+    STREAM_PLAN_LIMITS = {
+        'free': {'rate': 320 * 1024, 'burst': 4 * 1024 * 1024, 'streams': 2},
+        'premium': {'rate': 1024 * 1024, 'burst': 16 * 1024 * 1024, 'streams': 4},
+    }
+    STREAM_NODE_RATE = 200 * 1024 * 1024  # bytes/s all streams of this worker may send together
+    STREAM_MAX_ACTIVE = 64  # concurrent streams per worker; the rest of its threads stay free for API routes
+    STREAM_SLOT_WAIT = 5.0  # seconds a stream over its plan's concurrency waits for a slot before a 429
+    ENTITLEMENTS_RELOAD = 300  # seconds between reloads of the plan → feature matrix per worker
+    PLAN_CHANGES_RELOAD = 30  # seconds before a worker sees another worker's plan change
+    EVENTS_BUFFER = 2000  # recent events kept for reconnecting clients (Last-Event-ID)
+    EVENTS_COALESCE_WINDOW = 0.5  # seconds like-count changes are merged before being pushed
+    EVENTS_HEARTBEAT = 15  # seconds between keepalive comments on an idle stream
+    EVENTS_MAX_SUBSCRIBERS = 5000  # open /api/events streams per worker
+    # Per-request SQL accounting: 'off', 'sample' (log a warning for a sampled fraction of
+    # requests) or 'strict' (raise, for tests). Routes may declare their own @query_budget.
+    QUERY_GUARD_MODE = os.environ.get('QUERY_GUARD_MODE', 'off')
+    QUERY_GUARD_SAMPLE_RATE = 0.01
+    QUERY_BUDGET_DEFAULT = 30  # statements per request for routes without a declared budget
+    QUERY_REPEAT_THRESHOLD = 5  # identical statements in one request reported as N+1
+    # Database circuit breaker: this many connection/timeout errors within the window open
+    # it, and requests then fail fast (or get a stale catalog copy) until the cooldown lets
+    # a single probe through.
+    DB_BREAKER_FAILURES = 5
+    DB_BREAKER_WINDOW = 10.0  # seconds
+    DB_BREAKER_COOLDOWN = 15.0  # seconds the breaker stays open before probing
+    DB_DEADLINE_DEFAULT = None  # seconds of database time per request for routes without @deadline
+    DB_CONNECT_TIMEOUT = 3  # seconds; MySQL only
+    DB_POOL_TIMEOUT = 3  # seconds to wait for a pooled connection; MySQL only
+    STALE_MAX_AGE = 600  # seconds a last good catalog response may be served while the database is unavailable
+    STALE_CACHE_ENTRIES = 500
+    BATCH_MAX_REQUESTS = 20  # sub-requests accepted by one /api/batch call
+    BATCH_PARALLELISM = 4  # threads for runs of consecutive GET sub-requests
+    PLAY_FLUSH_INTERVAL = 2.0  # seconds between play-event batch writes
+    PLAY_BATCH_SIZE = 500
+    PLAY_QUEUE_MAX = 50000  # events buffered per worker before new ones are dropped
+    PLAY_BEACON_RATE = 1 / 30  # sustained /api/plays beacons per second per user (a play every 30s)
+    PLAY_BEACON_BURST = 50  # beacons a user may send at once, e.g. syncing plays made offline
+    LIKE_ROLLUP_SETTLE = 60  # seconds a like must be old before `flask rollup-likes` folds it in
+    LIKE_ANALYTICS_MAX_BUCKETS = 2000  # buckets one /api/analytics series may span
+    # Likes and TrackPlaylist rows are spread over these binds by hashed UserID (see SHARDING).
+    # 'main' is the default database; any other name must be a key of SQLALCHEMY_BINDS.
+    SHARD_BINDS = ('main',)
+    SHARD_BUCKETS = 1024  # fixed for the life of the data: rebalance-shards moves whole buckets
+    SHARD_MAP_RELOAD = 30  # seconds between reloads of the bucket → bind map per worker
+    SHARD_SCAN_CHUNK = 1000  # rows per page when reading a user's likes or a playlist from its shard
+    STARTUP_CHECK_DATABASE = False  # True restores the eager connection/count check in create_app()
+    STARTUP_WARM_CACHES = False  # True builds the cached home sections in a background thread
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')  # X-Metrics-Token for GET /api/metrics; unset disables it
 
 # ============== LOGGING ==============
 logging.basicConfig(level=logging.INFO)
@@ -73,6 +207,16 @@ class SubscriptionPlan(db.Model):
             'description': self.description
         }
 
+class PremiumFeature(db.Model):
+    __tablename__ = 'PremiumFeature'
+    premium_feature_id = db.Column('PremiumFeatureID', db.Integer, primary_key=True)
+    name = db.Column('Name', db.String(100), nullable=False)
+
+class PlanFeature(db.Model):
+    __tablename__ = 'PlanFeature'
+    subscription_plan_id = db.Column('SubscriptionPlanID', db.Integer, db.ForeignKey('SubscriptionPlan.SubscriptionPlanID'), primary_key=True)
+    premium_feature_id = db.Column('PremiumFeatureID', db.Integer, db.ForeignKey('PremiumFeature.PremiumFeatureID'), primary_key=True)
+
 class User(db.Model):
     __tablename__ = 'UserAccount'
     user_id = db.Column('UserID', db.Integer, primary_key=True)
@@ -96,6 +240,8 @@ class Artist(db.Model):
     artist_id = db.Column('ArtistID', db.Integer, primary_key=True)
     name = db.Column('Name', db.String(100))
     genre = db.Column('Genre', db.String(50))
+    # upload_track matches artists case-insensitively on LOWER(Name)
+    __table_args__ = (db.Index('idx_artist_name_lower', func.lower(name)),)
     
     def to_dict(self):
         return {
@@ -111,6 +257,7 @@ class Album(db.Model):
     artist_id = db.Column('ArtistID', db.Integer, db.ForeignKey('Artist.ArtistID'))
     release_date = db.Column('ReleaseDate', db.Date)
     artist = db.relationship('Artist')
+    __table_args__ = (db.Index('idx_album_artist_title', 'ArtistID', 'Title'),)
     
     def to_dict(self):
         return {
@@ -133,17 +280,22 @@ class Track(db.Model):
     release_date = db.Column('ReleaseDate', db.Date)
     artist = db.relationship('Artist')
     album = db.relationship('Album')
+    __table_args__ = (
+        db.Index('idx_track_artist', 'ArtistID'),
+        db.Index('idx_track_album', 'AlbumID'),
+    )
     
     def duration_seconds(self):
         if self.duration:
             return self.duration.hour * 3600 + self.duration.minute * 60 + self.duration.second
         return 0
     
-    def to_dict(self, user_id=None):
-        likes_count = db.session.query(func.count(Like.track_id)).filter(Like.track_id == self.track_id).scalar() or 0
-        is_liked = False
-        if user_id:
-            is_liked = db.session.query(Like).filter(Like.user_id == user_id, Like.track_id == self.track_id).first() is not None
+    def to_dict(self, user_id=None, likes_count=None, is_liked=None):
+        # Callers serializing a whole page can pass precomputed like data to skip the per-row queries
+        if likes_count is None:
+            likes_count = _likes_counts([self.track_id]).get(self.track_id, 0)
+        if is_liked is None:
+            is_liked = self.track_id in liked_track_ids(user_id, [self.track_id])
         
         return {
             'track_id': self.track_id,
@@ -166,6 +318,11 @@ class Like(db.Model):
     user_id = db.Column('UserID', db.Integer, db.ForeignKey('UserAccount.UserID'), primary_key=True)
     track_id = db.Column('TrackID', db.Integer, db.ForeignKey('Track.TrackID'), primary_key=True)
     liked_at = db.Column('LikedAt', db.DateTime, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('idx_likes_track_time', 'TrackID', 'LikedAt'),  # per-track counts; the PK leads with UserID
+        db.Index('idx_likes_user_time', 'UserID', 'LikedAt'),  # a user's likes in liked order
+        db.Index('idx_likes_time', 'LikedAt'),  # the like rollup reads only rows past its watermark
+    )
 
 class Playlist(db.Model):
     __tablename__ = 'Playlist'
@@ -174,19 +331,25 @@ class Playlist(db.Model):
     title = db.Column('Title', db.String(150))
     creation_date = db.Column('CreationDate', db.Date)
     parent_playlist_id = db.Column('ParentPlaylistID', db.Integer)
+    __table_args__ = (
+        db.Index('idx_playlist_user', 'UserID'),
+        db.Index('idx_playlist_parent', 'ParentPlaylistID'),  # one step of the nested playlist CTE
+    )
     
-    def to_dict(self, include_tracks=False, user_id=None):
-        track_count = db.session.query(func.count(TrackPlaylist.track_id)).filter(TrackPlaylist.playlist_id == self.playlist_id).scalar() or 0
+    def to_dict(self, include_tracks=False, user_id=None, track_count=None):
+        # Lists of playlists pass track_count from one grouped query (see playlist_track_counts)
+        if track_count is None:
+            track_count = playlist_track_counts([self]).get(self.playlist_id, 0)
         data = {
             'playlist_id': self.playlist_id,
             'user_id': self.user_id,
             'title': self.title,
             'creation_date': self.creation_date.isoformat() if self.creation_date else None,
+            'parent_playlist_id': self.parent_playlist_id,
             'track_count': track_count
         }
         if include_tracks:
-            tracks_raw = db.session.query(TrackPlaylist, Track).join(Track).filter(TrackPlaylist.playlist_id == self.playlist_id).order_by(TrackPlaylist.order_num).all()
-            data['tracks'] = [track.to_dict(user_id) for _, track in tracks_raw]
+            data['tracks'] = [record.to_dict() for record in iter_playlist_tracks(self, user_id)]
         return data
 
 class TrackPlaylist(db.Model):
@@ -195,6 +358,17 @@ class TrackPlaylist(db.Model):
     track_id = db.Column('TrackID', db.Integer, db.ForeignKey('Track.TrackID'), primary_key=True)
     order_num = db.Column('OrderNum', db.Integer)
     track = db.relationship('Track')
+    __table_args__ = (
+        db.Index('idx_trackplaylist_order', 'PlaylistID', 'OrderNum'),
+        db.Index('idx_trackplaylist_track', 'TrackID'),
+    )
+
+class ShardMap(db.Model):
+    __tablename__ = 'ShardMap'
+    # Buckets without a row live on the first of SHARD_BINDS
+    bucket = db.Column('Bucket', db.Integer, primary_key=True, autoincrement=False)
+    bind_key = db.Column('BindKey', db.String(64), nullable=False)
+    updated_at = db.Column('UpdatedAt', db.DateTime, default=datetime.utcnow)
 
 class Payment(db.Model):
     __tablename__ = 'Payment'
@@ -203,6 +377,7 @@ class Payment(db.Model):
     amount = db.Column('Amount', db.Float)
     date = db.Column('Date', db.DateTime, default=datetime.utcnow)
     method = db.Column('Method', db.String(50))
+    __table_args__ = (db.Index('idx_payment_user_date', 'UserID', 'Date'),)
     
     def to_dict(self):
         return {
@@ -213,6 +388,3389 @@ class Payment(db.Model):
             'method': self.method
         }
 
+class ArtistStats(db.Model):
+    __tablename__ = 'ArtistStats'
+    artist_id = db.Column('ArtistID', db.Integer, db.ForeignKey('Artist.ArtistID', ondelete='CASCADE'), primary_key=True)
+    track_count = db.Column('TrackCount', db.Integer, nullable=False, default=0)
+    album_count = db.Column('AlbumCount', db.Integer, nullable=False, default=0)
+    total_duration = db.Column('TotalDuration', db.Integer, nullable=False, default=0)  # seconds
+    total_likes = db.Column('TotalLikes', db.Integer, nullable=False, default=0)
+    updated_at = db.Column('UpdatedAt', db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    def to_dict(self):
+        return {
+            'track_count': self.track_count,
+            'album_count': self.album_count,
+            'total_duration_seconds': self.total_duration,
+            'total_likes': self.total_likes,
+            'updated_at': self.updated_at.isoformat() if self.updated_at else None
+        }
+
+class TrackStats(db.Model):
+    __tablename__ = 'TrackStats'
+    track_id = db.Column('TrackID', db.Integer, db.ForeignKey('Track.TrackID', ondelete='CASCADE'), primary_key=True)
+    artist_id = db.Column('ArtistID', db.Integer)
+    album_id = db.Column('AlbumID', db.Integer)
+    duration_seconds = db.Column('DurationSeconds', db.Integer, nullable=False, default=0)
+    likes_count = db.Column('LikesCount', db.Integer, nullable=False, default=0)
+    # Artist/album pages read "most liked first" straight off these indexes
+    __table_args__ = (
+        db.Index('idx_trackstats_artist_likes', 'ArtistID', 'LikesCount'),
+        db.Index('idx_trackstats_album_likes', 'AlbumID', 'LikesCount'),
+    )
+
+class UploadSession(db.Model):
+    __tablename__ = 'UploadSession'
+    upload_id = db.Column('UploadID', db.String(32), primary_key=True)
+    user_id = db.Column('UserID', db.Integer, db.ForeignKey('UserAccount.UserID', ondelete='CASCADE'))
+    filename = db.Column('Filename', db.String(255), nullable=False)
+    total_size = db.Column('TotalSize', db.BigInteger, nullable=False)
+    chunk_size = db.Column('ChunkSize', db.Integer, nullable=False)
+    checksum = db.Column('Checksum', db.String(200))  # optional whole-file "<algo> <digest>"
+    metadata_json = db.Column('Metadata', db.Text)  # title/artist_name/album_title/duration for the Track row
+    created_at = db.Column('CreatedAt', db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column('ExpiresAt', db.DateTime, nullable=False, index=True)
+
+    def total_chunks(self):
+        return max(1, (self.total_size + self.chunk_size - 1) // self.chunk_size)
+
+    def expected_chunk_length(self, index):
+        if index == self.total_chunks() - 1:
+            return self.total_size - self.chunk_size * index
+        return self.chunk_size
+
+    def to_dict(self, received=()):
+        received = sorted(received)
+        return {
+            'upload_id': self.upload_id,
+            'filename': self.filename,
+            'total_size': self.total_size,
+            'chunk_size': self.chunk_size,
+            'total_chunks': self.total_chunks(),
+            'received_chunks': received,
+            'missing_chunks': sorted(set(range(self.total_chunks())) - set(received)),
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None
+        }
+
+class TrackSeekIndex(db.Model):
+    __tablename__ = 'TrackSeekIndex'
+    track_id = db.Column('TrackID', db.Integer, db.ForeignKey('Track.TrackID', ondelete='CASCADE'), primary_key=True)
+    format = db.Column('Format', db.String(10), nullable=False)  # 'mp3' or 'flac'
+    interval_ms = db.Column('IntervalMs', db.Integer, nullable=False)
+    header_bytes = db.Column('HeaderBytes', db.Integer, nullable=False, default=0)  # FLAC metadata to replay before a seek
+    sample_rate = db.Column('SampleRate', db.Integer)
+    block_size = db.Column('BlockSize', db.Integer)
+    duration_ms = db.Column('DurationMs', db.Integer)
+    points = db.Column('Points', db.LargeBinary(16777215), nullable=False)  # packed '<IQ' (ms, byte offset) pairs
+    created_at = db.Column('CreatedAt', db.DateTime, default=datetime.utcnow)
+
+    def unpack_points(self):
+        return list(struct.iter_unpack('<IQ', self.points))
+
+class TrackFingerprint(db.Model):
+    __tablename__ = 'TrackFingerprint'
+    track_id = db.Column('TrackID', db.Integer, db.ForeignKey('Track.TrackID', ondelete='CASCADE'), primary_key=True)
+    hash_count = db.Column('HashCount', db.Integer, nullable=False)
+    duration_ms = db.Column('DurationMs', db.Integer)
+    created_at = db.Column('CreatedAt', db.DateTime, default=datetime.utcnow)
+
+class FingerprintHash(db.Model):
+    __tablename__ = 'FingerprintHash'
+    # Inverted index: the primary key leads with Hash, so matching a hash is one range read
+    hash = db.Column('Hash', db.Integer, primary_key=True)
+    track_id = db.Column('TrackID', db.Integer, db.ForeignKey('Track.TrackID', ondelete='CASCADE'), primary_key=True)
+    frame = db.Column('Frame', db.Integer, primary_key=True)  # anchor peak, in 64 ms frames
+    __table_args__ = (db.Index('idx_fingerprinthash_track', 'TrackID'),)
+
+class PlayEvent(db.Model):
+    __tablename__ = 'PlayEvent'
+    # Append-only fact table: no foreign keys so batched inserts stay cheap
+    play_event_id = db.Column('PlayEventID', db.BigInteger().with_variant(db.Integer, 'sqlite'), primary_key=True, autoincrement=True)
+    user_id = db.Column('UserID', db.Integer)
+    track_id = db.Column('TrackID', db.Integer, nullable=False)
+    artist_id = db.Column('ArtistID', db.Integer)
+    played_at = db.Column('PlayedAt', db.DateTime, nullable=False)
+    source = db.Column('Source', db.String(20))  # 'stream' or 'beacon'
+    played_ms = db.Column('PlayedMs', db.Integer)
+    __table_args__ = (db.Index('idx_playevent_track_time', 'TrackID', 'PlayedAt'),)
+
+class PlayRollup(db.Model):
+    __tablename__ = 'PlayRollup'
+    scope = db.Column('Scope', db.String(10), primary_key=True)  # 'track' or 'artist'
+    entity_id = db.Column('EntityID', db.Integer, primary_key=True)
+    granularity = db.Column('Granularity', db.String(5), primary_key=True)  # 'hour' or 'day'
+    bucket_start = db.Column('BucketStart', db.DateTime, primary_key=True)
+    plays = db.Column('Plays', db.Integer, nullable=False, default=0)
+    # Charts: top entities for one bucket, read straight off the index
+    __table_args__ = (db.Index('idx_playrollup_chart', 'Scope', 'Granularity', 'BucketStart', 'Plays'),)
+
+class LikeRollup(db.Model):
+    __tablename__ = 'LikeRollup'
+    # Likes per hour/day by LikedAt, net of later unlikes; maintained by roll_up_likes
+    scope = db.Column('Scope', db.String(10), primary_key=True)  # 'track' or 'artist'
+    entity_id = db.Column('EntityID', db.Integer, primary_key=True)
+    granularity = db.Column('Granularity', db.String(5), primary_key=True)  # 'hour' or 'day'
+    bucket_start = db.Column('BucketStart', db.DateTime, primary_key=True)
+    likes = db.Column('Likes', db.Integer, nullable=False, default=0)
+
+class RollupWatermark(db.Model):
+    __tablename__ = 'RollupWatermark'
+    name = db.Column('Name', db.String(40), primary_key=True)
+    through = db.Column('Through', db.DateTime)  # source rows up to this time are in the rollup
+    updated_at = db.Column('UpdatedAt', db.DateTime, default=datetime.utcnow)
+
+class LikeTombstone(db.Model):
+    __tablename__ = 'LikeTombstone'
+    # A like deleted while it may still be ahead of the 'likes' watermark; roll_up_likes settles it
+    tombstone_id = db.Column('TombstoneID', db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column('UserID', db.Integer, nullable=False)
+    track_id = db.Column('TrackID', db.Integer, nullable=False)
+    artist_id = db.Column('ArtistID', db.Integer)
+    liked_at = db.Column('LikedAt', db.DateTime, nullable=False, index=True)
+
+class PlanChange(db.Model):
+    __tablename__ = 'PlanChange'
+    # A user's latest plan change; tokens claiming another plan are stale until refreshed
+    user_id = db.Column('UserID', db.Integer, db.ForeignKey('UserAccount.UserID', ondelete='CASCADE'), primary_key=True)
+    plan_id = db.Column('SubscriptionPlanID', db.Integer, nullable=False)
+    changed_at = db.Column('ChangedAt', db.DateTime, nullable=False, index=True)
+
+# ============== SHARDING ==============
+# Likes rows belong to their UserID and TrackPlaylist rows to their playlist's owner, and
+# both can be spread over several databases. A user hashes (CRC-32 of the id) into one of
+# SHARD_BUCKETS fixed buckets; ShardMap in the main database says which bind holds each
+# bucket, and buckets without a row live on the first of SHARD_BINDS. 'main' is the
+# default database, so the default config keeps everything where it always was.
+#
+# Shard statements run on db.session with an explicit bind: they join the request's
+# transaction and commit with it, though a commit that spans two databases is not atomic
+# (`flask rebuild-artist-stats` recounts likes from the shards). Nothing joins across
+# databases: shard reads return track ids and the track details come from the main
+# database in a second query. Per-track like counts are the TrackStats counters; work
+# that needs every user's rows (rollups, track deletion, rebuilds) runs on each shard in
+# turn and merges the results. `flask rebalance-shards` moves buckets between binds.
+
+def _shard_table(table, metadata):
+    # Same columns and indexes; no foreign keys, since the referenced tables stay in main
+    copy = Table(table.name, metadata, *[
+        Column(c.name, c.type, primary_key=c.primary_key, nullable=c.nullable, autoincrement=False)
+        for c in table.columns
+    ])
+    for index in table.indexes:
+        Index(index.name, *[copy.c[c.name] for c in index.columns])
+    return copy
+
+shard_metadata = MetaData()
+for _model in (Like, TrackPlaylist):
+    _shard_table(_model.__table__, shard_metadata)
+
+class ShardRouter:
+    """One snapshot of the bucket → bind map."""
+
+    def __init__(self, binds, buckets, assignments):
+        self.binds = tuple(binds)
+        self.buckets = buckets
+        self.assignments = assignments
+        # Binds being drained still hold buckets after they leave SHARD_BINDS
+        self.all_binds = tuple(dict.fromkeys(self.binds + tuple(assignments.values())))
+        self.loaded_at = perf_counter()
+
+    def bucket(self, user_id):
+        return binascii.crc32(str(int(user_id or 0)).encode()) % self.buckets
+
+    def bind_for(self, user_id):
+        return self.assignments.get(self.bucket(user_id), self.binds[0])
+
+    def placement(self):
+        """{bucket: bind} for every bucket."""
+        return {bucket: self.assignments.get(bucket, self.binds[0]) for bucket in range(self.buckets)}
+
+def load_shard_router(config):
+    assignments = dict(db.session.query(ShardMap.bucket, ShardMap.bind_key).all())
+    unknown = (set(config['SHARD_BINDS']) | set(assignments.values())) - {'main', *config['SQLALCHEMY_BINDS']}
+    if unknown:
+        raise RuntimeError(f"Shard binds missing from SQLALCHEMY_BINDS: {', '.join(sorted(unknown))}")
+    return ShardRouter(config['SHARD_BINDS'], config['SHARD_BUCKETS'], assignments)
+
+_shard_router_lock = threading.Lock()
+
+def get_shard_router():
+    router = current_app.extensions.get('shard_router')
+    if router is None or perf_counter() - router.loaded_at > current_app.config['SHARD_MAP_RELOAD']:
+        with _shard_router_lock:
+            router = current_app.extensions.get('shard_router')
+            if router is None or perf_counter() - router.loaded_at > current_app.config['SHARD_MAP_RELOAD']:
+                try:
+                    router = current_app.extensions['shard_router'] = load_shard_router(current_app.config)
+                except Exception as e:
+                    if router is None:
+                        raise
+                    logger.warning(f"Shard map reload failed, keeping the previous one: {e}")
+    return router
+
+def shard_engine(bind):
+    return db.engine if bind == 'main' else db.engines[bind]
+
+def shard_execute(bind, stmt, params=None):
+    return db.session.execute(stmt, params, bind_arguments={'bind': shard_engine(bind)})
+
+def user_shard(user_id):
+    return get_shard_router().bind_for(user_id)
+
+def playlist_shard(playlist):
+    return user_shard(playlist.user_id)
+
+def scatter(stmt):
+    """Run a statement on every shard; returns the per-shard results."""
+    return [shard_execute(bind, stmt) for bind in get_shard_router().all_binds]
+
+def gather(stmt):
+    """Rows of a select from every shard, concatenated."""
+    return [row for bind in get_shard_router().all_binds for row in shard_execute(bind, stmt).all()]
+
+def create_shard_tables():
+    for bind in get_shard_router().all_binds:
+        if bind != 'main':
+            shard_metadata.create_all(shard_engine(bind))
+
+def keyset_chunks(bind, stmt, sort_column, tie_column, chunk_size=None):
+    """Rows of stmt on bind ordered by (sort_column, tie_column), one page at a time.
+
+    Every page is a separate query read to the end, so no cursor stays open while the
+    caller runs other queries in between. NULL sort values come first, as in MySQL and SQLite.
+    """
+    chunk_size = chunk_size or current_app.config['SHARD_SCAN_CHUNK']
+    last = None
+    while True:
+        page = stmt
+        if last is not None:
+            note_query_page()
+            value, tie = last
+            if value is None:
+                page = page.where(sort_column.isnot(None) | (tie_column > tie))
+            else:
+                page = page.where((sort_column > value) | ((sort_column == value) & (tie_column > tie)))
+        rows = shard_execute(bind, page.order_by(sort_column, tie_column).limit(chunk_size)).all()
+        if rows:
+            yield rows
+        if len(rows) < chunk_size:
+            return
+        last = rows[-1]._mapping[sort_column], rows[-1]._mapping[tie_column]
+
+def find_like(user_id, track_id):
+    """The user's like of track_id as a (liked_at,) row, or None."""
+    uid, tid = int(user_id), int(track_id)
+    return shard_execute(user_shard(uid), lambda_stmt(
+        lambda: select(Like.liked_at).where(Like.user_id == uid, Like.track_id == tid)
+    )).first()
+
+def add_like(user_id, track_id):
+    shard_execute(user_shard(user_id), insert(Like).values(user_id=int(user_id), track_id=track_id, liked_at=datetime.utcnow()))
+
+def remove_like(user_id, track_id):
+    shard_execute(user_shard(user_id), delete(Like).where(Like.user_id == int(user_id), Like.track_id == track_id))
+
+def like_counts_by_track(track_ids=None):
+    """{track_id: likes} counted on every shard; all tracks when track_ids is None."""
+    stmt = select(Like.track_id, func.count(Like.user_id)).group_by(Like.track_id)
+    if track_ids is not None:
+        if not track_ids:
+            return Counter()
+        stmt = stmt.where(Like.track_id.in_(track_ids))
+    counts = Counter()
+    for track_id, n in gather(stmt):
+        counts[track_id] += n
+    return counts
+
+def playlist_entry_chunks(playlist):
+    """Pages of (track_id, order_num) rows for a playlist in play order, from its owner's shard."""
+    return keyset_chunks(
+        playlist_shard(playlist),
+        select(TrackPlaylist.track_id, TrackPlaylist.order_num).where(TrackPlaylist.playlist_id == playlist.playlist_id),
+        TrackPlaylist.order_num, TrackPlaylist.track_id
+    )
+
+def playlist_track_counts(playlists):
+    """{playlist_id: tracks} with one grouped query per shard involved."""
+    by_shard = defaultdict(list)
+    for playlist in playlists:
+        by_shard[playlist_shard(playlist)].append(playlist.playlist_id)
+    counts = {}
+    for bind, ids in by_shard.items():
+        counts.update(shard_execute(bind, (
+            select(TrackPlaylist.playlist_id, func.count(TrackPlaylist.track_id))
+            .where(TrackPlaylist.playlist_id.in_(ids))
+            .group_by(TrackPlaylist.playlist_id)
+        )).all())
+    return counts
+
+def add_playlist_entry(playlist, track_id):
+    """Append track_id to the playlist; False if it is already there."""
+    bind, pid = playlist_shard(playlist), playlist.playlist_id
+    if shard_execute(bind, select(TrackPlaylist.track_id).where(
+            TrackPlaylist.playlist_id == pid, TrackPlaylist.track_id == track_id)).first():
+        return False
+    max_order = shard_execute(bind, select(func.max(TrackPlaylist.order_num)).where(TrackPlaylist.playlist_id == pid)).scalar() or 0
+    shard_execute(bind, insert(TrackPlaylist).values(playlist_id=pid, track_id=track_id, order_num=max_order + 1))
+    return True
+
+def remove_playlist_entry(playlist, track_id):
+    """Take track_id out of the playlist; False if it was not in it."""
+    return shard_execute(playlist_shard(playlist), delete(TrackPlaylist).where(
+        TrackPlaylist.playlist_id == playlist.playlist_id, TrackPlaylist.track_id == track_id
+    )).rowcount > 0
+
+def plan_rebalance(placement, binds):
+    """[(bucket, from bind, to bind)] giving each of binds an even share, moving as few buckets as possible."""
+    total = len(placement)
+    quota = {bind: total // len(binds) + (1 if i < total % len(binds) else 0) for i, bind in enumerate(binds)}
+    held = defaultdict(list)
+    for bucket in sorted(placement):
+        held[placement[bucket]].append(bucket)
+    # Buckets over a bind's quota, and everything on binds no longer listed, are up for moving
+    spare = iter(sorted((bucket, bind) for bind, owned in held.items() for bucket in owned[quota.get(bind, 0):]))
+    moves = []
+    for bind in binds:
+        for _ in range(quota[bind] - min(len(held[bind]), quota[bind])):
+            bucket, source = next(spare)
+            moves.append((bucket, source, bind))
+    return moves
+
+def _bucket_rows(bind, model, key_column, keys):
+    """{primary key: row dict} of model rows on bind whose key_column is in keys."""
+    table = model.__table__
+    rows = {}
+    for i in range(0, len(keys), 500):
+        for row in shard_execute(bind, select(table).where(key_column.in_(keys[i:i + 500]))).mappings():
+            rows[tuple(row[c.name] for c in table.primary_key)] = dict(row)
+    return rows
+
+def _delete_rows(bind, model, pks):
+    table = model.__table__
+    for pk in pks:
+        shard_execute(bind, table.delete().where(*[c == v for c, v in zip(table.primary_key, pk)]))
+
+def _bucket_keys(moves, router):
+    """{move: [(model, key column, keys)]}: the moving buckets' user ids found on each
+    source, and the playlist ids of their users (playlist entries follow the owner)."""
+    wanted = {(source, bucket) for bucket, source, _ in moves}
+    users = defaultdict(list)
+    for source in {source for source, _ in wanted}:
+        for uid in shard_execute(source, select(Like.user_id).distinct()).scalars():
+            if (source, router.bucket(uid)) in wanted:
+                users[(source, router.bucket(uid))].append(uid)
+    buckets = {bucket for _, bucket in wanted}
+    playlists = defaultdict(list)
+    for pid, uid in db.session.query(Playlist.playlist_id, Playlist.user_id):
+        if router.bucket(uid) in buckets:
+            playlists[router.bucket(uid)].append(pid)
+    return {
+        (bucket, source, target): [(Like, Like.user_id, users[(source, bucket)]),
+                                   (TrackPlaylist, TrackPlaylist.playlist_id, playlists[bucket])]
+        for bucket, source, target in moves
+    }
+
+def move_buckets(moves, settle):
+    """Move buckets' Likes and TrackPlaylist rows between binds: copy, switch the map,
+    wait `settle` seconds for workers to reload it, copy what was written meanwhile, and
+    delete from the source. Commits after each step."""
+    router = get_shard_router()
+    groups = _bucket_keys(moves, router)
+
+    copied = {}
+    for (bucket, source, target), parts in groups.items():
+        for model, key_column, keys in parts:
+            rows = _bucket_rows(source, model, key_column, keys)
+            present = _bucket_rows(target, model, key_column, keys)
+            missing = [row for pk, row in rows.items() if pk not in present]
+            if missing:
+                shard_execute(target, insert(model.__table__), missing)
+            copied[(bucket, model)] = set(rows)
+        db.session.commit()
+    logger.info(f"Copied {len(groups)} bucket(s); switching the shard map")
+
+    now = datetime.utcnow()
+    for bucket, _, target in moves:
+        db.session.merge(ShardMap(bucket=bucket, bind_key=target, updated_at=now))
+    db.session.commit()
+    logger.info(f"Waiting {settle:g}s for workers to load the new shard map")
+    sleep(settle)
+
+    # Scanned again: users whose first like, and playlists created, since the copy began
+    late_groups = _bucket_keys(moves, router)
+    for move, parts in groups.items():
+        bucket, source, target = move
+        for (model, key_column, keys), (_, _, late_keys) in zip(parts, late_groups[move]):
+            keys = sorted(set(keys) | set(late_keys))
+            rows = _bucket_rows(source, model, key_column, keys)
+            present = _bucket_rows(target, model, key_column, keys)
+            before = copied[(bucket, model)]
+            # Written to the source before workers switched; rows the target has deleted since are not revived
+            late = [row for pk, row in rows.items() if pk not in before and pk not in present]
+            if late:
+                shard_execute(target, insert(model.__table__), late)
+            # Deleted on the source after the first copy
+            _delete_rows(target, model, (before - set(rows)) & set(present))
+            _delete_rows(source, model, list(rows))
+        db.session.commit()
+    current_app.extensions.pop('shard_router', None)
+
+# ============== ARTIST STATS ==============
+# ArtistStats/TrackStats are maintained incrementally by the upload, delete and like
+# handlers. A missing summary row is rebuilt from the base tables on first touch, and
+# `flask rebuild-artist-stats` recomputes everything in bulk.
+
+def _duration_seconds_expr():
+    return func.coalesce(
+        extract('hour', Track.duration) * 3600 + extract('minute', Track.duration) * 60 + extract('second', Track.duration),
+        0
+    )
+
+def rebuild_artist_stats(artist_id=None):
+    """Recompute TrackStats and ArtistStats from the base tables, for one artist or all of them."""
+    track_filter = [Track.artist_id == artist_id] if artist_id else []
+    if artist_id:
+        TrackStats.query.filter(TrackStats.artist_id == artist_id).delete(synchronize_session=False)
+        ArtistStats.query.filter(ArtistStats.artist_id == artist_id).delete(synchronize_session=False)
+    else:
+        TrackStats.query.delete(synchronize_session=False)
+        ArtistStats.query.delete(synchronize_session=False)
+
+    db.session.execute(insert(TrackStats.__table__).from_select(
+        ['TrackID', 'ArtistID', 'AlbumID', 'DurationSeconds', 'LikesCount'],
+        select(Track.track_id, Track.artist_id, Track.album_id, _duration_seconds_expr(), literal(0))
+        .where(*track_filter)
+    ))
+    # Likes may live in other databases, so they are counted per shard and written back
+    track_ids = [tid for (tid,) in db.session.query(Track.track_id).filter(*track_filter)] if artist_id else None
+    counts = like_counts_by_track(track_ids)
+    if counts:
+        stats = TrackStats.__table__
+        db.session.execute(
+            stats.update().where(stats.c.TrackID == bindparam('tid')).values(LikesCount=bindparam('likes')),
+            [{'tid': tid, 'likes': n} for tid, n in counts.items()]
+        )
+
+    track_agg = (
+        select(
+            TrackStats.artist_id.label('artist_id'),
+            func.count(TrackStats.track_id).label('tracks'),
+            func.sum(TrackStats.duration_seconds).label('duration'),
+            func.sum(TrackStats.likes_count).label('likes')
+        )
+        .where(*([TrackStats.artist_id == artist_id] if artist_id else []))
+        .group_by(TrackStats.artist_id)
+        .subquery()
+    )
+    album_agg = (
+        select(Album.artist_id.label('artist_id'), func.count(Album.album_id).label('albums'))
+        .where(*([Album.artist_id == artist_id] if artist_id else []))
+        .group_by(Album.artist_id)
+        .subquery()
+    )
+    artist_filter = [Artist.artist_id == artist_id] if artist_id else []
+    db.session.execute(insert(ArtistStats.__table__).from_select(
+        ['ArtistID', 'TrackCount', 'AlbumCount', 'TotalDuration', 'TotalLikes', 'UpdatedAt'],
+        select(
+            Artist.artist_id,
+            func.coalesce(track_agg.c.tracks, 0),
+            func.coalesce(album_agg.c.albums, 0),
+            func.coalesce(track_agg.c.duration, 0),
+            func.coalesce(track_agg.c.likes, 0),
+            func.now()
+        )
+        .outerjoin(track_agg, track_agg.c.artist_id == Artist.artist_id)
+        .outerjoin(album_agg, album_agg.c.artist_id == Artist.artist_id)
+        .where(*artist_filter)
+    ))
+
+def bump_artist_stats(artist_id, tracks=0, albums=0, duration=0, likes=0):
+    """Apply counter deltas to an artist summary; rebuilds the row if it does not exist yet.
+
+    Call after the triggering change has been flushed so a rebuild already includes it.
+    """
+    if not artist_id:
+        return
+    deltas = {
+        ArtistStats.track_count: tracks,
+        ArtistStats.album_count: albums,
+        ArtistStats.total_duration: duration,
+        ArtistStats.total_likes: likes
+    }
+    values = {col: col + delta for col, delta in deltas.items() if delta}
+    if not values:
+        return
+    values[ArtistStats.updated_at] = datetime.utcnow()
+    updated = ArtistStats.query.filter(ArtistStats.artist_id == artist_id).update(values, synchronize_session=False)
+    if not updated:
+        rebuild_artist_stats(artist_id)
+
+def on_track_uploaded(track, album_created=False):
+    db.session.add(TrackStats(
+        track_id=track.track_id,
+        artist_id=track.artist_id,
+        album_id=track.album_id,
+        duration_seconds=track.duration_seconds(),
+        likes_count=0
+    ))
+    db.session.flush()
+    bump_artist_stats(track.artist_id, tracks=1, albums=1 if album_created else 0, duration=track.duration_seconds())
+
+def on_track_deleted(track, likes_count):
+    TrackStats.query.filter(TrackStats.track_id == track.track_id).delete(synchronize_session=False)
+    bump_artist_stats(track.artist_id, tracks=-1, duration=-track.duration_seconds(), likes=-likes_count)
+
+def on_like_changed(track, delta):
+    updated = TrackStats.query.filter(TrackStats.track_id == track.track_id).update(
+        {TrackStats.likes_count: TrackStats.likes_count + delta}, synchronize_session=False
+    )
+    if not updated and not track.artist_id:
+        db.session.add(TrackStats(
+            track_id=track.track_id,
+            album_id=track.album_id,
+            duration_seconds=track.duration_seconds(),
+            likes_count=like_counts_by_track([track.track_id]).get(track.track_id, 0)
+        ))
+    elif not updated:
+        # Artist rebuild recreates this track's stats row along with the summary
+        rebuild_artist_stats(track.artist_id)
+        return
+    bump_artist_stats(track.artist_id, likes=delta)
+
+def invalidate_like_counts():
+    # The popular ranking moves with every like; cached playlist trees take counts at read time
+    get_section_cache().invalidate('home:popular:')
+
+def liked_track_ids(user_id, track_ids):
+    """Return the subset of track_ids liked by user_id, in one query."""
+    if not user_id or not track_ids:
+        return set()
+    uid = int(user_id)
+    return set(shard_execute(user_shard(uid), lambda_stmt(
+        lambda: select(Like.track_id).where(Like.user_id == uid, Like.track_id.in_(track_ids))
+    )).scalars())
+
+# ============== CACHE ==============
+class TTLCache:
+    """Small thread-safe in-process cache with per-entry expiry.
+
+    Entries expire ttl seconds after they are set; with sliding=True every hit pushes
+    that back to ttl seconds from now, so only entries left unread expire.
+    """
+
+    def __init__(self, ttl=30, max_entries=None, sliding=False):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.sliding = sliding
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _lookup(self, key, now):
+        # Caller holds the lock
+        entry = self._data.get(key)
+        if not entry:
+            return None
+        expires, value = entry
+        if expires < now:
+            del self._data[key]
+            return None
+        if self.sliding:
+            # Re-inserted at the end, so eviction order stays least recently used
+            del self._data[key]
+            self._data[key] = (now + self.ttl, value)
+        return value
+
+    def _store(self, key, value, expires):
+        # Caller holds the lock
+        self._data.pop(key, None)
+        self._data[key] = (expires, value)
+        if self.max_entries and len(self._data) > self.max_entries:
+            # dicts keep insertion order, so the first key is the oldest entry
+            del self._data[next(iter(self._data))]
+
+    def get(self, key):
+        with self._lock:
+            return self._lookup(key, datetime.utcnow().timestamp())
+
+    def set(self, key, value, ttl=None):
+        expires = datetime.utcnow().timestamp() + (ttl if ttl is not None else self.ttl)
+        with self._lock:
+            self._store(key, value, expires)
+
+    def get_or_set(self, key, build, ttl=None):
+        """The cached value, else build()'s. Concurrent misses may each build, but all get the value stored first."""
+        value = self.get(key)
+        if value is not None:
+            return value
+        value = build()  # outside the lock: builds may query the database
+        with self._lock:
+            now = datetime.utcnow().timestamp()
+            current = self._lookup(key, now)
+            if current is not None:
+                return current
+            self._store(key, value, now + (ttl if ttl is not None else self.ttl))
+        return value
+
+    def invalidate(self, prefix=''):
+        with self._lock:
+            for key in [k for k in self._data if k.startswith(prefix)]:
+                del self._data[key]
+
+# ============== SHARED CACHE ==============
+# Cached sections live in files under SHARED_CACHE_DIR (tmpfs when available), one per
+# key: a fixed header (magic, expiry, generation) followed by the JSON payload, replaced
+# atomically on write. Rebuilds are single-flight across processes: the worker that
+# wins the key's flock rebuilds, the others serve the stale copy for up to
+# SHARED_CACHE_STALE_GRACE seconds or wait for the winner when there is none, for at most
+# SHARED_CACHE_LOCK_TIMEOUT seconds before building it themselves.
+# invalidate() also bumps a generation counter in an mmap'd file, so a rebuild that
+# started before the invalidation is returned but not stored.
+
+_ENTRY_HEADER = struct.Struct('<4sdQ')
+_ENTRY_MAGIC = b'SMC1'
+
+class SharedCache:
+    """Host-wide cache with the TTLCache interface, shared by worker processes."""
+
+    def __init__(self, directory, ttl=30, stale_grace=60, lock_timeout=10):
+        self.directory = directory
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self.lock_timeout = lock_timeout
+        self.counters = Counter()
+        self._thread_locks = {}  # used instead of flock where fcntl is missing
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '.generation'), 'ab') as f:
+            if f.tell() < 8:
+                f.write(bytes(8 - f.tell()))
+        with open(os.path.join(directory, '.generation'), 'r+b') as f:
+            self._generation = mmap.mmap(f.fileno(), 8)
+
+    def _path(self, key, kind=''):
+        # Quoted keys keep prefixes intact for invalidate()
+        return os.path.join(self.directory, kind + quote(key, safe=''))
+
+    def generation(self):
+        return struct.unpack_from('<Q', self._generation)[0]
+
+    def _read(self, key):
+        try:
+            with open(self._path(key), 'rb') as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) < _ENTRY_HEADER.size or data[:4] != _ENTRY_MAGIC:
+            return None
+        _, expires, _ = _ENTRY_HEADER.unpack_from(data)
+        payload = data[_ENTRY_HEADER.size:]
+        return expires, (orjson.loads(payload) if orjson is not None else json.loads(payload))
+
+    def get(self, key):
+        entry = self._read(key)
+        if entry and entry[0] >= datetime.utcnow().timestamp():
+            return entry[1]
+        return None
+
+    def set(self, key, value, ttl=None, generation=None):
+        if generation is not None and generation != self.generation():
+            self.counters['discarded'] += 1  # invalidated while this value was being built
+            return
+        expires = datetime.utcnow().timestamp() + (ttl if ttl is not None else self.ttl)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(_ENTRY_HEADER.pack(_ENTRY_MAGIC, expires, self.generation()))
+                f.write(dumps_bytes(value))
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+
+    def _flock(self, key):
+        if fcntl is None:
+            with self._lock:
+                return self._thread_locks.setdefault(key, threading.Lock())
+        return open(self._path(key, '.lock-'), 'a+b')
+
+    def _acquire(self, lock, blocking):
+        """Take the lock; a blocking take gives up after lock_timeout seconds and returns False."""
+        if fcntl is None:
+            return lock.acquire(timeout=self.lock_timeout) if blocking else lock.acquire(False)
+        # flock has no timeout of its own, so poll
+        due = perf_counter() + self.lock_timeout
+        while True:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if not blocking or perf_counter() >= due:
+                    return False
+                sleep(0.01)
+
+    def _release(self, lock, held):
+        if fcntl is not None:
+            lock.close()  # closing the file drops the flock
+        elif held:
+            lock.release()
+
+    def get_or_set(self, key, build, ttl=None):
+        now = datetime.utcnow().timestamp()
+        entry = self._read(key)
+        if entry and entry[0] >= now:
+            self.counters['hits'] += 1
+            return entry[1]
+        lock, held = self._flock(key), False
+        try:
+            held = self._acquire(lock, blocking=False)
+            if not held:
+                if entry and entry[0] + self.stale_grace >= now:
+                    self.counters['stale'] += 1
+                    return entry[1]
+                self.counters['waits'] += 1
+                held = self._acquire(lock, blocking=True)
+                if not held:
+                    self.counters['lock_timeouts'] += 1  # the rebuild is stuck; don't hang the request on it
+            # Another worker may have refreshed the key while we waited for the lock
+            entry = self._read(key)
+            if entry and entry[0] >= datetime.utcnow().timestamp():
+                self.counters['hits'] += 1
+                return entry[1]
+            self.counters['misses'] += 1
+            generation = self.generation()
+            value = build()
+            self.set(key, value, ttl, generation)
+            return value
+        finally:
+            self._release(lock, held)
+
+    def invalidate(self, prefix=''):
+        marker = self._path(prefix)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.startswith('.') and path.startswith(marker):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+        lock, held = self._flock('.generation'), False
+        try:
+            held = self._acquire(lock, blocking=True)
+            if not held:
+                self.counters['lock_timeouts'] += 1  # bump anyway: a lost increment beats a missed one
+            struct.pack_into('<Q', self._generation, 0, self.generation() + 1)
+        finally:
+            self._release(lock, held)
+
+    def stats(self):
+        lookups = self.counters['hits'] + self.counters['stale'] + self.counters['misses']
+        return dict(self.counters, hit_ratio=round((lookups - self.counters['misses']) / lookups, 4) if lookups else None)
+
+def get_section_cache():
+    """The host-wide cache for user-independent sections, created on first use."""
+    cache = current_app.extensions.get('section_cache')
+    if cache is None:
+        config = current_app.config
+        # One subdirectory per database, so apps pointed at different databases never share entries
+        namespace = hashlib.sha1(config['SQLALCHEMY_DATABASE_URI'].encode()).hexdigest()[:12]
+        cache = current_app.extensions['section_cache'] = SharedCache(
+            os.path.join(config['SHARED_CACHE_DIR'], namespace), config['HOME_CACHE_TTL'],
+            config['SHARED_CACHE_STALE_GRACE'], config['SHARED_CACHE_LOCK_TIMEOUT']
+        )
+    return cache
+
+# ============== HOME FEED ==============
+# Each section is built from user-independent data so it can be cached and shared;
+# per-user like flags are applied afterwards in a single query.
+_home_executor = None
+_home_executor_lock = threading.Lock()
+
+def _get_home_executor():
+    global _home_executor
+    with _home_executor_lock:
+        if _home_executor is None:
+            _home_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='home-section')
+        return _home_executor
+
+def _likes_counts(track_ids):
+    # The TrackStats counters: Likes may be spread over several shards
+    if not track_ids:
+        return {}
+    return dict(db.session.execute(lambda_stmt(
+        lambda: select(TrackStats.track_id, TrackStats.likes_count).where(TrackStats.track_id.in_(track_ids))
+    )).all())
+
+def tracks_to_dicts(tracks, user_id=None):
+    """Track.to_dict for a list, with like counts and liked flags from two queries in total."""
+    ids = [t.track_id for t in tracks]
+    counts = _likes_counts(ids)
+    liked = liked_track_ids(user_id, ids)
+    return [t.to_dict(user_id, likes_count=counts.get(t.track_id, 0), is_liked=t.track_id in liked) for t in tracks]
+
+def plans_section():
+    plans = SubscriptionPlan.query.order_by(SubscriptionPlan.subscription_plan_id).all()
+    return [p.to_dict() for p in plans]
+
+def popular_section(limit=10):
+    return [r.to_dict() for r in popular_track_records(limit)]
+
+def tracks_section(page=1, limit=50):
+    total = count_tracks()
+    return {
+        'tracks': [r.to_dict() for r in track_records_page((page - 1) * limit, limit)],
+        'total': total,
+        'pages': (total + limit - 1) // limit,
+        'current_page': page
+    }
+
+def artists_section(page=1, limit=50):
+    artists_query = (
+        db.session.query(Artist, ArtistStats)
+        .outerjoin(ArtistStats, ArtistStats.artist_id == Artist.artist_id)
+        .order_by(Artist.artist_id)
+        .paginate(page=page, per_page=limit, error_out=False)
+    )
+    return {
+        'artists': [dict(a.to_dict(), stats=s.to_dict() if s else None) for a, s in artists_query.items],
+        'total': artists_query.total,
+        'pages': artists_query.pages,
+        'current_page': page
+    }
+
+def _run_section(app, key, build, ttl):
+    # Runs on a pool thread: its own app context means its own session and pooled connection
+    with app.app_context():
+        return get_section_cache().get_or_set(key, build, ttl)
+
+def gather_home_sections(sections, timeout, ttl):
+    """Build {name: (cache_key, builder)} concurrently; returns (results, timed_out, failed)."""
+    app = current_app._get_current_object()
+    executor = _get_home_executor()
+    futures = {executor.submit(_run_section, app, key, build, ttl): name for name, (key, build) in sections.items()}
+    done, pending = wait(futures, timeout=timeout)
+    results, failed = {}, []
+    for future in done:
+        name = futures[future]
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            logger.error(f"Home section {name} failed: {e}")
+            failed.append(name)
+    timed_out = sorted(futures[f] for f in pending)
+    if timed_out:
+        logger.warning(f"Home sections timed out: {timed_out}")
+    return results, timed_out, sorted(failed)
+
+def apply_user_likes(track_lists, user_id):
+    """Copy each cached track dict with this user's is_liked_by_user flag filled in."""
+    ids = {t['track_id'] for tracks in track_lists for t in tracks}
+    liked = liked_track_ids(user_id, list(ids))
+    return [[dict(t, is_liked_by_user=t['track_id'] in liked) for t in tracks] for tracks in track_lists]
+
+# ============== STREAMING RESPONSES ==============
+# Large result sets are read through a server-side cursor (yield_per) as lightweight
+# rows and serialized incrementally, so memory stays flat however many rows there are.
+STREAM_FORMATS = ('stream', 'ndjson')
+
+def _json_default(obj):
+    return obj.isoformat() if hasattr(obj, 'isoformat') else str(obj)
+
+def dumps_bytes(obj):
+    if orjson is not None:
+        return orjson.dumps(obj, default=_json_default)
+    return json.dumps(obj, default=_json_default, separators=(',', ':')).encode('utf-8')
+
+def stream_rows(stmt):
+    """Execute a Core/ORM select with a server-side cursor and yield its rows."""
+    yield_per = current_app.config['STREAM_YIELD_PER']
+    result = db.session.execute(stmt.execution_options(yield_per=yield_per))
+    try:
+        for row in result:
+            yield row
+    finally:
+        result.close()
+
+def _chunked(pieces):
+    # Coalesce many small encoded pieces into chunks of about STREAM_CHUNK_BYTES
+    limit = current_app.config['STREAM_CHUNK_BYTES']
+    buf, size = [], 0
+    for piece in pieces:
+        buf.append(piece)
+        size += len(piece)
+        if size >= limit:
+            yield b''.join(buf)
+            buf, size = [], 0
+    if buf:
+        yield b''.join(buf)
+
+def _json_object_pieces(head, sections, tail=None):
+    # head: dict emitted first; sections: [(key, iterable of dicts)]; tail: callable -> dict emitted last
+    first = True
+    yield b'{'
+    for key, value in head.items():
+        yield (b'' if first else b',') + dumps_bytes(key) + b':' + dumps_bytes(value)
+        first = False
+    for key, items in sections:
+        yield (b'' if first else b',') + dumps_bytes(key) + b':['
+        first = False
+        sep = b''
+        for item in items:
+            yield sep + dumps_bytes(item)
+            sep = b','
+        yield b']'
+    for key, value in (tail() if tail else {}).items():
+        yield (b'' if first else b',') + dumps_bytes(key) + b':' + dumps_bytes(value)
+        first = False
+    yield b'}'
+
+def _ndjson_pieces(head, sections, tail=None):
+    if head:
+        yield dumps_bytes(dict(head, type='header')) + b'\n'
+    for key, items in sections:
+        for item in items:
+            yield dumps_bytes(dict(item, type=key)) + b'\n'
+    if tail:
+        yield dumps_bytes(dict(tail(), type='footer')) + b'\n'
+
+def streaming_response(fmt, head, sections, tail=None):
+    """Stream head/sections/tail as one chunked JSON object or as NDJSON lines."""
+    if fmt == 'ndjson':
+        pieces, mimetype = _ndjson_pieces(head, sections, tail), 'application/x-ndjson'
+    else:
+        pieces, mimetype = _json_object_pieces(head, sections, tail), 'application/json'
+    return Response(stream_with_context(_chunked(pieces)), mimetype=mimetype)
+
+def _track_fields():
+    # Track columns plus artist name and album title; select from Track outer-joined to Artist and Album
+    return [
+        Track.track_id, Track.title, Track.artist_id, Artist.name.label('artist_name'),
+        Track.album_id, Album.title.label('album_title'), Track.duration, Track.release_date,
+        Track.file_path
+    ]
+
+def _track_columns():
+    # Like counts are the TrackStats counters, since Likes may be spread over several shards
+    return _track_fields() + [
+        select(TrackStats.likes_count).where(TrackStats.track_id == Track.track_id)
+        .correlate(Track).scalar_subquery().label('likes_count')
+    ]
+
+# ============== READ MODELS ==============
+# Read-only track endpoints select just the columns they serialize. Their statements are
+# lambda_stmt()s: SQLAlchemy builds and caches each one per code location and afterwards
+# only binds the new values, so a request skips statement construction and cache-key
+# generation. Rows become __slots__ records instead of mapped instances, so nothing is
+# added to the identity map and nothing can lazy-load.
+TRACK_FIELDS = _track_fields()
+TRACK_COLUMNS = _track_columns()
+
+class TrackRecord:
+    """A track as listed to a user; to_dict() has the shape of Track.to_dict()."""
+    __slots__ = ('track_id', 'title', 'artist_id', 'artist_name', 'album_id', 'album_title',
+                 'duration', 'release_date', 'file_path', 'likes_count', 'is_liked')
+
+    def __init__(self, row, is_liked=False):
+        self.track_id = row.track_id
+        self.title = row.title
+        self.artist_id = row.artist_id
+        self.artist_name = row.artist_name
+        self.album_id = row.album_id
+        self.album_title = row.album_title
+        self.duration = row.duration
+        self.release_date = row.release_date
+        self.file_path = row.file_path
+        self.likes_count = row.likes_count or 0
+        self.is_liked = bool(is_liked)
+
+    def to_dict(self):
+        d = self.duration
+        return {
+            'track_id': self.track_id,
+            'title': self.title,
+            'artist_id': self.artist_id,
+            'artist_name': self.artist_name or 'Unknown',
+            'album_id': self.album_id,
+            'album_title': self.album_title,
+            'duration': str(d) if d else '00:00:00',
+            'duration_seconds': d.hour * 3600 + d.minute * 60 + d.second if d else 0,
+            'release_date': self.release_date.isoformat() if self.release_date else None,
+            'likes_count': self.likes_count,
+            'is_liked_by_user': self.is_liked,
+            'file_path': self.file_path
+        }
+
+def track_record(track_id, user_id=None):
+    """One track with its like count, or None; the liked flag comes from the user's shard."""
+    row = db.session.execute(lambda_stmt(lambda: (
+        select(*TRACK_COLUMNS)
+        .select_from(Track)
+        .outerjoin(Artist, Artist.artist_id == Track.artist_id)
+        .outerjoin(Album, Album.album_id == Track.album_id)
+        .where(Track.track_id == track_id)
+    ))).first()
+    if row is None:
+        return None
+    return TrackRecord(row, bool(liked_track_ids(user_id, [row.track_id])))
+
+def track_records_page(offset, limit, user_id=None):
+    """A page of tracks in id order, like counts and liked flags included."""
+    rows = db.session.execute(lambda_stmt(lambda: (
+        select(*TRACK_COLUMNS)
+        .select_from(Track)
+        .outerjoin(Artist, Artist.artist_id == Track.artist_id)
+        .outerjoin(Album, Album.album_id == Track.album_id)
+        .order_by(Track.track_id)
+        .offset(offset)
+        .limit(limit)
+    ))).all()
+    liked = liked_track_ids(user_id, [row.track_id for row in rows])
+    return [TrackRecord(row, row.track_id in liked) for row in rows]
+
+def track_records_by_ids(track_ids):
+    """{track_id: TrackRecord} for the ids that exist; liked flags are left to the caller."""
+    if not track_ids:
+        return {}
+    rows = db.session.execute(lambda_stmt(lambda: (
+        select(*TRACK_COLUMNS)
+        .select_from(Track)
+        .outerjoin(Artist, Artist.artist_id == Track.artist_id)
+        .outerjoin(Album, Album.album_id == Track.album_id)
+        .where(Track.track_id.in_(track_ids))
+    )))
+    return {row.track_id: TrackRecord(row) for row in rows}
+
+def iter_playlist_tracks(playlist, user_id=None):
+    """TrackRecords of a playlist in play order, a shard page at a time."""
+    for entries in playlist_entry_chunks(playlist):
+        ids = [track_id for track_id, _ in entries]
+        records = track_records_by_ids(ids)
+        liked = liked_track_ids(user_id, ids)
+        for track_id in ids:
+            record = records.get(track_id)
+            if record is not None:
+                record.is_liked = track_id in liked
+                yield record
+
+def iter_liked_tracks(user_id):
+    """(TrackRecord, liked_at) for a user's likes, oldest first, a shard page at a time."""
+    uid = int(user_id)
+    stmt = select(Like.track_id, Like.liked_at).where(Like.user_id == uid)
+    for likes in keyset_chunks(user_shard(uid), stmt, Like.liked_at, Like.track_id):
+        records = track_records_by_ids([track_id for track_id, _ in likes])
+        for track_id, liked_at in likes:
+            record = records.get(track_id)
+            if record is not None:
+                record.is_liked = True
+                yield record, liked_at
+
+def count_tracks():
+    return db.session.execute(lambda_stmt(lambda: select(func.count(Track.track_id)))).scalar_one()
+
+def popular_track_records(limit):
+    """Most liked tracks first; liked flags are left for apply_user_likes."""
+    rows = db.session.execute(lambda_stmt(lambda: (
+        select(*TRACK_FIELDS, func.coalesce(TrackStats.likes_count, 0).label('likes_count'))
+        .select_from(Track)
+        .outerjoin(TrackStats, TrackStats.track_id == Track.track_id)
+        .outerjoin(Artist, Artist.artist_id == Track.artist_id)
+        .outerjoin(Album, Album.album_id == Track.album_id)
+        .order_by(desc('likes_count'), Track.track_id)
+        .limit(limit)
+    )))
+    return [TrackRecord(row) for row in rows]
+
+# ============== COMPRESSION ==============
+# Buffered text/JSON responses are compressed with the best encoding the client accepts.
+# Compressed bodies are cached by content hash, so a cached payload served again is
+# not re-compressed. Streamed bodies, ranges and audio files are passed through untouched.
+compressed_cache = TTLCache(ttl=300, max_entries=Config.COMPRESS_CACHE_ENTRIES)
+
+def available_encodings():
+    encodings = []
+    if zstandard is not None:
+        encodings.append('zstd')
+    if brotli is not None:
+        encodings.append('br')
+    encodings.append('gzip')
+    return encodings
+
+def compress_body(body, encoding, level):
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(body)
+    if encoding == 'br':
+        return brotli.compress(body, quality=level)
+    return gzip.compress(body, compresslevel=level, mtime=0)
+
+def cached_compress(body, encoding, level):
+    key = f"{hashlib.blake2b(body, digest_size=16).hexdigest()}:{encoding}:{level}"
+    compressed = compressed_cache.get(key)
+    if compressed is None:
+        compressed = compress_body(body, encoding, level)
+        compressed_cache.set(key, compressed)
+    return compressed
+
+def compress_response(response):
+    """after_request hook negotiating Content-Encoding for buffered text/JSON responses."""
+    config = current_app.config
+    if (
+        response.direct_passthrough or response.is_streamed
+        or response.status_code != 200
+        or 'Content-Encoding' in response.headers
+        or response.mimetype not in config['COMPRESS_MIMETYPES']
+    ):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if not encoding:
+        return response
+    body = response.get_data()
+    if len(body) < config['COMPRESS_MIN_SIZE']:
+        return response
+    compressed = cached_compress(body, encoding, config['COMPRESS_LEVELS'][encoding])
+    if len(compressed) >= len(body):
+        return response
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+# ============== STORAGE ==============
+# Audio files live behind a small blob interface so API nodes can be stateless:
+# save/delete/exists/size/iter_range plus local_path(), which returns a path on this
+# machine when the bytes are already here (lets stream_track use send_file).
+
+class LocalStorage:
+    """Blobs stored as files under one directory."""
+    listable = True
+
+    def __init__(self, root, chunk_size=256 * 1024):
+        self.root = root
+        self.chunk_size = chunk_size
+
+    def _path(self, key):
+        return os.path.join(self.root, secure_filename(key))
+
+    def save(self, key, fileobj, content_type=None):
+        os.makedirs(self.root, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.root, prefix='.upload-')
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                shutil.copyfileobj(fileobj, out, self.chunk_size)
+            os.replace(tmp_path, self._path(key))
+        except Exception:
+            os.unlink(tmp_path)
+            raise
+        return os.path.getsize(self._path(key))
+
+    def exists(self, key):
+        return os.path.isfile(self._path(key))
+
+    def size(self, key):
+        return os.path.getsize(self._path(key))
+
+    def delete(self, key):
+        if self.exists(key):
+            os.remove(self._path(key))
+
+    def list_keys(self):
+        if not os.path.isdir(self.root):
+            return []
+        return [f for f in os.listdir(self.root) if not f.startswith('.')]
+
+    def iter_range(self, key, start=0, end=None):
+        """Yield bytes [start, end] (inclusive, like HTTP ranges) in chunks."""
+        with open(self._path(key), 'rb') as f:
+            f.seek(start)
+            remaining = None if end is None else end - start + 1
+            while remaining is None or remaining > 0:
+                chunk = f.read(self.chunk_size if remaining is None else min(self.chunk_size, remaining))
+                if not chunk:
+                    break
+                if remaining is not None:
+                    remaining -= len(chunk)
+                yield chunk
+
+    def local_path(self, key):
+        path = self._path(key)
+        return path if os.path.isfile(path) else None
+
+class S3Storage:
+    """Blobs in an S3-compatible bucket (AWS, MinIO, moto)."""
+    listable = False  # listing a bucket per request is too slow for the stream fallback
+
+    def __init__(self, bucket, prefix='', endpoint_url=None, region=None, access_key=None, secret_key=None,
+                 multipart_threshold=8 * 1024 * 1024, part_size=8 * 1024 * 1024, chunk_size=256 * 1024):
+        if boto3 is None:
+            raise RuntimeError("STORAGE_BACKEND 's3' requires boto3 (pip install boto3)")
+        self.bucket = bucket
+        self.prefix = prefix
+        self.multipart_threshold = multipart_threshold
+        self.part_size = part_size
+        self.chunk_size = chunk_size
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url, region_name=region,
+            aws_access_key_id=access_key, aws_secret_access_key=secret_key
+        )
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def save(self, key, fileobj, content_type=None):
+        extra = {'ContentType': content_type} if content_type else {}
+        first = fileobj.read(self.multipart_threshold)
+        rest = fileobj.read(1) if len(first) == self.multipart_threshold else b''
+        if not rest:
+            self.client.put_object(Bucket=self.bucket, Key=self._key(key), Body=first, **extra)
+            return len(first)
+
+        # Multipart: parts are read one at a time, so memory is bounded by part_size
+        upload = self.client.create_multipart_upload(Bucket=self.bucket, Key=self._key(key), **extra)
+        parts, total, buffer = [], 0, first + rest
+        try:
+            while buffer:
+                while len(buffer) < self.part_size:
+                    more = fileobj.read(self.part_size - len(buffer))
+                    if not more:
+                        break
+                    buffer += more
+                part = self.client.upload_part(
+                    Bucket=self.bucket, Key=self._key(key), UploadId=upload['UploadId'],
+                    PartNumber=len(parts) + 1, Body=buffer
+                )
+                parts.append({'PartNumber': len(parts) + 1, 'ETag': part['ETag']})
+                total += len(buffer)
+                buffer = fileobj.read(self.part_size)
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=self._key(key), UploadId=upload['UploadId'],
+                MultipartUpload={'Parts': parts}
+            )
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=self._key(key), UploadId=upload['UploadId'])
+            raise
+        return total
+
+    def exists(self, key):
+        try:
+            self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def size(self, key):
+        return self.client.head_object(Bucket=self.bucket, Key=self._key(key))['ContentLength']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def list_keys(self):
+        keys = []
+        for page in self.client.get_paginator('list_objects_v2').paginate(Bucket=self.bucket, Prefix=self.prefix):
+            keys.extend(obj['Key'][len(self.prefix):] for obj in page.get('Contents', []))
+        return keys
+
+    def iter_range(self, key, start=0, end=None):
+        byte_range = f"bytes={start}-{'' if end is None else end}"
+        body = self.client.get_object(Bucket=self.bucket, Key=self._key(key), Range=byte_range)['Body']
+        try:
+            for chunk in body.iter_chunks(self.chunk_size):
+                yield chunk
+        finally:
+            body.close()
+
+    def local_path(self, key):
+        return None
+
+_cache_fill_executor = None
+_cache_fill_executor_lock = threading.Lock()
+
+def _get_cache_fill_executor():
+    global _cache_fill_executor
+    with _cache_fill_executor_lock:
+        if _cache_fill_executor is None:
+            _cache_fill_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='storage-cache-fill')
+        return _cache_fill_executor
+
+class CachedStorage:
+    """Read-through disk cache in front of a remote backend.
+
+    A miss is served straight from the backend while a small worker pool copies the
+    object into cache_dir; later reads get a local path. At most max_pending copies are
+    queued; misses beyond that are left for a later read. Least recently used files are
+    evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, backend, cache_dir, max_bytes, max_pending=32):
+        self.backend = backend
+        self.cache = LocalStorage(cache_dir, backend.chunk_size)
+        self.chunk_size = backend.chunk_size
+        self.max_bytes = max_bytes
+        self.max_pending = max_pending
+        self.listable = backend.listable
+        self._filling = set()
+        self._lock = threading.Lock()
+
+    def save(self, key, fileobj, content_type=None):
+        self.cache.delete(key)
+        return self.backend.save(key, fileobj, content_type)
+
+    def delete(self, key):
+        self.cache.delete(key)
+        self.backend.delete(key)
+
+    def exists(self, key):
+        return self.cache.exists(key) or self.backend.exists(key)
+
+    def size(self, key):
+        return self.cache.size(key) if self.cache.exists(key) else self.backend.size(key)
+
+    def list_keys(self):
+        return self.backend.list_keys()
+
+    def iter_range(self, key, start=0, end=None):
+        if self.cache.exists(key):
+            return self.cache.iter_range(key, start, end)
+        return self.backend.iter_range(key, start, end)
+
+    def local_path(self, key):
+        path = self.cache.local_path(key)
+        if path:
+            os.utime(path)  # mtime doubles as the LRU clock
+            return path
+        self._fill_in_background(key)
+        return None
+
+    def _fill_in_background(self, key):
+        with self._lock:
+            if key in self._filling or len(self._filling) >= self.max_pending:
+                return
+            self._filling.add(key)
+        _get_cache_fill_executor().submit(self._fill, key)
+
+    def _fill(self, key):
+        try:
+            self.cache.save(key, _IterStream(self.backend.iter_range(key)))
+            self._evict()
+        except Exception as e:
+            logger.warning(f"Storage cache fill failed for {key}: {e}")
+        finally:
+            with self._lock:
+                self._filling.discard(key)
+
+    def _evict(self):
+        entries = []
+        for name in self.cache.list_keys():
+            st = os.stat(os.path.join(self.cache.root, name))
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self.cache.delete(name)
+            total -= size
+
+class _IterStream:
+    # Minimal file-like wrapper so an iterator of chunks can be fed to copyfileobj
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buf = b''
+
+    def read(self, size=-1):
+        while size < 0 or len(self._buf) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buf += chunk
+        if size < 0:
+            data, self._buf = self._buf, b''
+        else:
+            data, self._buf = self._buf[:size], self._buf[size:]
+        return data
+
+def create_storage(config):
+    if config['STORAGE_BACKEND'] == 's3':
+        storage = S3Storage(
+            config['S3_BUCKET'], config['S3_PREFIX'], config['S3_ENDPOINT_URL'], config['S3_REGION'],
+            config['S3_ACCESS_KEY'], config['S3_SECRET_KEY'],
+            config['S3_MULTIPART_THRESHOLD'], config['S3_PART_SIZE'], config['STORAGE_READ_CHUNK']
+        )
+        if config['STORAGE_CACHE_DIR']:
+            storage = CachedStorage(storage, config['STORAGE_CACHE_DIR'], config['STORAGE_CACHE_MAX_BYTES'])
+        return storage
+    return LocalStorage(config['UPLOAD_FOLDER'], config['STORAGE_READ_CHUNK'])
+
+def get_storage():
+    """The app's storage backend, created on first use."""
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        storage = current_app.extensions['storage'] = create_storage(current_app.config)
+    return storage
+
+def send_blob(storage, key):
+    """Serve a stored blob with HTTP range support, from disk when possible, else passed through."""
+    mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    hot = get_hot_cache()
+    if hot:
+        response = send_hot(hot, storage, key, mimetype)
+        if response is not None:
+            return response
+    path = storage.local_path(key)
+    if path:
+        return send_from_directory(os.path.dirname(path), os.path.basename(path), as_attachment=False, mimetype=mimetype)
+
+    size = storage.size(key)
+    headers = {'Accept-Ranges': 'bytes'}
+    if request.range and request.range.units == 'bytes':
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        start, stop = byte_range
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+        headers['Content-Length'] = str(stop - start)
+        return Response(storage.iter_range(key, start, stop - 1), status=206, mimetype=mimetype,
+                        headers=headers, direct_passthrough=True)
+    headers['Content-Length'] = str(size)
+    return Response(storage.iter_range(key), status=200, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+# ============== PLAYLIST DOWNLOADS ==============
+# A playlist's audio plus manifest.json as one uncompressed tar (PAX headers, so long and
+# non-ASCII names survive), generated while it is sent. The layout depends only on the
+# track list and the stored sizes, so the length and every offset are known before the
+# first byte: Range requests resume anywhere, and the ETag changes whenever the layout
+# would. Tar rather than zip because zip headers carry each file's CRC-32, and resuming
+# would mean reading every earlier file again to rebuild the central directory.
+TAR_BLOCK = 512
+blob_sizes = TTLCache(ttl=600, max_entries=100000)  # storage keys are unique per upload, so sizes never change
+
+def blob_size(storage, key):
+    size = blob_sizes.get(key)
+    if size is None:
+        size = storage.size(key)
+        blob_sizes.set(key, size)
+    return size
+
+def _archive_name(text):
+    return re.sub(r'[\x00-\x1f/\\:*?"<>|]+', '_', text).strip(' .') or '_'
+
+def _tar_header(name, size, mtime):
+    info = tarfile.TarInfo(name)
+    info.size, info.mtime, info.mode = size, mtime, 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, 'utf-8')
+
+class PlaylistArchive:
+    """Byte layout of a playlist tar: segments of literal bytes or whole stored blobs."""
+
+    def __init__(self, playlist, storage):
+        self.storage = storage
+        self.segments = []  # (length, bytes or None, storage key or None)
+        self.tracks, self.missing = [], []
+        rows = list(iter_playlist_tracks(playlist))
+        root = _archive_name(playlist.title or f'playlist-{playlist.playlist_id}')
+        # Days since the epoch rather than datetime.timestamp(): the same on every server
+        mtime = (playlist.creation_date - date(1970, 1, 1)).days * 86400 if playlist.creation_date else 0
+        width = max(2, len(str(len(rows))))
+        files = []
+        for n, row in enumerate(rows, 1):
+            d = row.to_dict()
+            info = {k: d[k] for k in ('track_id', 'title', 'artist_name', 'album_title', 'duration', 'release_date')}
+            size = None
+            if row.file_path:
+                try:
+                    size = blob_size(storage, row.file_path)
+                except (OSError, ClientError) as e:
+                    logger.warning(f"Download: no audio for track {row.track_id}: {e}")
+            if size is None:
+                self.missing.append(info)
+                continue
+            name = (f"{root}/{n:0{width}d} - {_archive_name(info['artist_name'])} - "
+                    f"{_archive_name(info['title'] or 'Untitled')}{os.path.splitext(row.file_path)[1].lower()}")
+            self.tracks.append(dict(info, file=name))
+            files.append((name, row.file_path, size))
+
+        manifest = json.dumps({
+            'playlist': {'playlist_id': playlist.playlist_id, 'title': playlist.title,
+                         'creation_date': playlist.creation_date.isoformat() if playlist.creation_date else None},
+            'tracks': self.tracks,
+            'missing': self.missing
+        }, indent=2, sort_keys=True).encode('utf-8')
+        digest = hashlib.sha1(manifest)
+        self._add(f'{root}/manifest.json', len(manifest), mtime, data=manifest)
+        for name, key, size in files:
+            self._add(name, size, mtime, key=key)
+            digest.update(f'{key}\0{size}\n'.encode())
+        self.segments.append((2 * TAR_BLOCK, bytes(2 * TAR_BLOCK), None))  # end-of-archive marker
+        self.size = sum(length for length, _, _ in self.segments)
+        self.etag = digest.hexdigest()
+
+    def _add(self, name, size, mtime, data=None, key=None):
+        header = _tar_header(name, size, mtime)
+        self.segments.append((len(header), header, None))
+        self.segments.append((size, data, key))
+        if size % TAR_BLOCK:
+            self.segments.append((TAR_BLOCK - size % TAR_BLOCK, bytes(TAR_BLOCK - size % TAR_BLOCK), None))
+
+    def iter_range(self, start=0, end=None):
+        """Yield archive bytes [start, end] (inclusive); blobs are read in storage-sized chunks."""
+        end = self.size - 1 if end is None else end
+        offset = 0
+        for length, data, key in self.segments:
+            first, last = offset, offset + length - 1
+            offset += length
+            if not length or last < start:
+                continue
+            if first > end:
+                break
+            lo, hi = max(start, first) - first, min(end, last) - first
+            if data is not None:
+                yield data[lo:hi + 1]
+            else:
+                yield from self.storage.iter_range(key, lo, hi)
+
+# ============== HOT SEGMENT CACHE ==============
+# The leading segment (or all, under HOT_CACHE_WHOLE_FILE_MAX) of the most requested
+# blobs, held in memory so release-day spikes stay off the disk. Admission is TinyLFU
+# style: a count-min sketch tracks recent request frequency and a newcomer only evicts
+# LRU entries that are requested less often than it is. Admitted segments are read on a
+# small pool, so the request that tips a track over the threshold is not held up by it.
+
+_hot_load_executor = None
+_hot_load_executor_lock = threading.Lock()
+
+def _get_hot_load_executor():
+    global _hot_load_executor
+    with _hot_load_executor_lock:
+        if _hot_load_executor is None:
+            _hot_load_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='hot-cache')
+        return _hot_load_executor
+
+class FrequencySketch:
+    """Count-min sketch with small saturating counters, halved periodically so old popularity fades."""
+
+    def __init__(self, width=4096, depth=4, sample_size=None):
+        self.width = width
+        self.seeds = [i * 0x9E3779B1 + 1 for i in range(depth)]
+        self.rows = [bytearray(width) for _ in range(depth)]
+        self.sample_size = sample_size or width * 10
+        self.additions = 0
+
+    def _slots(self, key):
+        h = int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), 'little')
+        return [((h ^ seed) * 0x2545F4914F6CDD1D >> 17) % self.width for seed in self.seeds]
+
+    def increment(self, key):
+        for row, slot in zip(self.rows, self._slots(key)):
+            if row[slot] < 15:
+                row[slot] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            for row in self.rows:
+                for i, count in enumerate(row):
+                    row[i] = count >> 1
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[slot] for row, slot in zip(self.rows, self._slots(key)))
+
+class HotSegmentCache:
+    """Size-bounded LRU of blob prefixes with frequency-based admission."""
+
+    def __init__(self, max_bytes, segment_bytes, whole_file_max, min_frequency=3):
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        self.whole_file_max = whole_file_max
+        self.min_frequency = min_frequency
+        self.sketch = FrequencySketch()
+        self.entries = OrderedDict()  # key -> (data, total size); most recently used last
+        self.used = 0
+        self.counters = Counter()
+        self._loading = set()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Record a request for key and return (memoryview of the cached prefix, total size) or None."""
+        with self._lock:
+            self.sketch.increment(key)
+            entry = self.entries.get(key)
+            if entry is None:
+                self.counters['misses'] += 1
+                return None
+            self.entries.move_to_end(key)
+            self.counters['hits'] += 1
+            return memoryview(entry[0]), entry[1]
+
+    def count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def consider(self, storage, key):
+        """After a miss, schedule loading key's segment if it is frequent enough to earn the space."""
+        with self._lock:
+            frequency = self.sketch.estimate(key)
+            if frequency < self.min_frequency or key in self.entries or key in self._loading:
+                return False
+            self._loading.add(key)
+        try:
+            _get_hot_load_executor().submit(self.load, storage, key, frequency)
+        except Exception:
+            with self._lock:
+                self._loading.discard(key)
+            raise
+        return True
+
+    def load(self, storage, key, frequency):
+        """Read key's segment and admit it; returns whether it was admitted."""
+        try:
+            size = storage.size(key)
+            length = size if size <= self.whole_file_max else min(size, self.segment_bytes)
+            with self._lock:
+                fits = length <= self.max_bytes and self._make_room(length, frequency, evict=False)
+                if not fits:
+                    self.counters['rejected'] += 1
+            if not fits:
+                return False
+            data = b''.join(storage.iter_range(key, 0, length - 1)) if length else b''
+            with self._lock:
+                if not self._make_room(len(data), frequency, evict=True):
+                    self.counters['rejected'] += 1
+                    return False
+                self.entries[key] = (data, size)
+                self.used += len(data)
+                self.counters['admitted'] += 1
+            return True
+        except Exception as e:
+            logger.warning(f"Hot cache: loading {key} failed: {e}")
+            return False
+        finally:
+            with self._lock:
+                self._loading.discard(key)
+
+    def _make_room(self, length, frequency, evict):
+        # Called under self._lock. Victims come from the LRU end; any of them hotter than
+        # the newcomer vetoes admission
+        free, victims = self.max_bytes - self.used, []
+        for victim in self.entries:
+            if free >= length:
+                break
+            if self.sketch.estimate(victim) >= frequency:
+                return False
+            victims.append(victim)
+            free += len(self.entries[victim][0])
+        if free < length:
+            return False
+        if evict:
+            for victim in victims:
+                self.used -= len(self.entries.pop(victim)[0])
+                self.counters['evicted'] += 1
+        return True
+
+    def invalidate(self, key):
+        with self._lock:
+            entry = self.entries.pop(key, None)
+            if entry:
+                self.used -= len(entry[0])
+
+    def stats(self):
+        with self._lock:
+            lookups = self.counters['hits'] + self.counters['misses']
+            return {
+                **self.counters,
+                'entries': len(self.entries),
+                'bytes': self.used,
+                'max_bytes': self.max_bytes,
+                'hit_ratio': round(self.counters['hits'] / lookups, 4) if lookups else None
+            }
+
+def get_hot_cache():
+    """The app's hot segment cache, or None when HOT_CACHE_MAX_BYTES is 0."""
+    if 'hot_cache' not in current_app.extensions:
+        config = current_app.config
+        current_app.extensions['hot_cache'] = HotSegmentCache(
+            config['HOT_CACHE_MAX_BYTES'], config['HOT_CACHE_SEGMENT_BYTES'],
+            config['HOT_CACHE_WHOLE_FILE_MAX'], config['HOT_CACHE_MIN_FREQUENCY']
+        ) if config['HOT_CACHE_MAX_BYTES'] else None
+    return current_app.extensions['hot_cache']
+
+def _view_chunks(view, chunk_size):
+    # WSGI servers only accept bytes, so slices are copied here, one chunk at a time
+    for i in range(0, len(view), chunk_size):
+        yield bytes(view[i:i + chunk_size])
+
+def send_hot(hot, storage, key, mimetype):
+    """Serve a request from the hot cache; None means the caller should read from storage."""
+    cached = hot.lookup(key)
+    if cached is None:
+        hot.consider(storage, key)
+        return None
+    view, size = cached
+    start, stop, status = 0, size, 200
+    headers = {'Accept-Ranges': 'bytes', 'X-Hot-Cache': 'hit'}
+    if request.range and request.range.units == 'bytes':
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{size}'})
+        start, stop = byte_range
+        status = 206
+        headers['Content-Range'] = f'bytes {start}-{stop - 1}/{size}'
+    if start >= len(view) and stop > start:
+        hot.count('beyond_segment')
+        return None
+    headers['Content-Length'] = str(stop - start)
+    if len(view) >= stop:
+        # Whole response in memory: the unsliced object goes out as-is, no copy
+        body = [view.obj] if (start, stop) == (0, len(view.obj)) else _view_chunks(view[start:stop], storage.chunk_size)
+        return Response(body, status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+    def body():
+        yield from _view_chunks(view[start:], storage.chunk_size)
+        yield from storage.iter_range(key, len(view), stop - 1)
+    return Response(body(), status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+# ============== UPLOADS ==============
+def unique_blob_key(storage, filename):
+    filename = secure_filename(filename)
+    # Avoid overwriting: append timestamp if file exists
+    if storage.exists(filename):
+        name, ext = os.path.splitext(filename)
+        filename = f"{name}_{int(datetime.utcnow().timestamp())}{ext}"
+    return filename
+
+def create_uploaded_track(user_id, filename, form):
+    """Create the Track (plus artist/album if new) for a stored file; form holds title, artist_name, album_title, duration."""
+    # Read form fields
+    title = (form.get('title') or filename).strip()
+    artist_name = (form.get('artist_name') or '').strip() or None
+    album_title = (form.get('album_title') or '').strip() or None
+    duration_str = (form.get('duration') or '').strip() or None
+
+    # Find or create artist
+    artist_id = None
+    if artist_name:
+        artist = Artist.query.filter(func.lower(Artist.name) == artist_name.lower()).first()
+        if not artist:
+            artist = Artist(name=artist_name)
+            db.session.add(artist)
+            db.session.flush()
+        artist_id = artist.artist_id
+
+    # Find or create album
+    album_id = None
+    album_created = False
+    if album_title:
+        # If we have an artist, try to associate
+        alb_query = Album.query.filter(Album.title == album_title)
+        if artist_id:
+            alb_query = alb_query.filter(Album.artist_id == artist_id)
+        album = alb_query.first()
+        if not album:
+            album = Album(title=album_title, artist_id=artist_id)
+            db.session.add(album)
+            db.session.flush()
+            album_created = True
+        album_id = album.album_id
+
+    # Parse duration string into time (if provided)
+    duration_val = None
+    if duration_str:
+        try:
+            dt = datetime.strptime(duration_str, '%H:%M:%S')
+            duration_val = dt.time()
+        except Exception:
+            try:
+                # Try mm:ss
+                dt = datetime.strptime(duration_str, '%M:%S')
+                duration_val = dt.time()
+            except Exception:
+                duration_val = None
+
+    # Create Track entry
+    # Ensure DB has the FilePath column (best-effort): if commit fails due to missing column, try to add it and retry
+    new_track = Track(
+        title=title,
+        artist_id=artist_id,
+        album_id=album_id,
+        duration=duration_val,
+        release_date=date.today(),
+        file_path=filename
+    )
+    db.session.add(new_track)
+    try:
+        db.session.flush()
+        on_track_uploaded(new_track, album_created)
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.warning(f"Upload commit failed, attempting to add FilePath column: {e}")
+        try:
+            # Try to add column to Track table (MySQL)
+            db.engine.execute("ALTER TABLE `Track` ADD COLUMN `FilePath` VARCHAR(255) NULL")
+        except Exception as e2:
+            logger.error(f"Failed to add FilePath column: {e2}")
+        # retry
+        db.session.add(new_track)
+        db.session.commit()
+
+    get_section_cache().invalidate('home:')
+    get_event_bus().publish('catalog', 'track.created', new_track.to_dict())
+    logger.info(f"✅ Track created: {new_track.track_id} - {title} (uploaded by user {user_id})")
+    return new_track
+
+# ============== RESUMABLE UPLOADS ==============
+# tus-style protocol: create a session, PUT chunks (any order, each with an optional
+# Upload-Checksum), then complete to assemble the file into storage and create the Track.
+# Chunks are staged as <index>.part files under UPLOAD_STAGING_FOLDER/<upload_id>; the
+# folder must be shared (or the load balancer sticky) when running several nodes.
+# Expired sessions are removed by `flask gc-uploads`, run from cron, not by requests.
+CHECKSUM_ALGORITHMS = ('sha256', 'sha1', 'md5')
+
+class UploadError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def parse_checksum(value):
+    """Parse '<algorithm> <digest>' (base64 as in tus, or hex) into (algorithm, digest bytes)."""
+    try:
+        algorithm, encoded = value.strip().split(' ', 1)
+    except ValueError:
+        raise UploadError('Checksum must be "<algorithm> <digest>"')
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise UploadError(f"Unsupported checksum algorithm: {algorithm}")
+    size = hashlib.new(algorithm).digest_size
+    for decode in (bytes.fromhex, base64.b64decode):
+        try:
+            digest = decode(encoded.strip())
+        except (ValueError, binascii.Error):
+            continue
+        if len(digest) == size:
+            return algorithm, digest
+    raise UploadError('Checksum digest is not valid hex or base64')
+
+def staging_dir(upload_id):
+    return os.path.join(current_app.config['UPLOAD_STAGING_FOLDER'], upload_id)
+
+def received_chunks(upload):
+    folder = staging_dir(upload.upload_id)
+    if not os.path.isdir(folder):
+        return []
+    return sorted(int(name[:-5]) for name in os.listdir(folder) if name.endswith('.part') and name[:-5].isdigit())
+
+def write_chunk(upload, index, stream, checksum=None):
+    """Stage one chunk; re-sending a chunk simply replaces it."""
+    if index < 0 or index >= upload.total_chunks():
+        raise UploadError(f"Chunk index out of range (0-{upload.total_chunks() - 1})")
+    expected = upload.expected_chunk_length(index)
+    algorithm, digest = parse_checksum(checksum) if checksum else (None, None)
+    hasher = hashlib.new(algorithm) if algorithm else None
+
+    folder = staging_dir(upload.upload_id)
+    os.makedirs(folder, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=folder, prefix='.chunk-')
+    written = 0
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                data = stream.read(min(256 * 1024, expected - written + 1))
+                if not data:
+                    break
+                written += len(data)
+                if written > expected:
+                    raise UploadError(f"Chunk {index} is larger than {expected} bytes")
+                if hasher:
+                    hasher.update(data)
+                out.write(data)
+        if written != expected:
+            raise UploadError(f"Chunk {index} must be {expected} bytes, got {written}")
+        if hasher and hasher.digest() != digest:
+            raise UploadError(f"Checksum mismatch for chunk {index}", status=460)
+        os.replace(tmp_path, os.path.join(folder, f"{index}.part"))
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+    return written
+
+def _read_parts(upload, hasher=None):
+    folder = staging_dir(upload.upload_id)
+    for index in range(upload.total_chunks()):
+        with open(os.path.join(folder, f"{index}.part"), 'rb') as f:
+            while True:
+                data = f.read(256 * 1024)
+                if not data:
+                    break
+                if hasher:
+                    hasher.update(data)
+                yield data
+
+def assemble_upload(upload, storage):
+    """Concatenate the staged chunks into storage; returns the blob key."""
+    missing = set(range(upload.total_chunks())) - set(received_chunks(upload))
+    if missing:
+        raise UploadError(f"Missing chunks: {sorted(missing)[:20]}", status=409)
+    algorithm, digest = parse_checksum(upload.checksum) if upload.checksum else (None, None)
+    hasher = hashlib.new(algorithm) if algorithm else None
+
+    key = unique_blob_key(storage, upload.filename)
+    storage.save(key, _IterStream(_read_parts(upload, hasher)), mimetypes.guess_type(key)[0])
+    if hasher and hasher.digest() != digest:
+        storage.delete(key)
+        raise UploadError('Checksum mismatch for assembled file', status=460)
+    return key
+
+def lock_upload_session(upload):
+    """Hold the session's row until this transaction ends; False if it is gone by then.
+
+    An UPDATE takes the row lock on MySQL and the write lock on SQLite, so a concurrent
+    /complete waits here and then finds the session already deleted.
+    """
+    claimed = db.session.query(UploadSession).filter(UploadSession.upload_id == upload.upload_id).update(
+        {UploadSession.expires_at: datetime.utcnow() + current_app.config['UPLOAD_SESSION_TTL']},
+        synchronize_session=False
+    )
+    if claimed:
+        db.session.refresh(upload)
+    return bool(claimed)
+
+def discard_upload(upload):
+    shutil.rmtree(staging_dir(upload.upload_id), ignore_errors=True)
+    db.session.delete(upload)
+
+def gc_expired_uploads():
+    """Remove expired sessions and any staging folders no session owns; returns sessions removed."""
+    expired = UploadSession.query.filter(UploadSession.expires_at < datetime.utcnow()).all()
+    for upload in expired:
+        discard_upload(upload)
+    db.session.commit()
+
+    root = current_app.config['UPLOAD_STAGING_FOLDER']
+    if os.path.isdir(root):
+        live = {uid for (uid,) in db.session.query(UploadSession.upload_id)}
+        cutoff = datetime.utcnow().timestamp() - current_app.config['UPLOAD_SESSION_TTL'].total_seconds()
+        for name in os.listdir(root):
+            path = os.path.join(root, name)
+            if name not in live and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+    if expired:
+        logger.info(f"🗑️ Removed {len(expired)} expired upload sessions")
+    return len(expired)
+
+# ============== SEEK INDEX ==============
+# Time -> byte lookup for VBR MP3 and FLAC. On upload each file is walked once and every
+# SEEK_INDEX_INTERVAL_MS a (ms, frame offset) point is kept. `?t=` on stream_track bisects
+# that table, then walks at most one interval of frames to land on the exact frame.
+SEEKABLE_FORMATS = {'.mp3': 'mp3', '.flac': 'flac'}
+
+MP3_BITRATES = {
+    (True, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+FLAC_BLOCK_SIZES = {1: 192, 2: 576, 3: 1152, 4: 2304, 5: 4608, 8: 256, 9: 512, 10: 1024, 11: 2048,
+                    12: 4096, 13: 8192, 14: 16384, 15: 32768}
+
+def _crc8_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x07) & 0xFF if crc & 0x80 else (crc << 1) & 0xFF
+        table.append(crc)
+    return table
+
+CRC8_TABLE = _crc8_table()
+
+class _ChunkReader:
+    """Forward-only buffered view over an iterator of byte chunks, tracking absolute offsets."""
+
+    def __init__(self, chunks, offset=0):
+        self._chunks = iter(chunks)
+        self.buf = bytearray()
+        self.pos = 0
+        self.base = offset
+
+    @property
+    def offset(self):
+        return self.base + self.pos
+
+    def ensure(self, n):
+        while len(self.buf) - self.pos < n:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return False
+            if self.pos >= 1 << 20:
+                drop = min(self.pos, len(self.buf))
+                del self.buf[:drop]
+                self.base += drop
+                self.pos -= drop
+            self.buf += chunk
+        return True
+
+    def peek(self, n):
+        return self.buf[self.pos:self.pos + n] if self.ensure(n) else None
+
+    def skip(self, n):
+        self.pos += n
+
+    def find(self, needle_first, start_delta=1):
+        # Advance to the next occurrence of needle_first; False at end of stream
+        self.pos += start_delta
+        while True:
+            idx = self.buf.find(needle_first, self.pos)
+            if idx >= 0:
+                self.pos = idx
+                return True
+            self.pos = len(self.buf)
+            if not self.ensure(1):
+                return False
+
+def _mp3_header(h):
+    """Return (frame_length, samples, sample_rate) for a 4-byte MPEG audio header, or None."""
+    if h[0] != 0xFF or (h[1] & 0xE0) != 0xE0:
+        return None
+    version, layer_bits = (h[1] >> 3) & 3, (h[1] >> 1) & 3
+    bitrate_idx, rate_idx, padding = h[2] >> 4, (h[2] >> 2) & 3, (h[2] >> 1) & 1
+    if version == 1 or layer_bits == 0 or bitrate_idx in (0, 15) or rate_idx == 3:
+        return None
+    layer, mpeg1 = 4 - layer_bits, version == 3
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_idx] * 1000
+    sample_rate = MP3_SAMPLE_RATES[version][rate_idx]
+    if layer == 1:
+        return (12 * bitrate // sample_rate + padding) * 4, 384, sample_rate
+    samples = 1152 if (layer == 2 or mpeg1) else 576
+    return samples // 8 * bitrate // sample_rate + padding, samples, sample_rate
+
+def mp3_frames(chunks, offset=0, start_ms=0):
+    """Yield (ms, byte offset) for each MPEG audio frame; skips ID3v2 tags and resyncs on garbage."""
+    reader = _ChunkReader(chunks, offset)
+    head = reader.peek(10)
+    if head is not None and head[:3] == b'ID3':
+        size = (head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9]
+        reader.skip(10 + size + (10 if head[5] & 0x10 else 0))
+    seconds, synced, first = start_ms / 1000.0, False, offset == 0
+    while True:
+        h = reader.peek(4)
+        if h is None:
+            return
+        frame = _mp3_header(h)
+        if frame and not synced:
+            # Off-sync: only trust a header whose successor is also a header (or EOF)
+            nxt = reader.peek(frame[0] + 4)
+            synced = nxt is None or _mp3_header(nxt[frame[0]:frame[0] + 4]) is not None
+        if not frame or not synced:
+            synced = False
+            if not reader.find(0xFF):
+                return
+            continue
+        length, samples, sample_rate = frame
+        if first:
+            first = False
+            # A Xing/Info frame carries VBR metadata, not audio
+            body = reader.peek(min(length, 64)) or b''
+            if b'Xing' in body or b'Info' in body:
+                reader.skip(length)
+                continue
+        yield int(seconds * 1000), reader.offset
+        seconds += samples / sample_rate
+        reader.skip(length)
+
+def _flac_utf8_number(data, i):
+    first = data[i]
+    if first < 0x80:
+        return first, i + 1
+    extra = next((n for n in range(1, 7) if first & (0x80 >> (n + 1)) == 0 and first & (0x80 >> n)), None)
+    if extra is None:
+        return None, i
+    value = first & (0x3F >> extra)
+    for j in range(1, extra + 1):
+        byte = data[i + j]
+        if byte & 0xC0 != 0x80:
+            return None, i
+        value = (value << 6) | (byte & 0x3F)
+    return value, i + extra + 1
+
+def _flac_frame_sample(h, block_size):
+    """Return the first sample number of the frame whose header starts h, or None if h is not a valid header."""
+    if h[0] != 0xFF or h[1] not in (0xF8, 0xF9) or h[2] >> 4 == 0 or h[2] & 0x0F == 0x0F:
+        return None
+    if h[3] >> 4 >= 11 or (h[3] >> 1) & 7 in (3, 7) or h[3] & 1:
+        return None
+    number, i = _flac_utf8_number(h, 4)
+    if number is None:
+        return None
+    i += {6: 1, 7: 2}.get(h[2] >> 4, 0)
+    i += {12: 1, 13: 2, 14: 2}.get(h[2] & 0x0F, 0)
+    crc = 0
+    for byte in h[:i]:
+        crc = CRC8_TABLE[crc ^ byte]
+    if crc != h[i]:
+        return None
+    return number if h[1] & 1 else number * block_size
+
+def read_flac_metadata(storage, key, head_bytes=64 * 1024):
+    """Parse the FLAC header: returns (streaminfo dict, seek points [(sample, offset)], audio offset).
+
+    Walks the metadata block headers up to the audio, fetching only STREAMINFO and
+    SEEKTABLE; other blocks (cover art can run to megabytes) are stepped over unread.
+    """
+    head = b''.join(storage.iter_range(key, 0, head_bytes - 1))
+
+    def read(start, length):
+        if start + length <= len(head):
+            return head[start:start + length]
+        return b''.join(storage.iter_range(key, start, start + length - 1)) if length else b''
+
+    if head[:4] != b'fLaC':
+        raise ValueError('Not a FLAC stream')
+    offset, info, seekpoints = 4, None, []
+    while True:
+        header = read(offset, 4)
+        if len(header) < 4:
+            raise ValueError('Truncated FLAC metadata')
+        last, block_type = header[0] & 0x80, header[0] & 0x7F
+        length = int.from_bytes(header[1:4], 'big')
+        offset += 4
+        if block_type in (0, 3):
+            block = read(offset, length)
+            if len(block) < length:
+                raise ValueError('Truncated FLAC metadata')
+            if block_type == 0:
+                packed = int.from_bytes(block[10:18], 'big')
+                info = {
+                    'min_block': int.from_bytes(block[0:2], 'big'),
+                    'max_block': int.from_bytes(block[2:4], 'big'),
+                    'min_frame': int.from_bytes(block[4:7], 'big'),
+                    'sample_rate': packed >> 44,
+                    'total_samples': packed & ((1 << 36) - 1)
+                }
+            else:
+                for sample, point_offset, _ in struct.iter_unpack('>QQH', bytes(block[:length - length % 18])):
+                    if sample != 0xFFFFFFFFFFFFFFFF:
+                        seekpoints.append((sample, point_offset))
+        offset += length
+        if last:
+            break
+    if not info or not info['sample_rate']:
+        raise ValueError('FLAC stream has no STREAMINFO')
+    return info, seekpoints, offset
+
+def flac_frames(chunks, offset, sample_rate, block_size, min_frame=0):
+    """Yield (ms, byte offset) for each FLAC frame found by sync code + header CRC-8."""
+    reader = _ChunkReader(chunks, offset)
+    while True:
+        h = reader.peek(16)
+        if h is None:
+            h = reader.buf[reader.pos:]
+            if len(h) < 6:
+                return
+        sample = _flac_frame_sample(h, block_size) if len(h) >= 6 else None
+        if sample is not None:
+            yield sample * 1000 // sample_rate, reader.offset
+            if not reader.find(0xFF, max(min_frame, 2)):
+                return
+        elif not reader.find(0xFF):
+            return
+
+def sample_points(frames, interval_ms):
+    points, next_ms, last_ms = [], 0, 0
+    for ms, offset in frames:
+        if ms >= next_ms:
+            points.append((ms, offset))
+            next_ms = ms + interval_ms
+        last_ms = ms
+    return points, last_ms
+
+def build_seek_index(track_id, storage, key, interval_ms):
+    """Walk a stored MP3/FLAC file once and store its seek table; returns the row or None."""
+    fmt = SEEKABLE_FORMATS.get(os.path.splitext(key)[1].lower())
+    if not fmt:
+        return None
+    started = perf_counter()
+    index = TrackSeekIndex(track_id=track_id, format=fmt, interval_ms=interval_ms, header_bytes=0)
+    if fmt == 'mp3':
+        points, index.duration_ms = sample_points(mp3_frames(storage.iter_range(key)), interval_ms)
+    else:
+        info, seekpoints, audio_offset = read_flac_metadata(storage, key)
+        index.header_bytes, index.sample_rate, index.block_size = audio_offset, info['sample_rate'], info['max_block']
+        index.duration_ms = info['total_samples'] * 1000 // info['sample_rate']
+        if len(seekpoints) > 1:
+            # An encoder SEEKTABLE already has what we need, no need to read the audio
+            points = [(sample * 1000 // info['sample_rate'], audio_offset + off) for sample, off in seekpoints]
+        else:
+            frames = flac_frames(storage.iter_range(key, audio_offset), audio_offset,
+                                 info['sample_rate'], info['max_block'], info['min_frame'])
+            points, _ = sample_points(frames, interval_ms)
+    if not points:
+        logger.warning(f"No audio frames found for track {track_id} ({key})")
+        return None
+    index.points = b''.join(struct.pack('<IQ', ms, off) for ms, off in points)
+    existing = db.session.get(TrackSeekIndex, track_id)
+    if existing:
+        db.session.delete(existing)
+        db.session.flush()
+    db.session.add(index)
+    logger.info(f"✅ Seek index for track {track_id}: {len(points)} points in {(perf_counter() - started) * 1000:.0f}ms")
+    return index
+
+def schedule_seek_index(app, track_id, key):
+    """Build the seek table after upload, in the background unless SEEK_INDEX_ASYNC is off."""
+    def run():
+        with app.app_context():
+            try:
+                build_seek_index(track_id, get_storage(), key, app.config['SEEK_INDEX_INTERVAL_MS'])
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Seek index failed for track {track_id}: {e}")
+    if app.config['SEEK_INDEX_ASYNC']:
+        threading.Thread(target=run, name='seek-index', daemon=True).start()
+    else:
+        run()
+
+def seek_offset(index, storage, key, target_ms):
+    """Return (ms, byte offset) of the last frame starting at or before target_ms."""
+    points = index.unpack_points()
+    i = max(0, bisect.bisect_right([ms for ms, _ in points], target_ms) - 1)
+    best = points[i]
+    # Refine inside one interval; the window is generous for 320 kbps MP3 and 24-bit FLAC
+    window_end = points[i + 1][1] if i + 1 < len(points) else None
+    chunks = storage.iter_range(key, best[1], window_end)
+    if index.format == 'mp3':
+        frames = mp3_frames(chunks, best[1], best[0])
+    else:
+        frames = flac_frames(chunks, best[1], index.sample_rate, index.block_size)
+    for ms, offset in frames:
+        if ms > target_ms:
+            break
+        best = (ms, offset)
+    return best
+
+def send_from_time(storage, key, track_id, seconds):
+    """Serve a track starting at the frame boundary for `seconds` (FLAC gets its header replayed first).
+
+    The body is header + file[offset:]; Range requests address that body, so an interrupted
+    seek resumes like any other download. Its ETag changes if the seek lands elsewhere.
+    """
+    index = db.session.get(TrackSeekIndex, track_id)
+    if index is None:
+        index = build_seek_index(track_id, storage, key, current_app.config['SEEK_INDEX_INTERVAL_MS'])
+        if index is None:
+            return jsonify({'error': 'Time seeking is only supported for MP3 and FLAC files'}), 400
+        db.session.commit()
+    ms, offset = seek_offset(index, storage, key, int(seconds * 1000))
+    header = index.header_bytes
+    length = header + storage.size(key) - offset
+    etag = hashlib.sha1(f'{key}:{header}:{offset}:{length}'.encode()).hexdigest()[:20]
+
+    headers = {
+        'Accept-Ranges': 'bytes',
+        'ETag': f'"{etag}"',
+        'X-Seek-Time-Ms': str(ms),
+        'X-Seek-Offset': str(offset)
+    }
+    start, end, status = 0, length - 1, 200
+    if_range = request.if_range
+    if request.range and request.range.units == 'bytes' and (
+            not (if_range.etag or if_range.date) or if_range.etag == etag):
+        byte_range = request.range.range_for_length(length)
+        if byte_range is None:
+            return Response(status=416, headers={'Content-Range': f'bytes */{length}'})
+        start, end, status = byte_range[0], byte_range[1] - 1, 206
+        headers['Content-Range'] = f'bytes {start}-{end}/{length}'
+    headers['Content-Length'] = str(end - start + 1)
+
+    def body():
+        if start < header:
+            yield from storage.iter_range(key, start, min(end, header - 1))
+        if end >= header:
+            yield from storage.iter_range(key, offset + max(start - header, 0), offset + end - header)
+
+    mimetype = mimetypes.guess_type(key)[0] or 'application/octet-stream'
+    return Response(body(), status=status, mimetype=mimetype, headers=headers, direct_passthrough=True)
+
+# ============== FINGERPRINTS ==============
+# Re-encoded copies of one song have different bytes but the same spectral peaks.
+# fingerprint.py turns a file into peak-pair hashes; those run in a process pool
+# (spawned, so workers import only fingerprint.py) because the FFTs hold the GIL.
+# FingerprintHash is the inverted index, keyed by hash: a duplicate check looks up an
+# evenly spaced sample of a track's hashes and counts, per other track, how many of
+# them line up at one time offset. Uploads are fingerprinted in the background;
+# `flask fingerprint-tracks` backfills the existing catalogue.
+_fingerprint_pool = None
+_fingerprint_pool_lock = threading.Lock()
+
+def _get_fingerprint_pool(workers):
+    global _fingerprint_pool
+    with _fingerprint_pool_lock:
+        if _fingerprint_pool is None:
+            _fingerprint_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'))
+        return _fingerprint_pool
+
+@contextmanager
+def local_audio_copy(storage, key):
+    """A filesystem path for a stored blob; remote blobs are copied to a temp file for the block."""
+    path = storage.local_path(key)
+    if path:
+        yield path
+        return
+    fd, tmp_path = tempfile.mkstemp(prefix='fingerprint-', suffix=os.path.splitext(key)[1])
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in storage.iter_range(key):
+                out.write(chunk)
+        yield tmp_path
+    finally:
+        os.unlink(tmp_path)
+
+def store_fingerprint(track_id, hashes, anchors, duration_ms):
+    FingerprintHash.query.filter_by(track_id=track_id).delete(synchronize_session=False)
+    TrackFingerprint.query.filter_by(track_id=track_id).delete(synchronize_session=False)
+    if hashes:
+        db.session.execute(
+            insert(FingerprintHash.__table__),
+            [{'Hash': h, 'TrackID': track_id, 'Frame': frame} for h, frame in zip(hashes, anchors)]
+        )
+    db.session.add(TrackFingerprint(track_id=track_id, hash_count=len(hashes), duration_ms=duration_ms))
+
+def duplicate_candidates(track_id, pairs=None):
+    """[(other track id, aligned matches, share of sampled hashes)] for tracks that look like track_id."""
+    config = current_app.config
+    if pairs is None:
+        pairs = db.session.execute(
+            select(FingerprintHash.hash, FingerprintHash.frame).where(FingerprintHash.track_id == track_id)
+        ).all()
+    if not pairs:
+        return []
+    pairs = sorted(pairs, key=lambda pair: pair[1])
+    sample = pairs[::max(1, len(pairs) // config['FINGERPRINT_QUERY_HASHES'])][:config['FINGERPRINT_QUERY_HASHES']]
+    query = {}
+    for h, frame in sample:
+        query.setdefault(h, []).append(frame)
+    hashes = list(query)
+    rows = []
+    for i in range(0, len(hashes), 500):
+        rows.extend(db.session.execute(
+            select(FingerprintHash.track_id, FingerprintHash.hash, FingerprintHash.frame)
+            .where(FingerprintHash.hash.in_(hashes[i:i + 500]), FingerprintHash.track_id != track_id)
+        ))
+    scores = fingerprint.best_alignment(query, rows)
+    candidates = [(other, n, round(n / len(sample), 3)) for other, n in scores.items() if n >= config['FINGERPRINT_MIN_MATCHES']]
+    return sorted(candidates, key=lambda c: -c[1])
+
+def fingerprint_track(track_id, key):
+    """Fingerprint a stored track in the pool, index it and return its duplicate candidates. Commits."""
+    config = current_app.config
+    with local_audio_copy(get_storage(), key) as path:
+        future = _get_fingerprint_pool(config['FINGERPRINT_WORKERS']).submit(
+            fingerprint.fingerprint_file, path, config['FFMPEG_BINARY']
+        )
+        hashes, anchors, duration_ms = future.result()
+    store_fingerprint(track_id, hashes, anchors, duration_ms)
+    db.session.commit()
+    return duplicate_candidates(track_id, list(zip(hashes, anchors)))
+
+def schedule_fingerprint(app, track_id, key):
+    """Fingerprint an upload in the background and log it when it matches existing tracks."""
+    if not app.config['FINGERPRINT_ON_UPLOAD'] or not fingerprint.available():
+        return
+    def run():
+        with app.app_context():
+            try:
+                candidates = fingerprint_track(track_id, key)
+                if candidates:
+                    logger.warning(f"Track {track_id} looks like a duplicate of track(s) {[c[0] for c in candidates[:5]]}")
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Fingerprint failed for track {track_id}: {e}")
+    threading.Thread(target=run, name='fingerprint', daemon=True).start()
+
+# ============== PREFETCH ==============
+# When a stream is opened with ?playlist=<id> or ?queue=<ids>, the next few entries get
+# Link: rel=preload hints and their first segment is pulled into the OS page cache in
+# the background, so the following track starts without a cold disk read.
+
+_prefetch_executor = None
+_prefetch_executor_lock = threading.Lock()
+prefetch_recent = TTLCache(ttl=300, max_entries=4096)  # keys warmed lately; page cache keeps them a while
+
+def _get_prefetch_executor():
+    global _prefetch_executor
+    with _prefetch_executor_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prefetch')
+        return _prefetch_executor
+
+def parse_queue(value):
+    """Track ids from a comma separated ?queue= value; junk entries are skipped."""
+    return [int(part) for part in (value or '').split(',') if part.strip().isdigit()]
+
+def upcoming_tracks(track_id, limit, playlist_id=None, queue_ids=None):
+    """(track_id, file_path) of the entries after track_id in a client queue or a playlist."""
+    if limit <= 0:
+        return []
+    if queue_ids:
+        after = queue_ids[queue_ids.index(track_id) + 1:] if track_id in queue_ids else queue_ids
+        ids = [tid for tid in after if tid != track_id][:limit]
+        paths = dict(db.session.query(Track.track_id, Track.file_path).filter(Track.track_id.in_(ids)).all()) if ids else {}
+        return [(tid, paths[tid]) for tid in ids if tid in paths]
+    playlist = db.session.get(Playlist, playlist_id) if playlist_id is not None else None
+    if playlist is None:
+        return []
+    # Entries come from the owner's shard, file paths from the main database
+    bind = playlist_shard(playlist)
+    current = shard_execute(bind, select(TrackPlaylist.order_num).where(
+        TrackPlaylist.playlist_id == playlist_id, TrackPlaylist.track_id == track_id
+    )).scalar()
+    stmt = select(TrackPlaylist.track_id).where(TrackPlaylist.playlist_id == playlist_id, TrackPlaylist.track_id != track_id)
+    if current is not None:
+        stmt = stmt.where(
+            (TrackPlaylist.order_num > current)
+            | ((TrackPlaylist.order_num == current) & (TrackPlaylist.track_id > track_id))
+        )
+    ids = shard_execute(bind, stmt.order_by(TrackPlaylist.order_num, TrackPlaylist.track_id).limit(limit)).scalars().all()
+    paths = dict(db.session.query(Track.track_id, Track.file_path).filter(Track.track_id.in_(ids)).all()) if ids else {}
+    return [(tid, paths[tid]) for tid in ids if tid in paths]
+
+def preload_link_header(upcoming, playlist_id=None, queue_ids=None):
+    """Link header value hinting the upcoming streams, carrying the same context forward."""
+    if playlist_id is not None:
+        context = f'?playlist={playlist_id}'
+    elif queue_ids:
+        context = '?queue=' + ','.join(map(str, queue_ids))
+    else:
+        context = ''
+    return ', '.join(f'</api/tracks/{tid}/stream{context}>; rel=preload; as=audio' for tid, _ in upcoming)
+
+def warm_blob(storage, key, nbytes):
+    """Pull the first nbytes of a blob into the OS page cache (or the local storage cache)."""
+    # For CachedStorage a miss starts the background copy, which is the remote warmup
+    path = storage.local_path(key)
+    if not path:
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, nbytes, os.POSIX_FADV_WILLNEED)
+        else:
+            remaining = nbytes  # no fadvise (macOS, Windows): a plain read does the readahead
+            while remaining > 0 and os.read(fd, min(remaining, 256 * 1024)):
+                remaining -= 256 * 1024
+    finally:
+        os.close(fd)
+    return True
+
+def schedule_prefetch(storage, keys, nbytes):
+    """Warm keys not warmed recently, off the request thread."""
+    def run(key):
+        try:
+            warm_blob(storage, key, nbytes)
+        except Exception as e:
+            logger.warning(f"Prefetch failed for {key}: {e}")
+    for key in keys:
+        if key and prefetch_recent.get(key) is None:
+            prefetch_recent.set(key, True)
+            _get_prefetch_executor().submit(run, key)
+
+# ============== ENTITLEMENTS ==============
+# The plan → feature matrix (SubscriptionPlan, PlanFeature, PremiumFeature) changes with
+# the catalogue of plans, not per request. Each worker keeps it as an immutable
+# Entitlements snapshot, reloaded every ENTITLEMENTS_RELOAD seconds. Access tokens carry
+# the user's plan id and feature bitmask (bit n is PremiumFeatureID n) as claims, so
+# gated routes decide from the token alone. A token minted against an older snapshot
+# gets its mask recomputed from the plan id in memory. Plans are changed by billing or
+# support through change_user_plan (`flask set-plan`), never by the user, and recorded
+# in PlanChange. Each worker also keeps the plan changes younger than
+# JWT_ACCESS_TOKEN_EXPIRES, reloaded every PLAN_CHANGES_RELOAD seconds; a token whose
+# plan claim differs from its user's latest change is stale. Gated routes answer it with
+# 401 and "refresh": true, and the client re-mints with POST /api/auth/refresh, so a
+# downgraded user loses the old features within PLAN_CHANGES_RELOAD seconds.
+FEATURE_AD_FREE = 'Ad-free listening'
+FEATURE_OFFLINE_DOWNLOADS = 'Offline downloads'
+FEATURE_HIGH_QUALITY = 'High-quality audio'
+
+class Entitlements:
+    """Immutable snapshot of which features each plan includes."""
+
+    def __init__(self, plans, features, plan_features):
+        # plans {plan id: name}, features {feature id: name}, plan_features [(plan id, feature id)]
+        masks = dict.fromkeys(plans, 0)
+        for plan_id, feature_id in plan_features:
+            masks[plan_id] = masks.get(plan_id, 0) | (1 << feature_id)
+        self.plan_names = MappingProxyType({plan_id: (name or 'free').lower() for plan_id, name in plans.items()})
+        self.masks = MappingProxyType(masks)
+        self.features = MappingProxyType({name.lower(): 1 << feature_id for feature_id, name in features.items()})
+        matrix = json.dumps([sorted(plans.items()), sorted(features.items()), sorted(plan_features)])
+        self.version = hashlib.sha1(matrix.encode()).hexdigest()[:8]
+        self.loaded_at = perf_counter()
+
+    def claims(self, plan_id):
+        return {'plan': plan_id, 'feat': self.masks.get(plan_id, 0), 'ent': self.version}
+
+    def allows(self, mask, feature):
+        bit = self.features.get(feature.lower(), 0)
+        return bool(mask & bit)
+
+    def feature_names(self, mask):
+        return sorted(name for name, bit in self.features.items() if mask & bit)
+
+def load_entitlements():
+    plans = dict(db.session.query(SubscriptionPlan.subscription_plan_id, SubscriptionPlan.name).all())
+    features = dict(db.session.query(PremiumFeature.premium_feature_id, PremiumFeature.name).all())
+    plan_features = [tuple(row) for row in db.session.query(PlanFeature.subscription_plan_id, PlanFeature.premium_feature_id)]
+    return Entitlements(plans, features, plan_features)
+
+_entitlements_lock = threading.Lock()
+
+def get_entitlements():
+    snapshot = current_app.extensions.get('entitlements')
+    if snapshot is None or perf_counter() - snapshot.loaded_at > current_app.config['ENTITLEMENTS_RELOAD']:
+        with _entitlements_lock:
+            snapshot = current_app.extensions.get('entitlements')
+            if snapshot is None or perf_counter() - snapshot.loaded_at > current_app.config['ENTITLEMENTS_RELOAD']:
+                try:
+                    snapshot = current_app.extensions['entitlements'] = load_entitlements()
+                except Exception as e:
+                    if snapshot is None:
+                        raise
+                    logger.warning(f"Entitlements reload failed, keeping version {snapshot.version}: {e}")
+    return snapshot
+
+class PlanChanges:
+    """Immutable snapshot of {user id: plan id} for recent plan changes."""
+
+    def __init__(self, plans):
+        self.plans = MappingProxyType(plans)
+        self.loaded_at = perf_counter()
+
+def load_plan_changes():
+    # Older tokens have expired, so older changes cannot make one stale
+    since = datetime.utcnow() - current_app.config['JWT_ACCESS_TOKEN_EXPIRES']
+    return PlanChanges(dict(
+        db.session.query(PlanChange.user_id, PlanChange.plan_id).filter(PlanChange.changed_at >= since).all()
+    ))
+
+_plan_changes_lock = threading.Lock()
+
+def get_plan_changes():
+    snapshot = current_app.extensions.get('plan_changes')
+    if snapshot is None or perf_counter() - snapshot.loaded_at > current_app.config['PLAN_CHANGES_RELOAD']:
+        with _plan_changes_lock:
+            snapshot = current_app.extensions.get('plan_changes')
+            if snapshot is None or perf_counter() - snapshot.loaded_at > current_app.config['PLAN_CHANGES_RELOAD']:
+                try:
+                    snapshot = current_app.extensions['plan_changes'] = load_plan_changes()
+                except Exception as e:
+                    if snapshot is None:
+                        raise
+                    logger.warning(f"Plan changes reload failed, keeping the last snapshot: {e}")
+    return snapshot
+
+class StaleTokenError(Exception):
+    """The token claims a plan the user has since left; plan_id is the current one."""
+
+    def __init__(self, plan_id):
+        super().__init__('Your plan has changed; refresh your token')
+        self.plan_id = plan_id
+
+def stale_token_response(e):
+    return jsonify({'error': str(e), 'refresh': True}), 401
+
+def issue_token(user):
+    """Access token for user with its plan and feature mask embedded as claims."""
+    claims = get_entitlements().claims(user.subscription_plan_id)
+    return create_access_token(identity=str(user.user_id), additional_claims=claims)
+
+def change_user_plan(user, plan_id):
+    """Move user to plan_id and return a token carrying the new plan; the caller commits."""
+    if plan_id not in get_entitlements().plan_names:
+        raise ValueError(f"Unknown subscription plan {plan_id}")
+    user.subscription_plan_id = plan_id
+    db.session.merge(PlanChange(user_id=user.user_id, plan_id=plan_id, changed_at=datetime.utcnow()))
+    legacy_plan_cache.invalidate(str(user.user_id))
+    # This worker reloads on its next request; the others within PLAN_CHANGES_RELOAD
+    current_app.extensions.pop('plan_changes', None)
+    return issue_token(user)
+
+legacy_plan_cache = TTLCache(ttl=60, max_entries=100000)
+
+def token_entitlements():
+    """(plan id, feature mask) for the request's verified token; (None, 0) when anonymous.
+
+    Raises StaleTokenError when the user's plan changed after the token was minted.
+    """
+    claims = get_jwt()
+    if not claims.get('sub'):
+        return None, 0
+    if 'plan' in claims:
+        plan_id = claims['plan']
+        current = get_plan_changes().plans.get(int(claims['sub']), plan_id)
+        if current != plan_id:
+            raise StaleTokenError(current)
+    else:
+        # Token minted before plans were embedded in claims
+        user_id = claims['sub']
+        plan_id = legacy_plan_cache.get_or_set(
+            str(user_id),
+            lambda: db.session.query(User.subscription_plan_id).filter(User.user_id == user_id).scalar() or 0
+        )
+    snapshot = get_entitlements()
+    if claims.get('ent') == snapshot.version:
+        return plan_id, claims['feat']
+    return plan_id, snapshot.masks.get(plan_id, 0)
+
+def requires_feature(feature):
+    """Route decorator: 401 without a token or with a stale one, 403 unless the token's plan includes feature."""
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            verify_jwt_in_request()
+            try:
+                _, mask = token_entitlements()
+            except StaleTokenError as e:
+                return stale_token_response(e)
+            if not get_entitlements().allows(mask, feature):
+                return jsonify({'error': f'Your plan does not include {feature}', 'feature': feature}), 403
+            return f(*args, **kwargs)
+        return decorated
+    return decorator
+
+# ============== STREAM LIMITS ==============
+# Streams are shaped, not refused: each chunk draws from a token bucket for the user
+# (rate and burst from their plan) and one for the whole worker, sleeping when either
+# runs dry, so parallel range requests from one client share a single allowance. A
+# user over their plan's concurrent streams waits briefly for a slot. New streams are
+# turned away with 503 once the worker has STREAM_MAX_ACTIVE in flight, which keeps
+# threads available for API routes. Limits are per worker process.
+
+class TokenBucket:
+    """Classic token bucket; take() returns how long the caller should sleep."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = perf_counter()
+        self._lock = threading.Lock()
+
+    def take(self, amount):
+        with self._lock:
+            now = perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount  # may go negative: a chunk larger than the burst is paid off over time
+            return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def try_take(self, amount):
+        """Take amount if the bucket holds it and return 0; otherwise take nothing and return the wait."""
+        with self._lock:
+            now = perf_counter()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens < amount:
+                return (amount - self.tokens) / self.rate
+            self.tokens -= amount
+            return 0.0
+
+class StreamLimitError(Exception):
+    def __init__(self, message, status=429, retry_after=1):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class StreamLease:
+    """One admitted stream: throttles its body and frees its slots when the response closes."""
+
+    def __init__(self, limiter, key, plan):
+        self.limiter = limiter
+        self.key = key
+        self.plan = plan
+        self.body = ()
+        self._released = False
+
+    def __iter__(self):
+        user_bucket, node_bucket = self.limiter.buckets(self.key, self.plan), self.limiter.node_bucket
+        for chunk in self.body:
+            delay = max(user_bucket.take(len(chunk)), node_bucket.take(len(chunk)))
+            if delay > 0:
+                self.limiter.counters['throttled_ms'] += int(delay * 1000)
+                sleep(delay)
+            yield chunk
+
+    def close(self):
+        # Streamed bodies are direct_passthrough, so the WSGI server calls this, not Response.close()
+        try:
+            if hasattr(self.body, 'close'):
+                self.body.close()
+        finally:
+            self.release()
+
+    def wrap(self, response):
+        """Make this lease the response body; non-Response results (errors) release it at once."""
+        if not isinstance(response, Response):
+            self.release()
+            return response
+        self.body = response.response
+        response.response = self
+        response.call_on_close(self.release)
+        return response
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self.limiter.release(self.key, self.plan)
+
+class StreamLimiter:
+    def __init__(self, plan_limits, node_rate, max_active, slot_wait):
+        self.plan_limits = plan_limits
+        self.node_bucket = TokenBucket(node_rate, node_rate)
+        self.max_active = max_active
+        self.slot_wait = slot_wait
+        self.active = Counter()  # key -> open streams
+        self.active_by_plan = Counter()
+        self.counters = Counter()
+        self._buckets = TTLCache(ttl=600, max_entries=100000, sliding=True)  # a bucket unused for 10 minutes expires
+        self._cond = threading.Condition()
+
+    def limits(self, plan):
+        return self.plan_limits.get(plan) or self.plan_limits['free']
+
+    def buckets(self, key, plan):
+        limits = self.limits(plan)
+        return self._buckets.get_or_set(f'{plan}:{key}', lambda: TokenBucket(limits['rate'], limits['burst']))
+
+    def acquire(self, key, plan):
+        allowed = self.limits(plan)['streams']
+        with self._cond:
+            if sum(self.active_by_plan.values()) >= self.max_active:
+                self.counters['rejected_busy'] += 1
+                raise StreamLimitError('Server is at streaming capacity, retry shortly', status=503, retry_after=2)
+            if not self._cond.wait_for(lambda: self.active[key] < allowed, timeout=self.slot_wait):
+                self.counters['rejected_concurrency'] += 1
+                raise StreamLimitError(f'At most {allowed} simultaneous streams on this plan', retry_after=max(1, round(self.slot_wait)))
+            self.active[key] += 1
+            self.active_by_plan[plan] += 1
+            self.counters['admitted'] += 1
+        return StreamLease(self, key, plan)
+
+    def release(self, key, plan):
+        with self._cond:
+            self.active[key] -= 1
+            if self.active[key] <= 0:
+                del self.active[key]
+            self.active_by_plan[plan] -= 1
+            self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                **self.counters,
+                'active': sum(self.active_by_plan.values()),
+                'max_active': self.max_active,
+                'active_by_plan': {plan: n for plan, n in self.active_by_plan.items() if n},
+                # Stream counts of the ten busiest users or IPs, without saying who they are
+                'busiest': [n for _, n in self.active.most_common(10)],
+                'keys': len(self.active),
+                'node_tokens': int(self.node_bucket.tokens)
+            }
+
+def current_plan_name():
+    """Lowercase plan name of the request's token ('free' when unknown or anonymous)."""
+    try:
+        plan_id, _ = token_entitlements()
+    except StaleTokenError as e:
+        # Shape the stream by the plan the user has now
+        plan_id = e.plan_id
+    return get_entitlements().plan_names.get(plan_id, 'free')
+
+def get_stream_limiter():
+    limiter = current_app.extensions.get('stream_limiter')
+    if limiter is None:
+        config = current_app.config
+        limiter = current_app.extensions['stream_limiter'] = StreamLimiter(
+            config['STREAM_PLAN_LIMITS'], config['STREAM_NODE_RATE'], config['STREAM_MAX_ACTIVE'], config['STREAM_SLOT_WAIT']
+        )
+    return limiter
+
+# ============== PLAY EVENTS ==============
+# stream_track and /api/plays only put events on an in-memory queue. A background
+# flusher writes them to PlayEvent in batches and adds the per-batch counts to the
+# hourly/daily PlayRollup rows in the same transaction, so charts never scan PlayEvent.
+ROLLUP_GRANULARITIES = ('hour', 'day')
+
+def bucket_start(moment, granularity):
+    if granularity == 'hour':
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+def upsert_increments(table, key_columns, value_column, deltas):
+    """Add {key tuple: delta} onto table[value_column], inserting missing rows, in one statement."""
+    if not deltas:
+        return
+    rows = [dict(zip(key_columns, key), **{value_column: delta}) for key, delta in deltas.items()]
+    dialect = db.session.get_bind().dialect.name
+    if dialect == 'mysql':
+        from sqlalchemy.dialects.mysql import insert as mysql_insert
+        stmt = mysql_insert(table)
+        stmt = stmt.on_duplicate_key_update({value_column: table.c[value_column] + stmt.inserted[value_column]})
+    elif dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as upsert_insert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as upsert_insert
+        stmt = upsert_insert(table)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=key_columns,
+            set_={value_column: table.c[value_column] + stmt.excluded[value_column]}
+        )
+    else:
+        for row in rows:
+            match = [table.c[col] == row[col] for col in key_columns]
+            updated = db.session.execute(
+                table.update().where(*match).values({value_column: table.c[value_column] + row[value_column]})
+            ).rowcount
+            if not updated:
+                db.session.execute(table.insert().values(row))
+        return
+    db.session.execute(stmt, rows)
+
+class PlayRecorder:
+    """Buffers play events in memory and writes them in batches from a background thread."""
+
+    def __init__(self, app):
+        self.app = app
+        self.queue = queue.Queue(maxsize=app.config['PLAY_QUEUE_MAX'])
+        self.counters = Counter()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._beacon_buckets = TTLCache(ttl=3600, max_entries=100000, sliding=True)
+
+    def beacon_wait(self, user_id):
+        """Seconds before user_id may send another play beacon; 0 means this one is allowed."""
+        config = self.app.config
+        bucket = self._beacon_buckets.get_or_set(
+            str(user_id), lambda: TokenBucket(config['PLAY_BEACON_RATE'], config['PLAY_BEACON_BURST'])
+        )
+        wait = bucket.try_take(1)
+        if wait:
+            self.counters['beacons_throttled'] += 1
+        return wait
+
+    def record(self, track_id, artist_id=None, user_id=None, source='stream', played_ms=None):
+        event = {
+            'TrackID': track_id,
+            'ArtistID': artist_id,
+            'UserID': int(user_id) if user_id else None,
+            'PlayedAt': datetime.utcnow(),
+            'Source': source,
+            'PlayedMs': played_ms
+        }
+        try:
+            self.queue.put_nowait(event)
+            self.counters['queued'] += 1
+        except queue.Full:
+            self.counters['dropped'] += 1
+            if self.counters['dropped'] % 1000 == 1:
+                logger.warning(f"Play event queue full, {self.counters['dropped']} events dropped so far")
+        self._ensure_thread()
+
+    def _ensure_thread(self):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='play-flusher', daemon=True)
+                    self._thread.start()
+                    atexit.register(self.flush)
+
+    def _drain(self):
+        batch = []
+        while len(batch) < self.app.config['PLAY_BATCH_SIZE']:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.app.config['PLAY_FLUSH_INTERVAL'])
+            self.flush()
+
+    def flush(self):
+        """Write everything queued so far (called by the flusher, at exit and by tests)."""
+        with self._flush_lock:
+            while True:
+                batch = self._drain()
+                if not batch:
+                    return
+                self._write(batch)
+
+    def _write(self, events):
+        deltas = Counter()
+        for e in events:
+            for granularity in ROLLUP_GRANULARITIES:
+                bucket = bucket_start(e['PlayedAt'], granularity)
+                deltas[('track', e['TrackID'], granularity, bucket)] += 1
+                if e['ArtistID']:
+                    deltas[('artist', e['ArtistID'], granularity, bucket)] += 1
+        with self.app.app_context():
+            try:
+                db.session.execute(insert(PlayEvent.__table__), events)
+                upsert_increments(PlayRollup.__table__, ['Scope', 'EntityID', 'Granularity', 'BucketStart'], 'Plays', deltas)
+                db.session.commit()
+                self.counters['written'] += len(events)
+            except Exception as e:
+                db.session.rollback()
+                self.counters['failed'] += len(events)
+                logger.error(f"Play event flush failed ({len(events)} events dropped): {e}")
+
+def get_play_recorder():
+    recorder = current_app.extensions.get('play_recorder')
+    if recorder is None:
+        recorder = current_app.extensions['play_recorder'] = PlayRecorder(current_app._get_current_object())
+    return recorder
+
+# ============== LIKE ANALYTICS ==============
+# `flask rollup-likes` (run from cron) folds Likes rows with LikedAt past the 'likes'
+# watermark into hourly/daily LikeRollup rows, so /api/analytics reads a few rollup rows
+# instead of grouping the whole Likes table. It stops LIKE_ROLLUP_SETTLE seconds short of
+# now so likes from transactions still in flight are not skipped. LikedAt, the watermark
+# and the MySQL session time zone are all UTC (see install_resilience).
+#
+# Unlikes never lock the watermark. A like already behind it is subtracted straight away;
+# one that may be ahead of it leaves a LikeTombstone in the same transaction. The next run
+# skips tombstoned likes it finds in its window, and subtracts tombstones that landed just
+# behind the previous run's watermark, whose likes that run had already counted.
+LIKE_ROLLUP_KEYS = ['Scope', 'EntityID', 'Granularity', 'BucketStart']
+
+def _lock_watermark(name, create=False):
+    mark = db.session.query(RollupWatermark).filter(RollupWatermark.name == name).with_for_update().first()
+    if mark is None and create:
+        mark = RollupWatermark(name=name, through=None)
+        db.session.add(mark)
+        db.session.flush()
+    return mark
+
+def _like_deltas(likes, sign):
+    deltas = Counter()
+    for track_id, artist_id, liked_at in likes:
+        for granularity in ROLLUP_GRANULARITIES:
+            bucket = bucket_start(liked_at, granularity)
+            deltas[('track', track_id, granularity, bucket)] += sign
+            if artist_id:
+                deltas[('artist', artist_id, granularity, bucket)] += sign
+    return deltas
+
+def roll_up_likes(now=None, chunk_size=5000):
+    """Add likes made since the last run to LikeRollup and settle tombstones; returns how many were added. Commits."""
+    through = (now or datetime.utcnow()) - timedelta(seconds=current_app.config['LIKE_ROLLUP_SETTLE'])
+    mark = _lock_watermark('likes', create=True)
+    if mark.through is not None and mark.through >= through:
+        db.session.commit()
+        return 0
+    since = mark.through
+    stmt = select(Like.user_id, Like.track_id, Like.liked_at).where(Like.liked_at <= through)
+    if since is not None:
+        stmt = stmt.where(Like.liked_at > since)
+    # Each shard in turn; write only after the reads finish: a streaming cursor keeps the connection busy
+    found = []
+    for bind in get_shard_router().all_binds:
+        for rows in shard_execute(bind, stmt.execution_options(yield_per=chunk_size)).partitions():
+            found.extend(tuple(row) for row in rows)
+    # Read after the likes, so a like gone from the scan already has its tombstone here
+    tombstones = db.session.query(LikeTombstone).filter(LikeTombstone.liked_at <= through).all()
+    unliked = {(t.user_id, t.track_id, t.liked_at) for t in tombstones}
+    track_deltas = _like_deltas([(track_id, None, liked_at) for user_id, track_id, liked_at in found
+                                 if (user_id, track_id, liked_at) not in unliked], 1)
+    # Artists come from the main database; likes of deleted tracks are dropped
+    track_ids = sorted({track_id for _, track_id, _, _ in track_deltas} | {t.track_id for t in tombstones})
+    artists = {}
+    for i in range(0, len(track_ids), chunk_size):
+        artists.update(db.session.query(Track.track_id, Track.artist_id).filter(Track.track_id.in_(track_ids[i:i + chunk_size])))
+    deltas = Counter()
+    added = 0
+    for (scope, track_id, granularity, bucket), n in track_deltas.items():
+        if track_id not in artists:
+            continue
+        deltas[(scope, track_id, granularity, bucket)] += n
+        if artists[track_id]:
+            deltas[('artist', artists[track_id], granularity, bucket)] += n
+        if granularity == ROLLUP_GRANULARITIES[0]:
+            added += n
+    # Unlikes that read the previous watermark while that run was counting their like
+    late = [(t.track_id, t.artist_id, t.liked_at) for t in tombstones if since is not None and t.liked_at <= since]
+    for key, n in _like_deltas(late, -1).items():
+        # delete_track already dropped the track's own rows
+        if key[0] == 'artist' or key[1] in artists:
+            deltas[key] += n
+    upsert_increments(LikeRollup.__table__, LIKE_ROLLUP_KEYS, 'Likes', deltas)
+    if tombstones:
+        db.session.query(LikeTombstone).filter(
+            LikeTombstone.tombstone_id.in_([t.tombstone_id for t in tombstones])
+        ).delete(synchronize_session=False)
+    mark.through = through
+    mark.updated_at = datetime.utcnow()
+    db.session.commit()
+    return added
+
+def retract_like_rollups(likes):
+    """Take [(user_id, track_id, artist_id, liked_at)] being deleted in this transaction back out of LikeRollup."""
+    likes = [like for like in likes if like[3] is not None]
+    if not likes:
+        return
+    # No lock: a stale watermark only sends a like the rollup job settles instead
+    through = db.session.execute(
+        select(RollupWatermark.through).where(RollupWatermark.name == 'likes')
+    ).scalar()
+    counted = [(track_id, artist_id, liked_at) for _, track_id, artist_id, liked_at in likes
+               if through is not None and liked_at <= through]
+    upsert_increments(LikeRollup.__table__, LIKE_ROLLUP_KEYS, 'Likes', _like_deltas(counted, -1))
+    db.session.add_all([
+        LikeTombstone(user_id=user_id, track_id=track_id, artist_id=artist_id, liked_at=liked_at)
+        for user_id, track_id, artist_id, liked_at in likes
+        if through is None or liked_at > through
+    ])
+
+def like_series(scope, entity_id, granularity, start, end):
+    """[(bucket start, likes)] for every bucket in [start, end), zero-filled."""
+    counts = dict(
+        db.session.query(LikeRollup.bucket_start, LikeRollup.likes)
+        .filter(
+            LikeRollup.scope == scope, LikeRollup.entity_id == entity_id, LikeRollup.granularity == granularity,
+            LikeRollup.bucket_start >= start, LikeRollup.bucket_start < end
+        )
+        .all()
+    )
+    step = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+    series = []
+    bucket = start
+    while bucket < end:
+        series.append((bucket, counts.get(bucket, 0)))
+        bucket += step
+    return series
+
+# ============== NESTED PLAYLISTS ==============
+# A playlist's children are the playlists whose ParentPlaylistID points at it. Expanding
+# one flattens the whole tree: its own tracks in order, then each child's expansion by
+# PlaylistID, keeping the first occurrence of a track. A recursive CTE finds the tree's
+# playlists; their entries are read from each owner's shard and merged here. Each
+# node's sort key is the path of zero-padded ids from the root, which also stops a
+# cycle (a playlist already on the path is not entered again); PLAYLIST_MAX_DEPTH bounds
+# the rest. Flattened trees live in the section cache under 'playlist-tree:<id>:'; any
+# edit invalidates the edited playlist and every ancestor.
+
+def _padded_id(column):
+    return func.substr(literal('0000000000') + cast(column, String), -10)
+
+def playlist_tree_cte(pid, max_depth):
+    root = (
+        select(Playlist.playlist_id, literal(0).label('depth'), cast(_padded_id(Playlist.playlist_id), String(1024)).label('sort_path'))
+        .where(Playlist.playlist_id == pid)
+        .cte('playlist_tree', recursive=True)
+    )
+    child = aliased(Playlist)
+    return root.union_all(
+        select(child.playlist_id, root.c.depth + 1, root.c.sort_path + '/' + _padded_id(child.playlist_id))
+        .where(
+            child.parent_playlist_id == root.c.playlist_id,
+            root.c.depth < max_depth,
+            ~root.c.sort_path.contains(_padded_id(child.playlist_id))
+        )
+    )
+
+def flattened_playlist_entries(pid, max_depth):
+    """[(track_id, from_playlist_id)] for the tree rooted at pid in play order, each track once."""
+    tree = playlist_tree_cte(pid, max_depth)
+    nodes = db.session.execute(
+        select(tree.c.playlist_id, tree.c.sort_path, Playlist.user_id)
+        .join(Playlist, Playlist.playlist_id == tree.c.playlist_id)
+    ).all()
+    paths = {node.playlist_id: node.sort_path for node in nodes}
+    by_shard = defaultdict(list)
+    for node in nodes:
+        by_shard[user_shard(node.user_id)].append(node.playlist_id)
+    first = {}
+    for bind, ids in by_shard.items():
+        rows = shard_execute(bind, select(TrackPlaylist.track_id, TrackPlaylist.order_num, TrackPlaylist.playlist_id)
+                             .where(TrackPlaylist.playlist_id.in_(ids)))
+        for track_id, order_num, playlist_id in rows:
+            key = (paths[playlist_id], order_num or 0, track_id)
+            if track_id not in first or key < first[track_id][0]:
+                first[track_id] = (key, playlist_id)
+    return [(track_id, playlist_id) for track_id, (_, playlist_id) in sorted(first.items(), key=lambda item: item[1][0])]
+
+def flattened_playlist(pid):
+    """Track dicts (is_liked_by_user unset) for the playlist tree rooted at pid, cached.
+
+    The cached likes_count goes stale with every like; callers take it from _likes_counts.
+    """
+    def build():
+        entries = flattened_playlist_entries(pid, current_app.config['PLAYLIST_MAX_DEPTH'])
+        chunk = current_app.config['SHARD_SCAN_CHUNK']
+        records = {}
+        for i in range(0, len(entries), chunk):
+            if i:
+                note_query_page()
+            records.update(track_records_by_ids([track_id for track_id, _ in entries[i:i + chunk]]))
+        return [dict(records[track_id].to_dict(), from_playlist_id=from_id) for track_id, from_id in entries if track_id in records]
+    return get_section_cache().get_or_set(f'playlist-tree:{pid}:', build, current_app.config['PLAYLIST_TREE_TTL'])
+
+def playlist_ancestors(pid, max_depth):
+    """pid and every playlist above it, nearest first."""
+    up = (
+        select(Playlist.playlist_id, Playlist.parent_playlist_id, literal(0).label('depth'))
+        .where(Playlist.playlist_id == pid)
+        .cte('playlist_ancestors', recursive=True)
+    )
+    parent = aliased(Playlist)
+    up = up.union_all(
+        select(parent.playlist_id, parent.parent_playlist_id, up.c.depth + 1)
+        .where(parent.playlist_id == up.c.parent_playlist_id, up.c.depth < max_depth)
+    )
+    ids = []
+    for (playlist_id,) in db.session.execute(select(up.c.playlist_id).order_by(up.c.depth)):
+        if playlist_id in ids:
+            break  # a cycle
+        ids.append(playlist_id)
+    return ids
+
+def invalidate_playlist_trees(pid):
+    cache = get_section_cache()
+    for playlist_id in playlist_ancestors(pid, current_app.config['PLAYLIST_MAX_DEPTH']):
+        cache.invalidate(f'playlist-tree:{playlist_id}:')
+
+# ============== LIVE EVENTS ==============
+# In-process pub/sub behind GET /api/events (Server-Sent Events). Published events go
+# into one sequence-numbered ring buffer and every subscriber waits on the same
+# condition for a sequence number past its own, so an idle subscriber costs a cursor,
+# not a queue, and a publish is O(1) however many are listening. Like counts are merged
+# per track over EVENTS_COALESCE_WINDOW by a one-shot timer.
+#
+# That keeps the bus cheap, not the streams: under the threaded development server every
+# open stream holds one OS thread until the client goes away. Production runs gunicorn
+# with gevent workers (gunicorn.conf.py), where the stream is a greenlet waiting on the
+# monkey-patched condition, so thousands of idle subscribers share one worker thread.
+#
+# Event ids are '<epoch>-<seq>' with a random epoch per process. A Last-Event-ID from
+# another worker or from before a restart carries another epoch; those clients get a
+# reset event (refetch) instead of a replay of unrelated sequence numbers.
+
+EVENT_TOPICS = ('catalog', 'likes')
+
+class EventBus:
+    def __init__(self, buffer_size=2000, coalesce_window=0.5, max_subscribers=5000):
+        self.events = deque(maxlen=buffer_size)  # (seq, topic, name, payload bytes)
+        self.seq = 0
+        self.epoch = uuid.uuid4().hex[:8]
+        self.coalesce_window = coalesce_window
+        self.max_subscribers = max_subscribers
+        self.subscribers = 0
+        self.counters = Counter()
+        self._pending_likes = {}
+        self._timer = None
+        self._cond = threading.Condition()
+
+    def publish(self, topic, name, data):
+        payload = dumps_bytes(data)
+        with self._cond:
+            self.seq += 1
+            self.events.append((self.seq, topic, name, payload))
+            self.counters[name] += 1
+            self._cond.notify_all()
+
+    def publish_like_count(self, track_id, likes_count):
+        """Queue a track's new like count; bursts collapse into one event per track per window."""
+        with self._cond:
+            self._pending_likes[track_id] = likes_count
+            if self._timer is None:
+                self._timer = threading.Timer(self.coalesce_window, self._flush_likes)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def _flush_likes(self):
+        with self._cond:
+            pending, self._pending_likes, self._timer = self._pending_likes, {}, None
+        if pending:
+            self.publish('likes', 'likes', {'counts': [{'track_id': tid, 'likes_count': n} for tid, n in pending.items()]})
+
+    def subscribe(self):
+        with self._cond:
+            if self.subscribers >= self.max_subscribers:
+                return False
+            self.subscribers += 1
+            return True
+
+    def unsubscribe(self):
+        with self._cond:
+            self.subscribers -= 1
+
+    def event_id(self, seq):
+        return f'{self.epoch}-{seq}'
+
+    def resume_from(self, last_event_id):
+        """The seq a reconnect with last_event_id resumes after, or None if this bus cannot replay it."""
+        epoch, _, seq = last_event_id.partition('-')
+        if epoch != self.epoch or not seq.isdigit() or int(seq) > self.seq:
+            return None
+        return int(seq)
+
+    def wait(self, after, timeout):
+        """Events with seq > after (None if the buffer no longer reaches back that far)."""
+        with self._cond:
+            self._cond.wait_for(lambda: self.seq > after, timeout=timeout)
+            if self.events and self.events[0][0] > after + 1:
+                return None
+            return [event for event in self.events if event[0] > after]
+
+    def stats(self):
+        with self._cond:
+            return {**self.counters, 'subscribers': self.subscribers, 'seq': self.seq}
+
+def get_event_bus():
+    bus = current_app.extensions.get('event_bus')
+    if bus is None:
+        config = current_app.config
+        bus = current_app.extensions['event_bus'] = EventBus(
+            config['EVENTS_BUFFER'], config['EVENTS_COALESCE_WINDOW'], config['EVENTS_MAX_SUBSCRIBERS']
+        )
+    return bus
+
+def _sse(name, payload, event_id=None):
+    head = (f'id: {event_id}\n' if event_id is not None else '') + f'event: {name}\n'
+    return head.encode() + b'data: ' + payload + b'\n\n'
+
+def _sse_frames(bus, topics, track_ids, after, heartbeat):
+    yield b'retry: 3000\n\n'
+    while True:
+        events = None if after is None else bus.wait(after, heartbeat)
+        if events is None:
+            # Missed more than the buffer holds, or resumes from another bus: refetch, then carry on live
+            after = bus.seq
+            yield _sse('reset', b'{}', bus.event_id(after))
+            continue
+        if not events:
+            yield b': keepalive\n\n'
+            continue
+        for seq, topic, name, payload in events:
+            after = seq
+            if topic not in topics:
+                continue
+            if track_ids and topic == 'likes':
+                counts = [c for c in json.loads(payload)['counts'] if c['track_id'] in track_ids]
+                if not counts:
+                    continue
+                payload = dumps_bytes({'counts': counts})
+            yield _sse(name, payload, bus.event_id(seq))
+
+class SSEStream:
+    """Response body for one subscriber; the WSGI server's close() releases its slot."""
+
+    def __init__(self, bus, topics, track_ids, after, heartbeat):
+        self.bus = bus
+        self.frames = _sse_frames(bus, topics, track_ids, after, heartbeat)
+        self._closed = False
+
+    def __iter__(self):
+        return self.frames
+
+    def close(self):
+        if not self._closed:
+            self._closed = True
+            self.frames.close()
+            self.bus.unsubscribe()
+
+# ============== BATCH REQUESTS ==============
+# /api/batch replays sub-requests through the app's own routing table: same routes,
+# decorators and after_request hooks as over HTTP, minus the round trips. Writes run
+# in order on the batch request's session. A run of consecutive GETs between writes
+# runs in parallel, each in its own app context (sessions are not thread-safe).
+# Streaming routes are excluded; any streamed response that still gets through is
+# closed unread, which releases stream slots and other resources it holds.
+
+BATCH_EXCLUDED_ENDPOINTS = {
+    'batch', 'events', 'stream_track', 'download_playlist', 'export_user_data',
+    'upload_track', 'create_upload', 'upload_chunk', 'complete_upload'
+}
+
+_batch_executor = None
+_batch_executor_lock = threading.Lock()
+
+def _get_batch_executor(workers):
+    global _batch_executor
+    with _batch_executor_lock:
+        if _batch_executor is None:
+            _batch_executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='batch')
+        return _batch_executor
+
+def run_subrequest(app, item, authorization, remote_addr):
+    """Dispatch one {method, path, body} item and return {status, body}."""
+    method = str(item.get('method') or 'GET').upper()
+    path = str(item.get('path') or '')
+    if not path.startswith('/api/'):
+        return {'status': 400, 'body': {'error': 'path must start with /api/'}}
+    builder = EnvironBuilder(
+        path=path, method=method, json=item.get('body'),
+        headers={'Authorization': authorization} if authorization else {},
+        environ_overrides={'REMOTE_ADDR': remote_addr}
+    )
+    environ = builder.get_environ()
+    try:
+        endpoint, _ = app.url_map.bind_to_environ(environ).match()
+    except HTTPException as e:
+        return {'status': e.code, 'body': {'error': e.description}}
+    if endpoint in BATCH_EXCLUDED_ENDPOINTS:
+        return {'status': 400, 'body': {'error': f'{path} cannot be batched'}}
+
+    with app.request_context(environ):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Batch item {method} {path} failed: {e}")
+            return {'status': 500, 'body': {'error': str(e)}}
+        try:
+            if response.direct_passthrough or response.is_streamed:
+                logger.warning(f"Batch item {method} {path} returned a stream; refused")
+                return {'status': 400, 'body': {'error': f'{path} streams its response and cannot be batched'}}
+            body = response.get_json(silent=True) if response.is_json else response.get_data(as_text=True)
+            return {'status': response.status_code, 'body': body}
+        finally:
+            response.close()
+
+def _run_subrequest_in_context(app, item, authorization, remote_addr):
+    with app.app_context():
+        return run_subrequest(app, item, authorization, remote_addr)
+
+def run_batch(items, authorization, remote_addr):
+    """Run sub-requests in order, fanning out runs of GETs; results keep the input order."""
+    app = current_app._get_current_object()
+    executor = _get_batch_executor(app.config['BATCH_PARALLELISM'])
+    results = [None] * len(items)
+    reads = []
+
+    def flush_reads():
+        if len(reads) == 1:
+            i = reads[0]
+            results[i] = run_subrequest(app, items[i], authorization, remote_addr)
+        elif reads:
+            futures = {i: executor.submit(_run_subrequest_in_context, app, items[i], authorization, remote_addr) for i in reads}
+            for i, future in futures.items():
+                results[i] = future.result()
+        reads.clear()
+
+    for i, item in enumerate(items):
+        if str(item.get('method') or 'GET').upper() == 'GET':
+            reads.append(i)
+            continue
+        flush_reads()
+        results[i] = run_subrequest(app, item, authorization, remote_addr)
+    flush_reads()
+    return [dict(result, id=item.get('id', i)) for i, (item, result) in enumerate(zip(items, results))]
+
 # ============== HELPERS ==============
 def validate_email(email):
     pattern = r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$'
@@ -221,22 +3779,443 @@ def validate_email(email):
 def validate_password(password):
     return len(password) >= 8 and any(c.isupper() for c in password) and any(c.isdigit() for c in password)
 
+# ============== QUERY PLANS ==============
+def hot_queries():
+    """(name, statement) for the per-request lookups that must stay on an index.
+
+    Checked by `flask check-query-plans` and test_query_plans.py. Whole-table listings
+    (home feed pages, popular) are paginated by primary key and are not listed here.
+    """
+    return [
+        ('track_likes_counters', select(TrackStats.track_id, TrackStats.likes_count).where(TrackStats.track_id.in_([1, 2]))),
+        ('likes_counts_batch', select(Like.track_id, func.count(Like.user_id)).where(Like.track_id.in_([1, 2])).group_by(Like.track_id)),
+        ('user_liked_ids', select(Like.track_id).where(Like.user_id == 1, Like.track_id.in_([1, 2]))),
+        ('liked_tracks_page', select(Like.track_id, Like.liked_at).where(
+            Like.user_id == 1, (Like.liked_at > datetime(2024, 1, 1)) | ((Like.liked_at == datetime(2024, 1, 1)) & (Like.track_id > 1))
+        ).order_by(Like.liked_at, Like.track_id).limit(1000)),
+        ('playlist_entries_page', select(TrackPlaylist.track_id, TrackPlaylist.order_num).where(
+            TrackPlaylist.playlist_id == 1, TrackPlaylist.order_num > 1
+        ).order_by(TrackPlaylist.order_num, TrackPlaylist.track_id).limit(1000)),
+        ('tracks_by_ids', select(*TRACK_COLUMNS).select_from(Track)
+            .outerjoin(Artist, Artist.artist_id == Track.artist_id)
+            .outerjoin(Album, Album.album_id == Track.album_id)
+            .where(Track.track_id.in_([1, 2]))),
+        ('playlist_track_count', select(func.count(TrackPlaylist.track_id)).where(TrackPlaylist.playlist_id == 1)),
+        ('track_playlist_entries', select(TrackPlaylist.playlist_id).where(TrackPlaylist.track_id == 1)),
+        ('user_playlists', select(Playlist).where(Playlist.user_id == 1)),
+        ('playlist_children', select(Playlist.playlist_id).where(Playlist.parent_playlist_id == 1)),
+        ('artist_by_name', select(Artist).where(func.lower(Artist.name) == 'coldplay')),
+        ('album_by_artist_title', select(Album).where(Album.title == 'Parachutes', Album.artist_id == 1)),
+        ('artist_albums', select(Album).where(Album.artist_id == 1)),
+        ('artist_tracks', select(Track.track_id).where(Track.artist_id == 1)),
+        ('artist_top_tracks', select(TrackStats).where(TrackStats.artist_id == 1).order_by(desc(TrackStats.likes_count)).limit(20)),
+        ('user_payments', select(Payment).where(Payment.user_id == 1).order_by(Payment.date)),
+        ('user_by_email', select(User).where(User.email == 'someone@example.com')),
+        ('play_chart', select(PlayRollup.entity_id, PlayRollup.plays).where(
+            PlayRollup.scope == 'track', PlayRollup.granularity == 'day', PlayRollup.bucket_start == datetime(2024, 1, 1)
+        ).order_by(desc(PlayRollup.plays)).limit(20)),
+        ('fingerprint_lookup', select(FingerprintHash.track_id, FingerprintHash.hash, FingerprintHash.frame).where(
+            FingerprintHash.hash.in_([1, 2]), FingerprintHash.track_id != 1
+        )),
+        ('track_fingerprint', select(FingerprintHash.hash, FingerprintHash.frame).where(FingerprintHash.track_id == 1)),
+        ('like_rollup_pending', select(Like.track_id, Like.liked_at).where(
+            Like.liked_at > datetime(2024, 1, 1), Like.liked_at <= datetime(2024, 1, 2)
+        )),
+        ('like_series', select(LikeRollup.bucket_start, LikeRollup.likes).where(
+            LikeRollup.scope == 'track', LikeRollup.entity_id == 1, LikeRollup.granularity == 'day',
+            LikeRollup.bucket_start >= datetime(2024, 1, 1), LikeRollup.bucket_start < datetime(2024, 2, 1)
+        )),
+    ]
+
+# ============== QUERY BUDGET ==============
+# Counts the SQL each request runs (via a before_cursor_execute listener) and checks
+# it against the route's @query_budget. Statements that differ only in their bound
+# values are fingerprinted alike; one fingerprint seen QUERY_REPEAT_THRESHOLD times is
+# reported as N+1 with the app frames that issued it. Queries run while a streamed
+# body is iterated happen after the check and are not counted. Routes that walk a shard
+# in SHARD_SCAN_CHUNK pages declare a per_page cost: every page after the first raises
+# the budget by it and the N+1 threshold by one, so a long list is not an N+1.
+
+class QueryBudgetExceeded(Exception):
+    pass
+
+def query_budget(limit, per_page=0):
+    """Declare how many SQL statements a route may run per request, plus per_page for
+    every page after the first that a paged loop (keyset_chunks) fetches."""
+    def decorator(f):
+        f._query_budget = limit
+        f._query_budget_per_page = per_page
+        return f
+    return decorator
+
+def note_query_page():
+    """Count one more page of a paged read against the current request's query budget."""
+    if has_app_context():
+        for _, log in g.get('_query_logs', ()):
+            log.pages += 1
+
+_IN_LIST = re.compile(r'\((?:\s*(?:\?|%s|:\w+)\s*,)+\s*(?:\?|%s|:\w+)\s*\)')
+
+def sql_fingerprint(statement):
+    """Statement text with whitespace and expanded IN lists collapsed."""
+    return _IN_LIST.sub('(?)', ' '.join(statement.split()))
+
+def _app_frames(limit=3):
+    # Innermost frames of this module that led to the query, skipping the listener itself
+    frames = [f for f in traceback.extract_stack()[:-3] if f.filename == __file__]
+    return [f'{f.name}:{f.lineno}' for f in frames[-limit:]]
+
+class QueryLog:
+    def __init__(self):
+        self.count = 0
+        self.pages = 0
+        self.fingerprints = Counter()
+        self.locations = {}
+
+    def record(self, statement):
+        self.count += 1
+        fingerprint = sql_fingerprint(statement)
+        self.fingerprints[fingerprint] += 1
+        if fingerprint not in self.locations:
+            self.locations[fingerprint] = _app_frames()
+
+    def repeats(self, threshold):
+        return [(fp, n, self.locations[fp]) for fp, n in self.fingerprints.most_common() if n >= threshold]
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _count_query(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        # Nested entries come from /api/batch sub-requests; the outer request pays for them too
+        for _, log in g.get('_query_logs', ()):
+            log.record(statement)
+
+def install_query_guard(app):
+    @app.before_request
+    def start_query_log():
+        mode = app.config['QUERY_GUARD_MODE']
+        if mode == 'off' or (mode == 'sample' and random.random() >= app.config['QUERY_GUARD_SAMPLE_RATE']):
+            return
+        g.setdefault('_query_logs', []).append((request._get_current_object(), QueryLog()))
+
+    def pop_log():
+        logs = g.get('_query_logs')
+        if logs and logs[-1][0] is request._get_current_object():
+            return logs.pop()[1]
+        return None
+
+    @app.after_request
+    def check_query_log(response):
+        log = pop_log()
+        if log is None:
+            return response
+        response.headers['X-Query-Count'] = str(log.count)
+        view = app.view_functions.get(request.endpoint)
+        budget = getattr(view, '_query_budget', app.config['QUERY_BUDGET_DEFAULT'])
+        per_page = getattr(view, '_query_budget_per_page', 0)
+        budget += per_page * log.pages
+        problems = []
+        if log.count > budget:
+            problems.append(f'{log.count} queries, budget {budget}')
+        threshold = app.config['QUERY_REPEAT_THRESHOLD'] + (log.pages if per_page else 0)
+        for fingerprint, n, where in log.repeats(threshold):
+            problems.append(f"N+1: {n}x from {' < '.join(reversed(where)) or '?'}: {fingerprint[:160]}")
+        if problems:
+            message = f"{request.method} {request.path}: " + '; '.join(problems)
+            if app.config['QUERY_GUARD_MODE'] == 'strict':
+                raise QueryBudgetExceeded(message)
+            logger.warning(f"Query budget: {message}")
+        return response
+
+    @app.teardown_request
+    def drop_query_log(exc):
+        pop_log()  # the view raised, so after_request never ran
+
+# ============== RESILIENCE ==============
+# A slow or unreachable MySQL must not tie up every worker thread. Failures to connect and
+# lost connections feed a per-worker circuit breaker; while it is open, ORM statements raise
+# DatabaseUnavailable before a connection is checked out, and @serve_stale catalog routes
+# answer from their last good response instead. Routes with a @deadline stop issuing SQL
+# once it passes, and their SELECTs carry the remaining time to the server. A deadline or
+# statement timeout fails (or serves stale for) that request only: one heavy route running
+# slow must not open the breaker for every other route.
+
+# MySQL client errors meaning the server could not be reached: can't connect (2002, 2003),
+# unknown host (2005), too many connections (1040). Lost connections are is_disconnect.
+MYSQL_CONNECT_ERRORS = {1040, 2002, 2003, 2005}
+
+class DatabaseUnavailable(Exception):
+    pass
+
+class DeadlineExceeded(Exception):
+    pass
+
+class CircuitBreaker:
+    """Closed → open after `failures` errors within `window` seconds; open → half-open
+    after `cooldown`, when one request probes the database. Its first statement closes
+    the breaker again, a failure re-opens it."""
+
+    def __init__(self, failures, window, cooldown):
+        self.threshold = failures
+        self.window = window
+        self.cooldown = cooldown
+        self.state = 'closed'
+        self.opened_at = 0.0
+        self.probe = None
+        self.failures = deque()
+        self.counters = Counter()
+        self._lock = threading.Lock()
+
+    def allow(self):
+        if self.state == 'closed':
+            return True
+        with self._lock:
+            now = perf_counter()
+            if self.state == 'half_open' and self.probe == threading.get_ident():
+                return True
+            # A probe that never reached the database must not keep the breaker half-open forever
+            if now - self.opened_at >= self.cooldown:
+                self.state, self.opened_at, self.probe = 'half_open', now, threading.get_ident()
+                self.counters['probes'] += 1
+                return True
+            self.counters['rejected'] += 1
+            return False
+
+    def record_success(self):
+        if self.state == 'closed':
+            return
+        with self._lock:
+            if self.state == 'half_open':
+                self.state, self.probe = 'closed', None
+                self.failures.clear()
+                self.counters['closed'] += 1
+                logger.info('Database circuit closed')
+
+    def record_failure(self):
+        with self._lock:
+            now = perf_counter()
+            self.counters['failures'] += 1
+            if self.state == 'half_open':
+                self.state, self.opened_at, self.probe = 'open', now, None
+                logger.warning('Database probe failed; circuit open again')
+                return
+            if self.state == 'open':
+                return
+            self.failures.append(now)
+            while self.failures and now - self.failures[0] > self.window:
+                self.failures.popleft()
+            if len(self.failures) >= self.threshold:
+                self.state, self.opened_at = 'open', now
+                self.counters['opened'] += 1
+                logger.error(f"Database circuit open after {len(self.failures)} failures in {self.window:g}s")
+
+    def retry_after(self):
+        """Whole seconds until the next probe may run."""
+        return max(1, int(self.cooldown - (perf_counter() - self.opened_at) + 0.999))
+
+    def stats(self):
+        with self._lock:
+            return {**self.counters, 'state': self.state, 'recent_failures': len(self.failures)}
+
+def get_db_breaker():
+    breaker = current_app.extensions.get('db_breaker')
+    if breaker is None:
+        config = current_app.config
+        breaker = current_app.extensions['db_breaker'] = CircuitBreaker(
+            config['DB_BREAKER_FAILURES'], config['DB_BREAKER_WINDOW'], config['DB_BREAKER_COOLDOWN']
+        )
+    return breaker
+
+def deadline(seconds):
+    """Declare how long a route's database work may take in total."""
+    def decorator(f):
+        f._deadline = seconds
+        return f
+    return decorator
+
+@event.listens_for(OrmSession, 'do_orm_execute')
+def _check_breaker(orm_execute_state):
+    if has_app_context() and not get_db_breaker().allow():
+        g.db_unavailable = True
+        raise DatabaseUnavailable('Database unavailable: circuit open')
+
+@event.listens_for(Engine, 'before_cursor_execute', retval=True)
+def _apply_deadline(conn, cursor, statement, parameters, context, executemany):
+    due = g.get('db_deadline') if has_app_context() else None
+    if due is None:
+        return statement, parameters
+    remaining = due - perf_counter()
+    if remaining <= 0:
+        raise DeadlineExceeded(f"Request deadline passed before: {sql_fingerprint(statement)[:80]}")
+    dialect = conn.dialect
+    if dialect.name == 'mysql' and statement.lstrip()[:6].upper() == 'SELECT':
+        if dialect.is_mariadb:
+            statement = f"SET STATEMENT max_statement_time={remaining:.3f} FOR {statement}"
+        else:
+            statement = f"SELECT /*+ MAX_EXECUTION_TIME({max(1, int(remaining * 1000))}) */{statement.lstrip()[6:]}"
+    elif dialect.name == 'sqlite':
+        # Checked every few thousand VM steps; a non-zero return interrupts the statement
+        conn.connection.dbapi_connection.set_progress_handler(lambda: perf_counter() > due, 10000)
+    return statement, parameters
+
+def _clear_progress_handler(conn):
+    if conn.dialect.name == 'sqlite' and has_app_context() and g.get('db_deadline') is not None:
+        conn.connection.dbapi_connection.set_progress_handler(None, 0)
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _db_succeeded(conn, cursor, statement, parameters, context, executemany):
+    if has_app_context():
+        _clear_progress_handler(conn)
+        get_db_breaker().record_success()
+
+@event.listens_for(Engine, 'handle_error')
+def _db_failed(context):
+    if not has_app_context():
+        return
+    if context.connection is not None and not context.connection.closed:
+        _clear_progress_handler(context.connection)
+    # Integrity and programming errors say nothing about the server's health
+    if (isinstance(context.original_exception, DeadlineExceeded)
+            or isinstance(context.sqlalchemy_exception, (sa_exc.OperationalError, sa_exc.InterfaceError))):
+        g.db_unavailable = True
+    # Only an unreachable server opens the breaker; timeouts mean this statement was slow
+    args = getattr(context.original_exception, 'args', ())
+    if context.is_disconnect or (args and args[0] in MYSQL_CONNECT_ERRORS):
+        g.db_unavailable = True
+        get_db_breaker().record_failure()
+
+stale_counters = Counter()
+
+def get_stale_responses():
+    cache = current_app.extensions.get('stale_responses')
+    if cache is None:
+        config = current_app.config
+        cache = current_app.extensions['stale_responses'] = TTLCache(
+            ttl=config['STALE_MAX_AGE'], max_entries=config['STALE_CACHE_ENTRIES']
+        )
+    return cache
+
+def stale_response(key, anonymous_key):
+    """The last good copy of a response, or a 503 when there is none."""
+    stale_responses = get_stale_responses()
+    entry = stale_responses.get(key) or stale_responses.get(anonymous_key)
+    if entry is None:
+        stale_counters['missing'] += 1
+        return database_unavailable_response()
+    stored_at, mimetype, body = entry
+    stale_counters['served'] += 1
+    response = Response(body, 200, mimetype=mimetype)
+    response.headers['Age'] = str(int(datetime.utcnow().timestamp() - stored_at))
+    response.headers['Warning'] = '110 - "Response is Stale"'
+    response.headers['X-Served-Stale'] = '1'
+    return response
+
+def database_unavailable_response():
+    response = jsonify({'error': 'Database temporarily unavailable, please retry shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(get_db_breaker().retry_after())
+    return response
+
+def serve_stale(f):
+    """Remember a catalog route's last good response per user and path, and serve it
+    (marked stale) while the database is unavailable. Signed-in users fall back to the
+    anonymous copy, which only lacks their own like flags."""
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        verify_jwt_in_request(optional=True)
+        user_id = get_jwt_identity()
+        anonymous_key = f":{request.full_path}"
+        key = f"{user_id}:{request.full_path}" if user_id else anonymous_key
+        if not get_db_breaker().allow():
+            return stale_response(key, anonymous_key)
+        try:
+            response = current_app.make_response(f(*args, **kwargs))
+        except Exception:
+            if g.get('db_unavailable'):
+                return stale_response(key, anonymous_key)
+            raise
+        if response.status_code == 200 and not response.is_streamed:
+            get_stale_responses().set(key, (datetime.utcnow().timestamp(), response.mimetype, response.get_data()))
+        elif response.status_code >= 500 and g.get('db_unavailable'):
+            return stale_response(key, anonymous_key)
+        return response
+    return decorated
+
+def install_resilience(app):
+    config = app.config
+    if config['SQLALCHEMY_DATABASE_URI'].startswith('mysql'):
+        options = config.setdefault('SQLALCHEMY_ENGINE_OPTIONS', {})
+        options.setdefault('pool_timeout', config['DB_POOL_TIMEOUT'])
+        options.setdefault('pool_pre_ping', True)
+        connect_args = options.setdefault('connect_args', {})
+        connect_args.setdefault('connect_timeout', config['DB_CONNECT_TIMEOUT'])
+        # The app writes UTC (datetime.utcnow); make NOW() and the Likes trigger agree
+        connect_args.setdefault('init_command', "SET time_zone = '+00:00'")
+
+    @app.before_request
+    def start_deadline():
+        view = app.view_functions.get(request.endpoint)
+        seconds = getattr(view, '_deadline', config['DB_DEADLINE_DEFAULT'])
+        if seconds:
+            g.db_deadline = perf_counter() + seconds
+
+    @app.after_request
+    def hide_database_failure(response):
+        # Routes catch everything and answer 500 with the exception text; an outage is a 503
+        if response.status_code == 500 and g.get('db_unavailable'):
+            return database_unavailable_response()
+        return response
+
+# ============== STARTUP ==============
+def warm_caches(app):
+    """Prebuild the user-independent home sections and the plan matrix so the first requests hit a warm cache."""
+    started = perf_counter()
+    try:
+        with app.app_context():
+            ttl = app.config['HOME_CACHE_TTL']
+            get_section_cache().get_or_set('home:plans', plans_section, ttl)
+            get_section_cache().get_or_set('home:popular:10', lambda: popular_section(10), ttl)
+            get_entitlements()
+        logger.info(f"✅ Caches warmed in {(perf_counter() - started) * 1000:.0f}ms")
+    except Exception as e:
+        logger.warning(f"Cache warmup failed: {e}")
+
+_IMPORT_FINISHED = perf_counter()
+
 # ============== CREATE APP ==============
 def create_app():
+    # Nothing here touches the database: connectivity is checked by /api/ready and the
+    # schema is created by `flask init-db`, so a new worker is ready as soon as routes exist.
+    timings = {'import': (_IMPORT_FINISHED - _IMPORT_STARTED) * 1000}
+    phase_started = perf_counter()
+
+    def mark(phase):
+        nonlocal phase_started
+        now = perf_counter()
+        timings[phase] = (now - phase_started) * 1000
+        phase_started = now
+
     app = Flask(__name__)
     app.config.from_object(Config)
+    mark('config')
     
     CORS(app, resources={r"/api/*": {"origins": "*"}})
     JWTManager(app)
+    install_resilience(app)  # before init_app: it sets MySQL connect and pool timeouts
     db.init_app(app)
+    mark('extensions')
     
-    with app.app_context():
-        check_database()  # Check database connection and content on startup
+    if app.config['STARTUP_CHECK_DATABASE']:
+        with app.app_context():
+            check_database()  # Check database connection and content on startup
+        mark('database_check')
     
     @app.before_request
     def preflight():
         if request.method == "OPTIONS":
             return make_response("ok", 200)
+
+    app.after_request(compress_response)
+    install_query_guard(app)
     
     def token_required(f):
         @wraps(f)
@@ -273,7 +4252,7 @@ def create_app():
             )
             db.session.add(user)
             db.session.commit()
-            token = create_access_token(identity=str(user.user_id))
+            token = issue_token(user)
             logger.info(f"✅ Registered: {user.username}")
             return jsonify({
                 'message': 'Registered',
@@ -294,7 +4273,7 @@ def create_app():
             user = User.query.filter_by(email=data['email']).first()
             if not user or not check_password_hash(user.password, data['password']):
                 return jsonify({'error': 'Invalid credentials'}), 401
-            token = create_access_token(identity=str(user.user_id))
+            token = issue_token(user)
             logger.info(f"✅ Logged in: {user.username}")
             return jsonify({
                 'message': 'Login successful',
@@ -312,10 +4291,26 @@ def create_app():
         user = User.query.get(uid)
         if not user:
             return jsonify({'error': 'User not found'}), 404
-        return jsonify(user.to_dict()), 200
+        try:
+            _, mask = token_entitlements()
+        except StaleTokenError as e:
+            return stale_token_response(e)
+        return jsonify(dict(user.to_dict(), features=get_entitlements().feature_names(mask))), 200
+
+    @app.route('/api/auth/refresh', methods=['POST'])
+    @jwt_required()
+    def refresh_token():
+        """New token with the user's current plan (for sessions that predate a plan change)."""
+        user = User.query.get(get_jwt_identity())
+        if not user:
+            return jsonify({'error': 'User not found'}), 404
+        return jsonify({'user': user.to_dict(), 'token': issue_token(user)}), 200
 
     # ============== TRACKS ROUTES ==============
     @app.route('/api/tracks', methods=['GET'])
+    @query_budget(4)
+    @deadline(2.0)
+    @serve_stale
     @jwt_required(optional=True)
     def get_tracks():
         try:
@@ -350,11 +4345,9 @@ def create_app():
                 }), 500
             
             try:
-                base_query = Track.query
-                
                 # Get total count with error handling
                 try:
-                    total_tracks = base_query.count()
+                    total_tracks = count_tracks()
                     logger.info(f"Total tracks in database: {total_tracks}")
                 except Exception as e:
                     logger.error(f"Error counting tracks: {e}")
@@ -376,17 +4369,7 @@ def create_app():
                 
                 # Get paginated results
                 offset = (page - 1) * limit
-                tracks = base_query.offset(offset).limit(limit).all()
-                
-                # Convert to response format with error handling for each track
-                track_list = []
-                for track in tracks:
-                    try:
-                        track_data = track.to_dict(user_id)
-                        track_list.append(track_data)
-                    except Exception as e:
-                        logger.error(f"Error converting track {track.track_id}: {e}")
-                        continue
+                track_list = [r.to_dict() for r in track_records_page(offset, limit, user_id)]
                 
                 logger.info(f"✅ Returning {len(track_list)} tracks (Page {page}/{total_pages})")
                 return jsonify({
@@ -406,23 +4389,34 @@ def create_app():
             return jsonify({'error': str(e)}), 500
 
     @app.route('/api/tracks/<int:tid>', methods=['GET'])
+    @query_budget(2)
+    @deadline(1.0)
+    @serve_stale
     @jwt_required(optional=True)
     def get_track(tid):
         user_id = get_jwt_identity()
-        track = Track.query.get(tid)
+        track = track_record(tid, user_id)
         if not track:
             return jsonify({'error': 'Track not found'}), 404
-        return jsonify(track.to_dict(user_id)), 200
+        return jsonify(track.to_dict()), 200
 
     @app.route('/api/tracks/popular', methods=['GET'])
+    @query_budget(4)
+    @deadline(2.0)
+    @serve_stale
     @jwt_required(optional=True)
     def popular():
         try:
             user_id = get_jwt_identity()
-            limit = request.args.get('limit', 10, type=int)
-            popular_tracks = db.session.query(Track).join(Like, Track.track_id == Like.track_id, isouter=True).group_by(Track.track_id).order_by(desc(func.count(Like.track_id))).limit(limit).all()
+            limit = min(max(1, request.args.get('limit', 10, type=int)), 50)
+            # Shared with /api/home's popular section; only the liked flags are per user
+            popular_tracks = get_section_cache().get_or_set(
+                f'home:popular:{limit}', lambda: popular_section(limit), app.config['HOME_CACHE_TTL']
+            )
+            if user_id:
+                popular_tracks, = apply_user_likes([popular_tracks], user_id)
             logger.info(f"✅ Popular: {len(popular_tracks)}")
-            return jsonify({'tracks': [t.to_dict(user_id) for t in popular_tracks]}), 200
+            return jsonify({'tracks': popular_tracks}), 200
         except Exception as e:
             logger.error(f"Popular error: {e}")
             return jsonify({'error': str(e)}), 500
@@ -434,19 +4428,21 @@ def create_app():
             track = Track.query.get(tid)
             if not track:
                 return jsonify({'error': 'Track not found'}), 404
-            existing = Like.query.filter_by(user_id=user_id, track_id=tid).first()
-            if existing:
+            if find_like(user_id, tid):
                 return jsonify({'error': 'Already liked'}), 409
-            like = Like(user_id=user_id, track_id=tid)
-            db.session.add(like)
+            add_like(user_id, tid)
+            on_like_changed(track, 1)
             db.session.commit()
-            likes_count = len(db.session.query(Like).filter(Like.track_id == tid).all())
+            invalidate_like_counts()
+            track_dict = track.to_dict(user_id)
+            likes_count = track_dict['likes_count']
+            get_event_bus().publish_like_count(tid, likes_count)
             logger.info(f"✅ Liked: track {tid} by user {user_id}")
             return jsonify({
                 'message': 'Liked',
                 'likes_count': likes_count,
                 'is_liked_by_user': True,
-                'track': track.to_dict(user_id)
+                'track': track_dict
             }), 201
         except Exception as e:
             db.session.rollback()
@@ -457,19 +4453,24 @@ def create_app():
     @token_required
     def unlike(user_id, tid):
         try:
-            like = Like.query.filter_by(user_id=user_id, track_id=tid).first()
+            like = find_like(user_id, tid)
             if not like:
                 return jsonify({'error': 'Not liked'}), 404
-            db.session.delete(like)
-            db.session.commit()
             track = Track.query.get(tid)
-            likes_count = len(db.session.query(Like).filter(Like.track_id == tid).all())
+            retract_like_rollups([(int(user_id), tid, track.artist_id, like.liked_at)])
+            remove_like(user_id, tid)
+            on_like_changed(track, -1)
+            db.session.commit()
+            invalidate_like_counts()
+            track_dict = track.to_dict(user_id)
+            likes_count = track_dict['likes_count']
+            get_event_bus().publish_like_count(tid, likes_count)
             logger.info(f"✅ Unliked: track {tid} by user {user_id}")
             return jsonify({
                 'message': 'Unliked',
                 'likes_count': likes_count,
                 'is_liked_by_user': False,
-                'track': track.to_dict(user_id)
+                'track': track_dict
             }), 200
         except Exception as e:
             db.session.rollback()
@@ -484,9 +4485,7 @@ def create_app():
             return jsonify({}), 200
 
         try:
-            # Ensure upload directory exists
-            uploads_dir = os.path.join(os.path.dirname(__file__), 'uploads')
-            os.makedirs(uploads_dir, exist_ok=True)
+            storage = get_storage()
 
             if 'file' not in request.files:
                 logger.error('Upload error: No file part')
@@ -497,87 +4496,13 @@ def create_app():
                 logger.error('Upload error: Empty filename')
                 return jsonify({'error': 'No selected file'}), 400
 
-            filename = secure_filename(file.filename)
-            save_path = os.path.join(uploads_dir, filename)
-            # Avoid overwriting: append timestamp if file exists
-            if os.path.exists(save_path):
-                name, ext = os.path.splitext(filename)
-                filename = f"{name}_{int(datetime.utcnow().timestamp())}{ext}"
-                save_path = os.path.join(uploads_dir, filename)
-
-            file.save(save_path)
-            logger.info(f"✅ File saved: {save_path}")
-
-            # Read form fields
-            title = (request.form.get('title') or filename).strip()
-            artist_name = (request.form.get('artist_name') or '').strip() or None
-            album_title = (request.form.get('album_title') or '').strip() or None
-            duration_str = (request.form.get('duration') or '').strip() or None
-
-            # Find or create artist
-            artist_id = None
-            if artist_name:
-                artist = Artist.query.filter(func.lower(Artist.name) == artist_name.lower()).first()
-                if not artist:
-                    artist = Artist(name=artist_name)
-                    db.session.add(artist)
-                    db.session.flush()
-                artist_id = artist.artist_id
-
-            # Find or create album
-            album_id = None
-            if album_title:
-                # If we have an artist, try to associate
-                alb_query = Album.query.filter(Album.title == album_title)
-                if artist_id:
-                    alb_query = alb_query.filter(Album.artist_id == artist_id)
-                album = alb_query.first()
-                if not album:
-                    album = Album(title=album_title, artist_id=artist_id)
-                    db.session.add(album)
-                    db.session.flush()
-                album_id = album.album_id
-
-            # Parse duration string into time (if provided)
-            duration_val = None
-            if duration_str:
-                try:
-                    dt = datetime.strptime(duration_str, '%H:%M:%S')
-                    duration_val = dt.time()
-                except Exception:
-                    try:
-                        # Try mm:ss
-                        dt = datetime.strptime(duration_str, '%M:%S')
-                        duration_val = dt.time()
-                    except Exception:
-                        duration_val = None
-
-            # Create Track entry
-            # Ensure DB has the FilePath column (best-effort): if commit fails due to missing column, try to add it and retry
-            new_track = Track(
-                title=title,
-                artist_id=artist_id,
-                album_id=album_id,
-                duration=duration_val,
-                release_date=date.today(),
-                file_path=filename
-            )
-            db.session.add(new_track)
-            try:
-                db.session.commit()
-            except Exception as e:
-                db.session.rollback()
-                logger.warning(f"Upload commit failed, attempting to add FilePath column: {e}")
-                try:
-                    # Try to add column to Track table (MySQL)
-                    db.engine.execute("ALTER TABLE `Track` ADD COLUMN `FilePath` VARCHAR(255) NULL")
-                except Exception as e2:
-                    logger.error(f"Failed to add FilePath column: {e2}")
-                # retry
-                db.session.add(new_track)
-                db.session.commit()
+            filename = unique_blob_key(storage, file.filename)
+            size = storage.save(filename, file.stream, file.mimetype)
+            logger.info(f"✅ File saved: {filename} ({size} bytes)")
 
-            logger.info(f"✅ Track created: {new_track.track_id} - {title} (uploaded by user {user_id})")
+            new_track = create_uploaded_track(user_id, filename, request.form)
+            schedule_seek_index(app, new_track.track_id, filename)
+            schedule_fingerprint(app, new_track.track_id, filename)
 
             # Optionally, you could store the file-path metadata in another table or a new column.
             return jsonify({'message': 'Uploaded', 'track': new_track.to_dict(user_id)}), 201
@@ -586,14 +4511,203 @@ def create_app():
             logger.error(f"Upload error: {e}")
             return jsonify({'error': str(e)}), 500
 
+    # ============== RESUMABLE UPLOADS ==============
+    def get_upload_session(user_id, upload_id):
+        upload = db.session.get(UploadSession, upload_id)
+        if not upload or str(upload.user_id) != str(user_id):
+            return None
+        return upload
+
+    @app.route('/api/uploads', methods=['POST'])
+    @token_required
+    def create_upload(user_id):
+        try:
+            data = request.get_json(silent=True) or {}
+            filename = secure_filename(data.get('filename') or '')
+            if not filename:
+                return jsonify({'error': 'filename required'}), 400
+            try:
+                total_size = int(data.get('size'))
+                chunk_size = int(data.get('chunk_size') or app.config['UPLOAD_CHUNK_SIZE'])
+            except (TypeError, ValueError):
+                return jsonify({'error': 'size and chunk_size must be integers'}), 400
+            if total_size <= 0 or total_size > app.config['UPLOAD_MAX_SIZE']:
+                return jsonify({'error': f"size must be between 1 and {app.config['UPLOAD_MAX_SIZE']} bytes"}), 400
+            if chunk_size <= 0 or chunk_size > app.config['UPLOAD_MAX_CHUNK_SIZE']:
+                return jsonify({'error': f"chunk_size must be between 1 and {app.config['UPLOAD_MAX_CHUNK_SIZE']} bytes"}), 400
+            if data.get('checksum'):
+                parse_checksum(data['checksum'])
+            metadata = {k: data.get(k) for k in ('title', 'artist_name', 'album_title', 'duration') if data.get(k)}
+            for key, value in metadata.items():
+                if not isinstance(value, str):
+                    return jsonify({'error': f"{key} must be a string"}), 400
+
+            upload = UploadSession(
+                upload_id=uuid.uuid4().hex,
+                user_id=user_id,
+                filename=filename,
+                total_size=total_size,
+                chunk_size=chunk_size,
+                checksum=data.get('checksum'),
+                metadata_json=json.dumps(metadata),
+                expires_at=datetime.utcnow() + app.config['UPLOAD_SESSION_TTL']
+            )
+            db.session.add(upload)
+            db.session.commit()
+            logger.info(f"✅ Upload session {upload.upload_id}: {filename} ({total_size} bytes, {upload.total_chunks()} chunks)")
+            return jsonify(upload.to_dict()), 201
+        except UploadError as e:
+            return jsonify({'error': str(e)}), e.status
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Create upload error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/uploads/<upload_id>', methods=['GET'])
+    @token_required
+    def upload_status(user_id, upload_id):
+        upload = get_upload_session(user_id, upload_id)
+        if not upload:
+            return jsonify({'error': 'Upload not found'}), 404
+        received = received_chunks(upload)
+        # Upload-Offset: bytes received contiguously from the start, as in tus
+        contiguous = 0
+        while contiguous in received:
+            contiguous += 1
+        offset = min(contiguous * upload.chunk_size, upload.total_size)
+        response = jsonify(dict(upload.to_dict(received), offset=offset))
+        response.headers['Upload-Offset'] = str(offset)
+        response.headers['Upload-Length'] = str(upload.total_size)
+        return response, 200
+
+    @app.route('/api/uploads/<upload_id>/chunks/<int:index>', methods=['PUT'])
+    @token_required
+    def upload_chunk(user_id, upload_id, index):
+        try:
+            upload = get_upload_session(user_id, upload_id)
+            if not upload:
+                return jsonify({'error': 'Upload not found'}), 404
+            if upload.expires_at < datetime.utcnow():
+                return jsonify({'error': 'Upload expired'}), 410
+            size = write_chunk(upload, index, request.stream, request.headers.get('Upload-Checksum'))
+            upload.expires_at = datetime.utcnow() + app.config['UPLOAD_SESSION_TTL']
+            db.session.commit()
+            return jsonify({'upload_id': upload_id, 'index': index, 'size': size}), 200
+        except UploadError as e:
+            return jsonify({'error': str(e)}), e.status
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Upload chunk error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/uploads/<upload_id>/complete', methods=['POST'])
+    @token_required
+    def complete_upload(user_id, upload_id):
+        try:
+            upload = get_upload_session(user_id, upload_id)
+            if not upload or not lock_upload_session(upload):
+                return jsonify({'error': 'Upload not found'}), 404
+            filename = assemble_upload(upload, get_storage())
+            metadata = json.loads(upload.metadata_json or '{}')
+            # Deleted in the Track's transaction, so the row stays locked until the track exists
+            db.session.delete(upload)
+            new_track = create_uploaded_track(user_id, filename, metadata)
+            shutil.rmtree(staging_dir(upload_id), ignore_errors=True)
+            schedule_seek_index(app, new_track.track_id, filename)
+            schedule_fingerprint(app, new_track.track_id, filename)
+            logger.info(f"✅ Upload {upload_id} completed as track {new_track.track_id}")
+            return jsonify({'message': 'Uploaded', 'track': new_track.to_dict(user_id)}), 201
+        except UploadError as e:
+            db.session.rollback()
+            return jsonify({'error': str(e)}), e.status
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Complete upload error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/uploads/<upload_id>', methods=['DELETE'])
+    @token_required
+    def abort_upload(user_id, upload_id):
+        try:
+            upload = get_upload_session(user_id, upload_id)
+            if not upload:
+                return jsonify({'error': 'Upload not found'}), 404
+            discard_upload(upload)
+            db.session.commit()
+            return jsonify({'message': 'Upload aborted'}), 200
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Abort upload error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/tracks/<int:tid>', methods=['DELETE'])
+    @token_required
+    def delete_track(user_id, tid):
+        try:
+            track = Track.query.get(tid)
+            if not track:
+                return jsonify({'error': 'Track not found'}), 404
+            file_path = track.file_path
+
+            # The counter, so the artist summary loses exactly what it was given
+            likes_count = _likes_counts([tid]).get(tid, 0)
+            likes = gather(select(Like.user_id, Like.liked_at).where(Like.track_id == tid))
+            retract_like_rollups([(uid, tid, track.artist_id, at) for uid, at in likes])
+            LikeRollup.query.filter_by(scope='track', entity_id=tid).delete(synchronize_session=False)
+            FingerprintHash.query.filter_by(track_id=tid).delete(synchronize_session=False)
+            TrackFingerprint.query.filter_by(track_id=tid).delete(synchronize_session=False)
+            scatter(delete(Like).where(Like.track_id == tid))
+            scatter(delete(TrackPlaylist).where(TrackPlaylist.track_id == tid))
+            db.session.delete(track)
+            db.session.flush()
+            on_track_deleted(track, likes_count)
+            db.session.commit()
+
+            # Only once the row is gone: a failed delete must not leave a track without its audio
+            if file_path:
+                try:
+                    get_storage().delete(file_path)
+                    blob_sizes.invalidate(file_path)
+                    if get_hot_cache():
+                        get_hot_cache().invalidate(file_path)
+                    logger.info(f"🗑️ File deleted: {file_path}")
+                except Exception as e:
+                    logger.warning(f"⚠️ Failed to delete file: {e}")
+
+            get_section_cache().invalidate('home:')
+            get_section_cache().invalidate('playlist-tree:')
+            get_event_bus().publish('catalog', 'track.deleted', {'track_id': tid})
+            logger.info(f"✅ Track {tid} deleted by user {user_id}")
+            return jsonify({'message': 'Track deleted successfully'}), 200
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Delete error: {e}")
+            return jsonify({'error': str(e)}), 500
+
     @app.route('/api/tracks/user/<int:uid>/likes', methods=['GET'])
+    @query_budget(8, per_page=2)
     def user_likes(uid):
         try:
             user = User.query.get(uid)
             if not user:
                 return jsonify({'error': 'User not found'}), 404
-            likes = db.session.query(Like, Track).join(Track).filter(Like.user_id == uid).all()
-            liked_tracks = [track.to_dict(uid) for _, track in likes]
+            fmt = request.args.get('format')
+            if fmt in STREAM_FORMATS:
+                counter = {'total_likes': 0}
+
+                def liked_rows():
+                    for record, _ in iter_liked_tracks(uid):
+                        counter['total_likes'] += 1
+                        yield record.to_dict()
+
+                logger.info(f"✅ Streaming likes for user {uid} as {fmt}")
+                return streaming_response(
+                    fmt,
+                    {'user_id': uid, 'username': user.username},
+                    [('liked_tracks', liked_rows())],
+                    lambda: counter
+                )
+            liked_tracks = [record.to_dict() for record, _ in iter_liked_tracks(uid)]
             logger.info(f"✅ User {uid} likes: {len(liked_tracks)}")
             return jsonify({
                 'user_id': uid,
@@ -605,13 +4719,65 @@ def create_app():
             logger.error(f"User likes error: {e}")
             return jsonify({'error': str(e)}), 500
 
+    @app.route('/api/users/<int:uid>/export', methods=['GET'])
+    @token_required
+    def export_user_data(user_id, uid):
+        """Stream a user's likes, playlists and payments (NDJSON by default, ?format=stream for JSON)."""
+        try:
+            if str(uid) != str(user_id):
+                return jsonify({'error': 'Unauthorized'}), 403
+            user = User.query.get(uid)
+            if not user:
+                return jsonify({'error': 'User not found'}), 404
+            fmt = request.args.get('format', 'ndjson')
+            if fmt not in STREAM_FORMATS:
+                return jsonify({'error': 'format must be one of: ' + ', '.join(STREAM_FORMATS)}), 400
+
+            def playlist_entries():
+                # Entries come from the user's shard a page at a time, titles from the main database
+                for playlist in Playlist.query.filter_by(user_id=uid).order_by(Playlist.playlist_id).all():
+                    for entries in playlist_entry_chunks(playlist):
+                        titles = dict(db.session.query(Track.track_id, Track.title).filter(Track.track_id.in_([t for t, _ in entries])))
+                        for track_id, order_num in entries:
+                            if track_id in titles:
+                                yield {'playlist_id': playlist.playlist_id, 'track_id': track_id,
+                                       'order_num': order_num, 'title': titles[track_id]}
+
+            playlists = (
+                select(Playlist.playlist_id, Playlist.title, Playlist.creation_date, Playlist.parent_playlist_id)
+                .where(Playlist.user_id == uid)
+                .order_by(Playlist.playlist_id)
+            )
+            payments = (
+                select(Payment.payment_id, Payment.amount, Payment.date, Payment.method)
+                .where(Payment.user_id == uid)
+                .order_by(Payment.date)
+            )
+            sections = [
+                ('likes', (dict(record.to_dict(), liked_at=liked_at) for record, liked_at in iter_liked_tracks(uid))),
+                ('playlists', (r._asdict() for r in stream_rows(playlists))),
+                ('playlist_tracks', playlist_entries()),
+                ('payments', (r._asdict() for r in stream_rows(payments)))
+            ]
+            logger.info(f"✅ Exporting data for user {uid} as {fmt}")
+            response = streaming_response(
+                fmt, {'user': user.to_dict(), 'exported_at': datetime.utcnow().isoformat()}, sections
+            )
+            response.headers['Content-Disposition'] = f'attachment; filename="user_{uid}_export.{"ndjson" if fmt == "ndjson" else "json"}"'
+            return response
+        except Exception as e:
+            logger.error(f"Export error: {e}")
+            return jsonify({'error': str(e)}), 500
+
     # ============== PLAYLISTS ROUTES ==============
     @app.route('/api/playlists/user/<int:uid>', methods=['GET'])
+    @query_budget(4)
     def user_playlists(uid):
         try:
             playlists = Playlist.query.filter_by(user_id=uid).all()
+            counts = playlist_track_counts(playlists)
             logger.info(f"✅ User {uid} playlists: {len(playlists)}")
-            return jsonify({'playlists': [p.to_dict() for p in playlists]}), 200
+            return jsonify({'playlists': [p.to_dict(track_count=counts.get(p.playlist_id, 0)) for p in playlists]}), 200
         except Exception as e:
             logger.error(f"User playlists error: {e}")
             return jsonify({'error': str(e)}), 500
@@ -631,11 +4797,6 @@ def create_app():
                 logger.error("Create playlist error: Content-Type is not application/json")
                 return jsonify({'error': 'Content-Type must be application/json'}), 422
                 
-            user = User.query.get(user_id)
-            if not user:
-                logger.error(f"Create playlist error: User {user_id} not found")
-                return jsonify({'error': 'User not found'}), 401
-                
             data = request.get_json(silent=True) or {}
             logger.info(f"Create playlist parsed data: {data}")
             
@@ -660,6 +4821,7 @@ def create_app():
             return jsonify({'error': str(e)}), 500
 
     @app.route('/api/playlists/<int:pid>', methods=['GET'])
+    @query_budget(8, per_page=3)
     @jwt_required(optional=True)
     def get_playlist(pid):
         try:
@@ -667,6 +4829,11 @@ def create_app():
             playlist = Playlist.query.get(pid)
             if not playlist:
                 return jsonify({'error': 'Playlist not found'}), 404
+            fmt = request.args.get('format')
+            if fmt in STREAM_FORMATS:
+                head = playlist.to_dict()
+                records = iter_playlist_tracks(playlist, user_id)
+                return streaming_response(fmt, head, [('tracks', (r.to_dict() for r in records))])
             return jsonify(playlist.to_dict(include_tracks=True, user_id=user_id)), 200
         except Exception as e:
             logger.error(f"Get playlist error: {e}")
@@ -686,13 +4853,10 @@ def create_app():
             track = Track.query.get(tid)
             if not track:
                 return jsonify({'error': 'Track not found'}), 404
-            existing = TrackPlaylist.query.filter_by(playlist_id=pid, track_id=tid).first()
-            if existing:
+            if not add_playlist_entry(playlist, track.track_id):
                 return jsonify({'error': 'Already in playlist'}), 409
-            max_order = db.session.query(func.max(TrackPlaylist.order_num)).filter_by(playlist_id=pid).scalar() or 0
-            tp = TrackPlaylist(playlist_id=pid, track_id=tid, order_num=max_order + 1)
-            db.session.add(tp)
             db.session.commit()
+            invalidate_playlist_trees(pid)
             logger.info(f"✅ Track {tid} added to playlist {pid}")
             return jsonify({
                 'message': 'Added',
@@ -710,11 +4874,10 @@ def create_app():
             playlist = Playlist.query.get(pid)
             if not playlist or playlist.user_id != user_id:
                 return jsonify({'error': 'Playlist not found or unauthorized'}), 404
-            tp = TrackPlaylist.query.filter_by(playlist_id=pid, track_id=tid).first()
-            if not tp:
+            if not remove_playlist_entry(playlist, tid):
                 return jsonify({'error': 'Not in playlist'}), 404
-            db.session.delete(tp)
             db.session.commit()
+            invalidate_playlist_trees(pid)
             logger.info(f"✅ Track {tid} removed from playlist {pid}")
             return jsonify({
                 'message': 'Removed',
@@ -725,16 +4888,119 @@ def create_app():
             logger.error(f"Remove error: {e}")
             return jsonify({'error': str(e)}), 500
 
+    @app.route('/api/playlists/<int:pid>/expanded', methods=['GET'])
+    @query_budget(6, per_page=1)
+    @jwt_required(optional=True)
+    def expanded_playlist(pid):
+        """The playlist with its nested playlists' tracks flattened in, de-duplicated."""
+        try:
+            playlist = Playlist.query.get(pid)
+            if not playlist:
+                return jsonify({'error': 'Playlist not found'}), 404
+            tracks = flattened_playlist(pid)
+            ids = [t['track_id'] for t in tracks]
+            counts = _likes_counts(ids)
+            liked = liked_track_ids(get_jwt_identity(), ids)
+            data = playlist.to_dict(track_count=len(tracks))
+            data['tracks'] = [dict(t, likes_count=counts.get(t['track_id'], 0), is_liked_by_user=t['track_id'] in liked)
+                              for t in tracks]
+            return jsonify(data), 200
+        except Exception as e:
+            logger.error(f"Expand playlist error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/playlists/<int:pid>/download', methods=['GET'])
+    @requires_feature(FEATURE_OFFLINE_DOWNLOADS)
+    def download_playlist(pid):
+        """The playlist's audio and a manifest.json as one streamed tar; resumable with Range/If-Range."""
+        try:
+            playlist = Playlist.query.get(pid)
+            if not playlist:
+                return jsonify({'error': 'Playlist not found'}), 404
+            archive = PlaylistArchive(playlist, get_storage())
+            if not archive.tracks:
+                return jsonify({'error': 'No audio files to download', 'missing': archive.missing}), 404
+
+            name = secure_filename(playlist.title or '') or f'playlist-{pid}'
+            headers = {
+                'Accept-Ranges': 'bytes',
+                'ETag': f'"{archive.etag}"',
+                'Content-Disposition': f"attachment; filename=\"{name}.tar\"; filename*=UTF-8''{quote(playlist.title or name)}.tar"
+            }
+            start, end, status = 0, archive.size - 1, 200
+            # A resume against a changed playlist gets the whole new archive instead of mixed bytes
+            if_range = request.if_range
+            if request.range and request.range.units == 'bytes' and (
+                    not (if_range.etag or if_range.date) or if_range.etag == archive.etag):
+                byte_range = request.range.range_for_length(archive.size)
+                if byte_range is None:
+                    return Response(status=416, headers={'Content-Range': f'bytes */{archive.size}'})
+                start, end, status = byte_range[0], byte_range[1] - 1, 206
+                headers['Content-Range'] = f'bytes {start}-{end}/{archive.size}'
+            headers['Content-Length'] = str(end - start + 1)
+
+            user_id = get_jwt_identity()
+            try:
+                lease = get_stream_limiter().acquire(user_id, current_plan_name())
+            except StreamLimitError as e:
+                logger.warning(f"Download limited for playlist {pid}: {e}")
+                return jsonify({'error': str(e)}), e.status, {'Retry-After': str(e.retry_after)}
+            logger.info(f"✅ Download playlist {pid}: {len(archive.tracks)} files, bytes {start}-{end}/{archive.size}")
+            response = Response(archive.iter_range(start, end), status=status, mimetype='application/x-tar',
+                                headers=headers, direct_passthrough=True)
+            return lease.wrap(response)
+        except Exception as e:
+            logger.error(f"Download playlist error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/playlists/<int:pid>/parent', methods=['PUT'])
+    @token_required
+    def set_playlist_parent(user_id, pid):
+        """Nest a playlist under another of the same user's playlists; null un-nests it."""
+        try:
+            playlist = Playlist.query.get(pid)
+            if not playlist or str(playlist.user_id) != str(user_id):
+                return jsonify({'error': 'Playlist not found or unauthorized'}), 404
+            data = request.get_json(silent=True) or {}
+            parent_id = data.get('parent_playlist_id')
+            if parent_id is not None:
+                parent = Playlist.query.get(parent_id)
+                if not parent or str(parent.user_id) != str(user_id):
+                    return jsonify({'error': 'Parent playlist not found or unauthorized'}), 404
+                if pid in playlist_ancestors(parent_id, app.config['PLAYLIST_MAX_DEPTH']):
+                    return jsonify({'error': 'A playlist cannot be nested inside itself'}), 409
+            old_parent_id = playlist.parent_playlist_id
+            playlist.parent_playlist_id = parent_id
+            db.session.commit()
+            # The new ancestors gain this subtree and the old ones lose it
+            invalidate_playlist_trees(pid)
+            if old_parent_id is not None:
+                invalidate_playlist_trees(old_parent_id)
+            logger.info(f"✅ Playlist {pid} nested under {parent_id}")
+            return jsonify({'message': 'Updated', 'playlist': playlist.to_dict()}), 200
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Set playlist parent error: {e}")
+            return jsonify({'error': str(e)}), 500
+
     # ============== ARTISTS ROUTES ==============
     @app.route('/api/artists', methods=['GET'])
+    @query_budget(4)
+    @deadline(2.0)
+    @serve_stale
     def artists():
         try:
             page = request.args.get('page', 1, type=int)
             limit = request.args.get('limit', 50, type=int)
-            artists_query = Artist.query.paginate(page=page, per_page=limit, error_out=False)
+            artists_query = (
+                db.session.query(Artist, ArtistStats)
+                .outerjoin(ArtistStats, ArtistStats.artist_id == Artist.artist_id)
+                .order_by(Artist.artist_id)
+                .paginate(page=page, per_page=limit, error_out=False)
+            )
             logger.info(f"✅ Artists: {artists_query.total}")
             return jsonify({
-                'artists': [a.to_dict() for a in artists_query.items],
+                'artists': [dict(a.to_dict(), stats=s.to_dict() if s else None) for a, s in artists_query.items],
                 'total': artists_query.total,
                 'pages': artists_query.pages,
                 'current_page': page
@@ -744,6 +5010,9 @@ def create_app():
             return jsonify({'error': str(e)}), 500
 
     @app.route('/api/artists/<int:aid>', methods=['GET'])
+    @query_budget(15)
+    @deadline(2.0)
+    @serve_stale
     @jwt_required(optional=True)
     def artist(aid):
         try:
@@ -751,49 +5020,144 @@ def create_app():
             artist_obj = Artist.query.get(aid)
             if not artist_obj:
                 return jsonify({'error': 'Artist not found'}), 404
-            tracks = Track.query.filter_by(artist_id=aid).all()
-            albums = Album.query.filter_by(artist_id=aid).all()
+            tracks_page = max(1, request.args.get('tracks_page', 1, type=int))
+            tracks_limit = min(max(1, request.args.get('tracks_limit', 20, type=int)), 100)
+            albums_page = max(1, request.args.get('albums_page', 1, type=int))
+            albums_limit = min(max(1, request.args.get('albums_limit', 20, type=int)), 100)
+
+            stats = db.session.get(ArtistStats, aid)
+            if not stats:
+                rebuild_artist_stats(aid)
+                db.session.commit()
+                stats = db.session.get(ArtistStats, aid)
+
+            # Most liked first, served by idx_trackstats_artist_likes
+            track_rows = (
+                db.session.query(Track, TrackStats.likes_count)
+                .join(TrackStats, TrackStats.track_id == Track.track_id)
+                .filter(TrackStats.artist_id == aid)
+                .options(joinedload(Track.album))
+                .order_by(desc(TrackStats.likes_count), desc(TrackStats.track_id))
+                .offset((tracks_page - 1) * tracks_limit)
+                .limit(tracks_limit)
+                .all()
+            )
+            liked = liked_track_ids(user_id, [t.track_id for t, _ in track_rows])
+
+            album_likes = (
+                db.session.query(TrackStats.album_id.label('album_id'), func.sum(TrackStats.likes_count).label('likes'))
+                .filter(TrackStats.artist_id == aid, TrackStats.album_id.isnot(None))
+                .group_by(TrackStats.album_id)
+                .subquery()
+            )
+            album_rows = (
+                db.session.query(Album, func.coalesce(album_likes.c.likes, 0))
+                .outerjoin(album_likes, album_likes.c.album_id == Album.album_id)
+                .filter(Album.artist_id == aid)
+                .order_by(desc(func.coalesce(album_likes.c.likes, 0)), desc(Album.album_id))
+                .offset((albums_page - 1) * albums_limit)
+                .limit(albums_limit)
+                .all()
+            )
+
             return jsonify({
                 'artist': artist_obj.to_dict(),
-                'tracks': [t.to_dict(user_id) for t in tracks],
-                'albums': [a.to_dict() for a in albums]
+                'stats': stats.to_dict(),
+                'tracks': [t.to_dict(user_id, likes_count=n, is_liked=t.track_id in liked) for t, n in track_rows],
+                'albums': [dict(a.to_dict(), likes_count=int(n)) for a, n in album_rows],
+                'tracks_pagination': {
+                    'total': stats.track_count,
+                    'pages': (stats.track_count + tracks_limit - 1) // tracks_limit,
+                    'current_page': tracks_page
+                },
+                'albums_pagination': {
+                    'total': stats.album_count,
+                    'pages': (stats.album_count + albums_limit - 1) // albums_limit,
+                    'current_page': albums_page
+                }
             }), 200
         except Exception as e:
             logger.error(f"Artist error: {e}")
             return jsonify({'error': str(e)}), 500
 
+    # ============== HOME FEED ==============
+    @app.route('/api/home', methods=['GET'])
+    @query_budget(6)
+    @deadline(3.0)
+    @serve_stale
+    @jwt_required(optional=True)
+    def home():
+        """Plans, popular tracks, the first tracks page and artists in a single round trip."""
+        try:
+            user_id = get_jwt_identity()
+            popular_limit = min(max(1, request.args.get('popular_limit', 10, type=int)), 50)
+            tracks_limit = min(max(1, request.args.get('tracks_limit', 50, type=int)), 100)
+            artists_limit = min(max(1, request.args.get('artists_limit', 50, type=int)), 100)
+
+            results, timed_out, failed = gather_home_sections({
+                'subscription_plans': ('home:plans', plans_section),
+                'popular_tracks': (f'home:popular:{popular_limit}', lambda: popular_section(popular_limit)),
+                'tracks': (f'home:tracks:1:{tracks_limit}', lambda: tracks_section(1, tracks_limit)),
+                'artists': (f'home:artists:1:{artists_limit}', lambda: artists_section(1, artists_limit))
+            }, timeout=app.config['HOME_SECTION_TIMEOUT'], ttl=app.config['HOME_CACHE_TTL'])
+
+            popular_tracks = results.get('popular_tracks')
+            tracks_page = results.get('tracks')
+            if user_id:
+                popular_liked, page_tracks = apply_user_likes(
+                    [popular_tracks or [], tracks_page['tracks'] if tracks_page else []], user_id
+                )
+                if popular_tracks is not None:
+                    popular_tracks = popular_liked
+                if tracks_page:
+                    tracks_page = dict(tracks_page, tracks=page_tracks)
+
+            logger.info(f"✅ Home: {len(results)} sections, timed out: {timed_out}, failed: {failed}")
+            return jsonify({
+                'subscription_plans': results.get('subscription_plans'),
+                'popular_tracks': popular_tracks,
+                'tracks': tracks_page,
+                'artists': results.get('artists'),
+                'timed_out': timed_out,
+                'failed': failed
+            }), 200
+        except Exception as e:
+            logger.error(f"Home error: {e}")
+            return jsonify({'error': str(e)}), 500
+
     # ============== SUBSCRIPTION PLANS ==============
     @app.route('/api/subscription_plans', methods=['GET'])
     def subscription_plans():
         """Return available subscription plans."""
         try:
-            plans = SubscriptionPlan.query.order_by(SubscriptionPlan.subscription_plan_id).all()
+            plans = get_section_cache().get_or_set('home:plans', plans_section, app.config['HOME_CACHE_TTL'])
             logger.info(f"✅ Subscription plans: {len(plans)}")
-            return jsonify({'subscription_plans': [p.to_dict() for p in plans]}), 200
+            return jsonify({'subscription_plans': plans}), 200
         except Exception as e:
             logger.error(f"Subscription plans error: {e}")
             return jsonify({'error': str(e)}), 500
 
     @app.route('/api/tracks/<int:tid>/stream', methods=['GET'])
+    @jwt_required(optional=True)
     def stream_track(tid):
         try:
             track = Track.query.get(tid)
             if not track:
                 return jsonify({'error': 'Track not found'}), 404
 
-            uploads_dir = os.path.join(os.path.dirname(__file__), 'uploads')
+            storage = get_storage()
 
             # Prefer stored file_path if present
             candidate = None
             if getattr(track, 'file_path', None):
-                p = os.path.join(uploads_dir, track.file_path)
-                if os.path.exists(p):
+                if storage.local_path(track.file_path) or storage.exists(track.file_path):
                     candidate = track.file_path
 
             # Fallback: try to find a file that matches the track title or id
-            if not candidate and os.path.isdir(uploads_dir):
+            if not candidate and storage.listable:
+                keys = storage.list_keys()
                 # first pass: look for track id in filename
-                for fname in os.listdir(uploads_dir):
+                for fname in keys:
                     if str(tid) in fname:
                         candidate = fname
                         break
@@ -805,23 +5169,436 @@ def create_app():
                         return ''.join(c.lower() for c in s if c.isalnum())
 
                     title_norm = normalize_text(track.title or '')
-                    for fname in os.listdir(uploads_dir):
+                    for fname in keys:
                         fname_norm = normalize_text(fname)
                         if title_norm and title_norm in fname_norm:
                             candidate = fname
                             break
 
             if not candidate:
-                logger.error(f"Stream error: file for track {tid} not found in uploads")
+                logger.error(f"Stream error: file for track {tid} not found in storage")
                 return jsonify({'error': 'Audio file not found'}), 404
 
-            logger.info(f"✅ Streaming file for track {tid}: {candidate}")
-            return send_from_directory(uploads_dir, candidate, as_attachment=False)
+            seek_seconds = request.args.get('t', type=float)
+            # Players re-request ranges while playing; only the opening request counts as a play
+            range_header = request.headers.get('Range', '').replace(' ', '')
+            opening = not seek_seconds and (not range_header or range_header.startswith('bytes=0-'))
+            if opening:
+                get_play_recorder().record(tid, track.artist_id, get_jwt_identity(), 'stream')
+
+            playlist_id = request.args.get('playlist', type=int)
+            queue_ids = parse_queue(request.args.get('queue'))
+            upcoming = []
+            if opening and (playlist_id is not None or queue_ids):
+                upcoming = upcoming_tracks(tid, app.config['PREFETCH_NEXT_TRACKS'], playlist_id, queue_ids)
+                schedule_prefetch(storage, [path for _, path in upcoming], app.config['PREFETCH_BYTES'])
+
+            user_id = get_jwt_identity()
+            try:
+                lease = get_stream_limiter().acquire(user_id or f'ip:{request.remote_addr}', current_plan_name())
+            except StreamLimitError as e:
+                logger.warning(f"Stream limited for track {tid}: {e}")
+                return jsonify({'error': str(e)}), e.status, {'Retry-After': str(e.retry_after)}
+            try:
+                if seek_seconds is not None and seek_seconds > 0:
+                    logger.info(f"✅ Streaming file for track {tid} from {seek_seconds}s: {candidate}")
+                    response = send_from_time(storage, candidate, tid, seek_seconds)
+                else:
+                    logger.info(f"✅ Streaming file for track {tid}: {candidate}")
+                    response = send_blob(storage, candidate)
+            except Exception:
+                lease.release()
+                raise
+            if upcoming and isinstance(response, Response):
+                response.headers['Link'] = preload_link_header(upcoming, playlist_id, queue_ids)
+            return lease.wrap(response)
         except Exception as e:
             logger.error(f"Stream error: {e}")
             return jsonify({'error': str(e)}), 500
 
+    # ============== PLAYS & CHARTS ==============
+    @app.route('/api/plays', methods=['POST'])
+    @jwt_required()
+    def record_play():
+        """Beacon for plays the stream endpoint cannot see (cached or offline audio)."""
+        data = request.get_json(silent=True) or {}
+        try:
+            tid = int(data.get('track_id'))
+            played_ms = int(data['played_ms']) if data.get('played_ms') is not None else None
+        except (TypeError, ValueError):
+            return jsonify({'error': 'track_id (and optional played_ms) must be integers'}), 400
+        user_id = get_jwt_identity()
+        recorder = get_play_recorder()
+        wait = recorder.beacon_wait(user_id)
+        if wait:
+            return jsonify({'error': 'Too many play beacons, retry later'}), 429, {'Retry-After': str(max(1, round(wait)))}
+        # The artist comes from the catalog, never from the client, so charts cannot be padded
+        track = db.session.query(Track.artist_id).filter(Track.track_id == tid).first()
+        if track is None:
+            return jsonify({'error': 'Track not found'}), 404
+        recorder.record(tid, track.artist_id, user_id, 'beacon', played_ms)
+        return jsonify({'message': 'Queued'}), 202
+
+    @app.route('/api/charts/<scope>', methods=['GET'])
+    @query_budget(3)
+    @deadline(2.0)
+    @serve_stale
+    @jwt_required(optional=True)
+    def play_chart(scope):
+        """Most played tracks or artists for one hour/day bucket, read from PlayRollup."""
+        try:
+            if scope not in ('tracks', 'artists'):
+                return jsonify({'error': 'scope must be tracks or artists'}), 404
+            granularity = request.args.get('granularity', 'day')
+            if granularity not in ROLLUP_GRANULARITIES:
+                return jsonify({'error': 'granularity must be hour or day'}), 400
+            limit = min(max(1, request.args.get('limit', 20, type=int)), 100)
+            try:
+                at = datetime.fromisoformat(request.args['at']) if request.args.get('at') else datetime.utcnow()
+            except ValueError:
+                return jsonify({'error': 'at must be an ISO datetime'}), 400
+            bucket = bucket_start(at, granularity)
+
+            rows = (
+                db.session.query(PlayRollup.entity_id, PlayRollup.plays)
+                .filter(PlayRollup.scope == scope[:-1], PlayRollup.granularity == granularity, PlayRollup.bucket_start == bucket)
+                .order_by(desc(PlayRollup.plays))
+                .limit(limit)
+                .all()
+            )
+            plays = dict(rows)
+            if scope == 'tracks':
+                records = track_records_by_ids(list(plays))
+                liked = liked_track_ids(get_jwt_identity(), list(records))
+                entries = []
+                for i, n in rows:
+                    record = records.get(i)
+                    if record is not None:
+                        record.is_liked = i in liked
+                        entries.append(dict(record.to_dict(), plays=n))
+            else:
+                artists = {a.artist_id: a for a in Artist.query.filter(Artist.artist_id.in_(plays)).all()}
+                entries = [dict(artists[i].to_dict(), plays=n) for i, n in rows if i in artists]
+            return jsonify({'granularity': granularity, 'bucket_start': bucket.isoformat(), scope: entries}), 200
+        except Exception as e:
+            logger.error(f"Chart error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/analytics/<scope>/<int:entity_id>/likes', methods=['GET'])
+    @query_budget(4)
+    def like_analytics(scope, entity_id):
+        """Likes per hour/day for one track or artist, read from LikeRollup.
+
+        ?bucket=hour|day (default day); ?from= and ?to= are ISO datetimes, default the
+        last 30 days (48 hours for hourly). Likes newer than 'through' are not in yet.
+        """
+        try:
+            if scope not in ('tracks', 'artists'):
+                return jsonify({'error': 'scope must be tracks or artists'}), 404
+            granularity = request.args.get('bucket', 'day')
+            if granularity not in ROLLUP_GRANULARITIES:
+                return jsonify({'error': 'bucket must be hour or day'}), 400
+            try:
+                end = datetime.fromisoformat(request.args['to']) if request.args.get('to') else datetime.utcnow()
+                default_span = timedelta(hours=48) if granularity == 'hour' else timedelta(days=30)
+                start = datetime.fromisoformat(request.args['from']) if request.args.get('from') else end - default_span
+            except ValueError:
+                return jsonify({'error': 'from and to must be ISO datetimes'}), 400
+            start = bucket_start(start, granularity)
+            step = timedelta(hours=1) if granularity == 'hour' else timedelta(days=1)
+            if end <= start:
+                return jsonify({'error': 'from must be before to'}), 400
+            if (end - start) / step > app.config['LIKE_ANALYTICS_MAX_BUCKETS']:
+                return jsonify({'error': f"at most {app.config['LIKE_ANALYTICS_MAX_BUCKETS']} buckets per request"}), 400
+
+            model = Track if scope == 'tracks' else Artist
+            if db.session.get(model, entity_id) is None:
+                return jsonify({'error': f'{scope[:-1].capitalize()} not found'}), 404
+            series = like_series(scope[:-1], entity_id, granularity, start, end)
+            mark = db.session.get(RollupWatermark, 'likes')
+            return jsonify({
+                f'{scope[:-1]}_id': entity_id,
+                'bucket': granularity,
+                'from': start.isoformat(),
+                'to': end.isoformat(),
+                'through': mark.through.isoformat() if mark and mark.through else None,
+                'total': sum(n for _, n in series),
+                'series': [{'bucket_start': b.isoformat(), 'likes': n} for b, n in series]
+            }), 200
+        except Exception as e:
+            logger.error(f"Like analytics error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    @app.route('/api/tracks/<int:tid>/duplicates', methods=['GET'])
+    @query_budget(10)
+    @jwt_required(optional=True)
+    def track_duplicates(tid):
+        """Tracks whose audio matches this one's fingerprint, best match first."""
+        try:
+            if db.session.get(Track, tid) is None:
+                return jsonify({'error': 'Track not found'}), 404
+            if db.session.get(TrackFingerprint, tid) is None:
+                return jsonify({'error': 'Track has not been fingerprinted yet', 'fingerprinted': False}), 409
+            candidates = duplicate_candidates(tid)
+            tracks = {
+                t.track_id: t for t in Track.query.options(joinedload(Track.artist), joinedload(Track.album))
+                .filter(Track.track_id.in_([c[0] for c in candidates])).all()
+            }
+            dicts = {d['track_id']: d for d in tracks_to_dicts(list(tracks.values()), get_jwt_identity())}
+            return jsonify({
+                'track_id': tid,
+                'candidates': [dict(dicts[other], matches=n, score=score) for other, n, score in candidates if other in dicts]
+            }), 200
+        except Exception as e:
+            logger.error(f"Duplicates error: {e}")
+            return jsonify({'error': str(e)}), 500
+
+    # ============== CLI ==============
+    @app.cli.command('rebuild-artist-stats')
+    def rebuild_artist_stats_command():
+        """Create the stats tables if needed and recompute every artist summary."""
+        ArtistStats.__table__.create(db.engine, checkfirst=True)
+        TrackStats.__table__.create(db.engine, checkfirst=True)
+        rebuild_artist_stats()
+        db.session.commit()
+        logger.info(f"✅ Artist stats rebuilt: {ArtistStats.query.count()} artists, {TrackStats.query.count()} tracks")
+
+    @app.cli.command('build-seek-indexes')
+    def build_seek_indexes_command():
+        """Build seek tables for stored MP3/FLAC tracks that do not have one yet."""
+        TrackSeekIndex.__table__.create(db.engine, checkfirst=True)
+        storage = get_storage()
+        pending = (
+            db.session.query(Track.track_id, Track.file_path)
+            .outerjoin(TrackSeekIndex, TrackSeekIndex.track_id == Track.track_id)
+            .filter(TrackSeekIndex.track_id.is_(None), Track.file_path.isnot(None))
+            .all()
+        )
+        for track_id, key in pending:
+            try:
+                if storage.exists(key):
+                    build_seek_index(track_id, storage, key, app.config['SEEK_INDEX_INTERVAL_MS'])
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Seek index failed for track {track_id}: {e}")
+
+    @app.cli.command('fingerprint-tracks')
+    @click.option('--workers', type=int, default=None, help='Processes to fingerprint with (default FINGERPRINT_WORKERS).')
+    @click.option('--limit', type=int, default=None, help='Fingerprint at most this many tracks.')
+    def fingerprint_tracks_command(workers, limit):
+        """Fingerprint stored tracks that have no fingerprint yet, in parallel, and report likely duplicates."""
+        if not fingerprint.available():
+            logger.error("❌ numpy is not installed; fingerprinting is unavailable")
+            raise SystemExit(1)
+        TrackFingerprint.__table__.create(db.engine, checkfirst=True)
+        FingerprintHash.__table__.create(db.engine, checkfirst=True)
+        query = (
+            db.session.query(Track.track_id, Track.file_path)
+            .outerjoin(TrackFingerprint, TrackFingerprint.track_id == Track.track_id)
+            .filter(TrackFingerprint.track_id.is_(None), Track.file_path.isnot(None))
+            .order_by(Track.track_id)
+        )
+        pending = query.limit(limit).all() if limit else query.all()
+        workers = workers or app.config['FINGERPRINT_WORKERS']
+        storage = get_storage()
+        done, failed = [], 0
+        started = perf_counter()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            # A few files per worker at a time bounds the temp copies made for remote storage
+            window = workers * 4
+            for i in range(0, len(pending), window):
+                with ExitStack() as copies:
+                    futures = {}
+                    for track_id, key in pending[i:i + window]:
+                        try:
+                            path = copies.enter_context(local_audio_copy(storage, key))
+                        except Exception as e:
+                            failed += 1
+                            logger.warning(f"Track {track_id}: cannot read {key}: {e}")
+                            continue
+                        futures[pool.submit(fingerprint.fingerprint_file, path, app.config['FFMPEG_BINARY'])] = track_id
+                    for future in as_completed(futures):
+                        track_id = futures[future]
+                        try:
+                            store_fingerprint(track_id, *future.result())
+                            db.session.commit()
+                            done.append(track_id)
+                        except Exception as e:
+                            db.session.rollback()
+                            failed += 1
+                            logger.warning(f"Track {track_id}: fingerprint failed: {e}")
+        logger.info(f"✅ Fingerprinted {len(done)} track(s) in {perf_counter() - started:.1f}s, {failed} failed")
+        # Matched once everything is indexed, so duplicates within this batch are found too
+        reported = set()
+        for track_id in done:
+            for other, n, score in duplicate_candidates(track_id):
+                pair = frozenset((track_id, other))
+                if pair not in reported:
+                    reported.add(pair)
+                    logger.warning(f"Possible duplicate: tracks {track_id} and {other} ({n} aligned hashes, score {score})")
+
+    @app.cli.command('gc-uploads')
+    def gc_uploads_command():
+        """Delete expired resumable-upload sessions and their staged chunks (run from cron)."""
+        gc_expired_uploads()
+
+    @app.cli.command('rollup-likes')
+    def rollup_likes_command():
+        """Fold likes made since the last run into the hourly/daily LikeRollup rows (run from cron)."""
+        LikeTombstone.__table__.create(db.engine, checkfirst=True)
+        added = roll_up_likes()
+        logger.info(f"✅ Like rollup: {added} like(s) added, through {db.session.get(RollupWatermark, 'likes').through}")
+
+    @app.cli.command('set-plan')
+    @click.argument('user_id', type=int)
+    @click.argument('plan_id', type=int)
+    def set_plan_command(user_id, plan_id):
+        """Move a user to another subscription plan (billing and support; payment is recorded elsewhere)."""
+        user = db.session.get(User, user_id)
+        if not user:
+            logger.error(f"❌ No user {user_id}")
+            raise SystemExit(1)
+        try:
+            change_user_plan(user, plan_id)
+        except ValueError as e:
+            logger.error(f"❌ {e}")
+            raise SystemExit(1)
+        db.session.commit()
+        logger.info(f"✅ User {user_id} moved to plan {plan_id}; their old tokens go stale within {app.config['PLAN_CHANGES_RELOAD']}s")
+
+    @app.cli.command('init-db')
+    def init_db_command():
+        """Create any missing tables for the models (existing tables are left alone)."""
+        db.create_all()
+        # create_all skips indexes on tables that already exist; the migrations add those
+        apply_migrations(db.engine, db.metadata)
+        create_shard_tables()
+        logger.info("✅ Database schema created")
+
+    @app.cli.command('migrate-db')
+    def migrate_db_command():
+        """Apply pending schema migrations (indexes missing from databases built with older DDL)."""
+        ShardMap.__table__.create(db.engine, checkfirst=True)
+        LikeTombstone.__table__.create(db.engine, checkfirst=True)
+        PlanChange.__table__.create(db.engine, checkfirst=True)
+        applied = apply_migrations(db.engine, db.metadata)
+        create_shard_tables()
+        logger.info(f"✅ {len(applied)} migration(s) applied" if applied else "✅ Schema is up to date")
+
+    @app.cli.command('rebalance-shards')
+    @click.option('--dry-run', is_flag=True, help='Print the planned bucket moves without moving anything.')
+    @click.option('--settle', type=float, default=None,
+                  help='Seconds to wait after switching the map (default SHARD_MAP_RELOAD plus 5).')
+    def rebalance_shards_command(dry_run, settle):
+        """Spread the hash buckets evenly over SHARD_BINDS, moving their Likes and playlist entries."""
+        ShardMap.__table__.create(db.engine, checkfirst=True)
+        create_shard_tables()
+        router = get_shard_router()
+        moves = plan_rebalance(router.placement(), router.binds)
+        flows = Counter((source, target) for _, source, target in moves)
+        for (source, target), n in sorted(flows.items()):
+            logger.info(f"{source} → {target}: {n} bucket(s)")
+        if not moves:
+            logger.info("✅ Shards are balanced")
+            return
+        if dry_run:
+            logger.info(f"Dry run: {len(moves)} bucket(s) would move")
+            return
+        move_buckets(moves, app.config['SHARD_MAP_RELOAD'] + 5 if settle is None else settle)
+        logger.info(f"✅ Moved {len(moves)} bucket(s)")
+
+    @app.cli.command('check-query-plans')
+    def check_query_plans_command():
+        """EXPLAIN every hot query; exits non-zero if any falls back to a full table scan."""
+        with db.engine.connect() as connection:
+            failures = check_query_plans(connection, hot_queries())
+        for name, tables in failures.items():
+            logger.error(f"❌ {name}: full scan of {', '.join(tables)}")
+        if failures:
+            raise SystemExit(1)
+        logger.info("✅ All hot queries use an index")
+
+    @app.cli.command('check-db')
+    def check_db_command():
+        """Run the connection and table-count check that used to run on every startup."""
+        check_database()
+
+    # ============== LIVE EVENTS ==============
+    @app.route('/api/events', methods=['GET'])
+    def events():
+        """SSE stream of catalog changes and coalesced like counts.
+
+        ?topics=catalog,likes picks topics (default all); ?track_ids=1,2 narrows like
+        updates to those tracks. Reconnects resume from Last-Event-ID when it came from this
+        worker's bus, and otherwise start with a reset event.
+        """
+        topics = set(filter(None, request.args.get('topics', ','.join(EVENT_TOPICS)).split(',')))
+        unknown = topics - set(EVENT_TOPICS)
+        if unknown or not topics:
+            return jsonify({'error': f"topics must be from {', '.join(EVENT_TOPICS)}"}), 400
+        track_ids = set(parse_queue(request.args.get('track_ids')))
+        bus = get_event_bus()
+        last_id = request.headers.get('Last-Event-ID')
+        after = bus.resume_from(last_id) if last_id else bus.seq
+        if not bus.subscribe():
+            return jsonify({'error': 'Too many event subscribers, retry shortly'}), 503, {'Retry-After': '5'}
+        # The body never touches the request or the database, so no request context is kept
+        return Response(
+            SSEStream(bus, topics, track_ids, after, app.config['EVENTS_HEARTBEAT']),
+            mimetype='text/event-stream', direct_passthrough=True,
+            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+        )
+
+    # ============== BATCH ==============
+    @app.route('/api/batch', methods=['POST'])
+    def batch():
+        """Run up to BATCH_MAX_REQUESTS sub-requests in one round trip; per-item status in order."""
+        data = request.get_json(silent=True) or {}
+        items = data.get('requests')
+        if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+            return jsonify({'error': 'requests must be a non-empty list of {method, path, body}'}), 400
+        if len(items) > app.config['BATCH_MAX_REQUESTS']:
+            return jsonify({'error': f"At most {app.config['BATCH_MAX_REQUESTS']} requests per batch"}), 400
+        responses = run_batch(items, request.headers.get('Authorization'), request.remote_addr)
+        logger.info(f"✅ Batch: {len(items)} requests, statuses {[r['status'] for r in responses]}")
+        return jsonify({'responses': responses}), 200
+
     # ============== HEALTH CHECK ==============
+    @app.route('/api/ready', methods=['GET'])
+    def ready():
+        """Readiness probe: one round trip to the database, no table scans."""
+        try:
+            db.session.execute(text('SELECT 1'))
+            return jsonify({
+                'status': 'ready',
+                'startup_ms': {k: round(v, 1) for k, v in app.extensions['startup_timings'].items()}
+            }), 200
+        except Exception as e:
+            logger.error(f"Readiness error: {e}")
+            return jsonify({'status': 'unavailable', 'message': str(e)}), 503
+
+
+    @app.route('/api/metrics', methods=['GET'])
+    def metrics():
+        """In-process counters for this worker; operators only (X-Metrics-Token)."""
+        expected = app.config['METRICS_TOKEN']
+        if not expected:
+            return jsonify({'error': 'Not found'}), 404
+        if not hmac.compare_digest(request.headers.get('X-Metrics-Token', '').encode(), expected.encode()):
+            return jsonify({'error': 'Metrics token required'}), 403
+        hot = get_hot_cache()
+        recorder = app.extensions.get('play_recorder')
+        return jsonify({
+            'hot_cache': hot.stats() if hot else None,
+            'section_cache': get_section_cache().stats(),
+            'stream_limiter': get_stream_limiter().stats(),
+            'events': get_event_bus().stats(),
+            'plays': dict(recorder.counters) if recorder else None,
+            'database': get_db_breaker().stats(),
+            'stale_responses': dict(stale_counters)
+        }), 200
+
     @app.route('/api/health', methods=['GET'])
     def health():
         try:
@@ -840,6 +5617,13 @@ def create_app():
             logger.error(f"Health error: {e}")
             return jsonify({'status': 'error', 'message': str(e)}), 500
 
+    mark('routes')
+    app.extensions['startup_timings'] = timings
+    logger.info("🚀 Startup: " + ", ".join(f"{k} {v:.1f}ms" for k, v in timings.items()))
+
+    if app.config['STARTUP_WARM_CACHES']:
+        threading.Thread(target=warm_caches, args=(app,), name='cache-warmup', daemon=True).start()
+
     return app
 
 if __name__ == '__main__':
@@ -13,8 +13,7 @@ from werkzeug.security import generate_password_hash, check_password_hash
 from sqlalchemy import func
 
 # ================= CONFIG =================
-UPLOAD_FOLDER = os.path.join(os.getcwd(), "uploads")
-os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "uploads")
 ALLOWED_EXTENSIONS = {"mp3", "wav", "ogg", "m4a", "flac"}
 
 logging.basicConfig(level=logging.INFO)
@@ -108,8 +107,11 @@ def create_app():
     CORS(app, resources={r"/api/*": {"origins": "*"}})
     JWTManager(app)
 
-    with app.app_context():
+    @app.cli.command("init-db")
+    def init_db_command():
+        """Create any missing tables (run once per deploy instead of on every boot)."""
         db.create_all()
+        logger.info("✅ Database schema created")
 
     @app.before_request
     def preflight():
@@ -196,6 +198,7 @@ def create_app():
 
             filename = secure_filename(file.filename)
             filename = f"{datetime.now().timestamp()}_{filename}"
+            os.makedirs(UPLOAD_FOLDER, exist_ok=True)
             save_path = os.path.join(UPLOAD_FOLDER, filename)
             file.save(save_path)
 
@@ -0,0 +1,79 @@
+"""/api/batch never runs a streaming route, so a batched download cannot hold a stream slot.
+
+Seeds a Premium user with one downloadable playlist in a throwaway SQLite database:
+    python test_batch.py
+"""
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+import music_streaming_app as app_module
+
+def make_app(tmp):
+    m = app_module
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(m.Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp}/batch.db")
+        mp.setattr(m.Config, 'UPLOAD_FOLDER', os.path.join(tmp, 'uploads'))
+        app = m.create_app()
+    app.config.update(TESTING=True)
+    db = m.db
+    with app.app_context():
+        db.create_all()
+        db.session.add_all([m.SubscriptionPlan(name='Free', price=0), m.SubscriptionPlan(name='Premium', price=199.99)])
+        db.session.add(m.PremiumFeature(premium_feature_id=1, name=m.FEATURE_OFFLINE_DOWNLOADS))
+        db.session.add(m.PlanFeature(subscription_plan_id=2, premium_feature_id=1))
+        db.session.add(m.Artist(name='Coldplay'))
+        db.session.add(m.User(username='premium', email='premium@example.com', password='x', subscription_plan_id=2))
+        db.session.flush()
+        m.get_storage().save('yellow.mp3', io.BytesIO(b'\xff\xfb' * 4096))
+        db.session.add(m.Track(title='Yellow', artist_id=1, file_path='yellow.mp3'))
+        db.session.add(m.Playlist(user_id=1, title='Offline'))
+        db.session.flush()
+        m.add_playlist_entry(db.session.get(m.Playlist, 1), 1)
+        db.session.commit()
+        token = m.issue_token(db.session.get(m.User, 1))
+    return app, {'Authorization': f'Bearer {token}'}
+
+def active_streams(app):
+    with app.app_context():
+        return app_module.get_stream_limiter().stats()['active']
+
+def test_batched_download_is_refused_and_holds_no_stream_slot():
+    app, headers = make_app(tempfile.mkdtemp())
+    client = app.test_client()
+    # The route itself works and is shaped like a stream
+    response = client.get('/api/playlists/1/download', headers=headers)
+    assert response.status_code == 200 and response.data[257:262] == b'ustar'
+    response.close()
+    assert active_streams(app) == 0
+
+    batch = {'requests': [{'method': 'GET', 'path': '/api/playlists/1/download'}, {'method': 'GET', 'path': '/api/tracks/1'}]}
+    for _ in range(3):
+        response = client.post('/api/batch', headers=headers, json=batch)
+        assert response.status_code == 200
+        statuses = [item['status'] for item in response.get_json()['responses']]
+        assert statuses == [400, 200], statuses
+    assert active_streams(app) == 0
+
+def test_streamed_response_that_slips_past_the_exclusions_is_closed():
+    app, headers = make_app(tempfile.mkdtemp())
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(app_module, 'BATCH_EXCLUDED_ENDPOINTS', app_module.BATCH_EXCLUDED_ENDPOINTS - {'download_playlist'})
+        response = app.test_client().post('/api/batch', headers=headers, json={
+            'requests': [{'method': 'GET', 'path': '/api/playlists/1/download'}]
+        })
+    assert response.status_code == 200
+    assert response.get_json()['responses'][0]['status'] == 400
+    assert active_streams(app) == 0
+
+if __name__ == '__main__':
+    try:
+        test_batched_download_is_refused_and_holds_no_stream_slot()
+        test_streamed_response_that_slips_past_the_exclusions_is_closed()
+        print('ok')
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
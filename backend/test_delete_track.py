@@ -0,0 +1,61 @@
+"""DELETE /api/tracks/<id> removes the audio only once the track's rows are committed away.
+
+    python test_delete_track.py
+"""
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+import music_streaming_app as app_module
+
+def make_app(tmp):
+    m = app_module
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(m.Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp}/delete.db")
+        mp.setattr(m.Config, 'UPLOAD_FOLDER', os.path.join(tmp, 'uploads'))
+        app = m.create_app()
+    app.config.update(TESTING=True)
+    db = m.db
+    with app.app_context():
+        db.create_all()
+        db.session.add(m.SubscriptionPlan(name='Free', price=0))
+        db.session.add(m.Artist(name='Coldplay'))
+        db.session.add(m.User(username='owner', email='owner@example.com', password='x', subscription_plan_id=1))
+        db.session.flush()
+        m.get_storage().save('yellow.mp3', io.BytesIO(b'\xff\xfb' * 4096))
+        db.session.add(m.Track(title='Yellow', artist_id=1, file_path='yellow.mp3'))
+        db.session.commit()
+        token = m.issue_token(db.session.get(m.User, 1))
+    return app, {'Authorization': f'Bearer {token}'}
+
+def stored(app):
+    with app.app_context():
+        return app_module.get_storage().exists('yellow.mp3')
+
+def test_failed_delete_keeps_the_audio():
+    app, headers = make_app(tempfile.mkdtemp())
+    client = app.test_client()
+
+    def fail(*args):
+        raise RuntimeError('database went away')
+
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(app_module, 'on_track_deleted', fail)
+        assert client.delete('/api/tracks/1', headers=headers).status_code == 500
+    assert client.get('/api/tracks/1').status_code == 200
+    assert stored(app)
+
+    assert client.delete('/api/tracks/1', headers=headers).status_code == 200
+    assert client.get('/api/tracks/1').status_code == 404
+    assert not stored(app)
+
+if __name__ == '__main__':
+    try:
+        test_failed_delete_keeps_the_audio()
+        print('ok')
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
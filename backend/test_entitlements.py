@@ -0,0 +1,72 @@
+"""A plan downgrade takes features away from tokens minted before it, on every worker.
+
+Two apps on one throwaway SQLite database stand in for two workers:
+    python test_entitlements.py
+"""
+import sys
+import tempfile
+
+import pytest
+
+import music_streaming_app as app_module
+
+def make_workers(tmp):
+    m = app_module
+    workers = []
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(m.Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp}/entitlements.db")
+        for _ in range(2):
+            workers.append(m.create_app())
+    for app in workers:
+        app.config.update(TESTING=True)
+    db = m.db
+    with workers[0].app_context():
+        db.create_all()
+        db.session.add_all([m.SubscriptionPlan(name='Free', price=0), m.SubscriptionPlan(name='Premium', price=199.99)])
+        db.session.add(m.PremiumFeature(premium_feature_id=1, name=m.FEATURE_OFFLINE_DOWNLOADS))
+        db.session.add(m.PlanFeature(subscription_plan_id=2, premium_feature_id=1))
+        db.session.add(m.User(username='premium', email='premium@example.com', password='x', subscription_plan_id=2))
+        db.session.flush()
+        db.session.add(m.Playlist(user_id=1, title='Offline'))
+        db.session.commit()
+        token = m.issue_token(db.session.get(m.User, 1))
+    return workers, {'Authorization': f'Bearer {token}'}
+
+def features(client, headers):
+    response = client.get('/api/auth/user', headers=headers)
+    return response.status_code, (response.get_json() or {}).get('features')
+
+def test_downgraded_token_loses_the_feature():
+    (first, second), premium = make_workers(tempfile.mkdtemp())
+    offline = app_module.FEATURE_OFFLINE_DOWNLOADS.lower()
+    for worker in (first, second):
+        assert features(worker.test_client(), premium) == (200, [offline])
+
+    result = first.test_cli_runner().invoke(args=['set-plan', '1', '1'])
+    assert result.exit_code == 0, result.output
+
+    # The worker that made the change refuses the old token at once
+    response = first.test_client().get('/api/playlists/1/download', headers=premium)
+    assert response.status_code == 401 and response.get_json()['refresh'] is True
+
+    # Another worker refuses it once its plan-change snapshot reloads
+    second.extensions['plan_changes'].loaded_at -= second.config['PLAN_CHANGES_RELOAD'] + 1
+    response = second.test_client().get('/api/playlists/1/download', headers=premium)
+    assert response.status_code == 401 and response.get_json()['refresh'] is True
+    assert features(second.test_client(), premium)[0] == 401
+
+    # The refreshed token carries the Free plan
+    response = second.test_client().post('/api/auth/refresh', headers=premium)
+    assert response.status_code == 200
+    free = {'Authorization': f"Bearer {response.get_json()['token']}"}
+    assert features(second.test_client(), free) == (200, [])
+    response = second.test_client().get('/api/playlists/1/download', headers=free)
+    assert response.status_code == 403
+
+if __name__ == '__main__':
+    try:
+        test_downgraded_token_loses_the_feature()
+        print('ok')
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
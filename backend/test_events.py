@@ -0,0 +1,130 @@
+"""/api/events fan-out under the gunicorn gevent worker: many idle subscribers, few threads.
+
+Serves a throwaway SQLite database from one gevent worker with gunicorn.conf.py, opens
+SUBSCRIBERS event streams, likes a track and checks every stream receives the update.
+Needs gunicorn and gevent:
+    python test_events.py
+"""
+import http.client
+import os
+import selectors
+import socket
+import subprocess
+import sys
+import tempfile
+from time import monotonic, sleep
+
+import pytest
+
+pytest.importorskip('gevent')
+pytest.importorskip('gunicorn')
+
+import music_streaming_app as app_module
+
+SUBSCRIBERS = 1000
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+def database_uri():
+    return f"sqlite:///{os.environ['EVENTS_TEST_DIR']}/events.db"
+
+def served_app():
+    """The app gunicorn serves: `test_events:served_app()`."""
+    app_module.Config.SQLALCHEMY_DATABASE_URI = database_uri()
+    return app_module.create_app()
+
+def seed():
+    m = app_module
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(m.Config, 'SQLALCHEMY_DATABASE_URI', database_uri())
+        app = m.create_app()
+    db = m.db
+    with app.app_context():
+        db.create_all()
+        db.session.add(m.SubscriptionPlan(name='Free', price=0))
+        db.session.add(m.Artist(name='Coldplay'))
+        db.session.add(m.User(username='fan', email='fan@example.com', password='x', subscription_plan_id=1))
+        db.session.flush()
+        db.session.add(m.Track(title='Yellow', artist_id=1))
+        db.session.commit()
+        return m.issue_token(db.session.get(m.User, 1))
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_for_server(port, deadline):
+    while monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/api/tracks/1')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            sleep(0.1)
+    raise AssertionError('gunicorn did not start')
+
+def worker_threads(master_pid):
+    with open(f'/proc/{master_pid}/task/{master_pid}/children') as f:
+        (worker,) = f.read().split()
+    with open(f'/proc/{worker}/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('Threads:'))
+
+def read_until(selector, received, marker, deadline):
+    """Read from every subscriber until each has marker in its bytes; returns how many do."""
+    pending = {key.fileobj for key in selector.get_map().values() if marker not in received[key.fileobj]}
+    while pending and monotonic() < deadline:
+        for key, _ in selector.select(timeout=0.5):
+            sock = key.fileobj
+            received[sock] += sock.recv(65536)
+            if marker in received[sock]:
+                pending.discard(sock)
+    return len(received) - len(pending)
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/task'), reason='reads thread counts from /proc')
+def test_subscriber_fan_out_under_gevent_worker():
+    os.environ['EVENTS_TEST_DIR'] = tempfile.mkdtemp()
+    token = seed()
+    port = free_port()
+    server = subprocess.Popen(
+        # Idle streams only notice a shutdown at their next heartbeat, so do not wait on them
+        [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '--workers', '1', '--graceful-timeout', '1',
+         '--bind', f'127.0.0.1:{port}', 'test_events:served_app()'],
+        cwd=HERE,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    selector = selectors.DefaultSelector()
+    received = {}
+    try:
+        wait_for_server(port, monotonic() + 30)
+        for _ in range(SUBSCRIBERS):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(b'GET /api/events?topics=likes HTTP/1.1\r\nHost: localhost\r\n\r\n')
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ)
+            received[sock] = b''
+        assert read_until(selector, received, b'retry: 3000', monotonic() + 30) == SUBSCRIBERS
+
+        # Every stream is open and idle; a thread-per-connection server would hold one thread each
+        threads = worker_threads(server.pid)
+        assert threads < 50, f'{threads} threads for {SUBSCRIBERS} subscribers'
+
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+        connection.request('POST', '/api/tracks/1/like', headers={'Authorization': f'Bearer {token}'})
+        assert connection.getresponse().status == 201
+        delivered = read_until(selector, received, b'event: likes', monotonic() + 30)
+        assert delivered == SUBSCRIBERS, f'{delivered} of {SUBSCRIBERS} subscribers got the like'
+    finally:
+        for sock in received:
+            selector.unregister(sock)
+            sock.close()
+        server.terminate()
+        server.wait(timeout=30)
+
+if __name__ == '__main__':
+    try:
+        test_subscriber_fan_out_under_gevent_worker()
+        print('ok')
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,47 @@
+"""GET /api/metrics is for operators only and names no users or IPs.
+
+    python test_metrics.py
+"""
+import sys
+import tempfile
+
+import pytest
+
+import music_streaming_app as app_module
+
+def make_app(tmp, token):
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(app_module.Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp}/metrics.db")
+        mp.setattr(app_module.Config, 'METRICS_TOKEN', token)
+        app = app_module.create_app()
+    app.config.update(TESTING=True)
+    return app
+
+def test_metrics_need_the_operator_token():
+    assert make_app(tempfile.mkdtemp(), None).test_client().get('/api/metrics').status_code == 404
+
+    app = make_app(tempfile.mkdtemp(), 'ops-secret')
+    client = app.test_client()
+    assert client.get('/api/metrics').status_code == 403
+    assert client.get('/api/metrics', headers={'X-Metrics-Token': 'guess'}).status_code == 403
+
+    with app.app_context():
+        limiter = app_module.get_stream_limiter()
+        leases = [limiter.acquire('42', 'free'), limiter.acquire('ip:203.0.113.9', 'free')]
+    try:
+        response = client.get('/api/metrics', headers={'X-Metrics-Token': 'ops-secret'})
+        assert response.status_code == 200
+        streams = response.get_json()['stream_limiter']
+        assert streams['busiest'] == [1, 1] and streams['keys'] == 2
+        assert b'42' not in response.data and b'203.0.113.9' not in response.data
+    finally:
+        for lease in leases:
+            lease.release()
+
+if __name__ == '__main__':
+    try:
+        test_metrics_need_the_operator_token()
+        print('ok')
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
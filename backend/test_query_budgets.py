@@ -0,0 +1,101 @@
+"""Query-budget regression guard: hot GET routes stay within their @query_budget and run no N+1s.
+
+Seeds a throwaway SQLite database and requests each route with the guard in strict mode:
+    python test_query_budgets.py
+"""
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+import pytest
+
+import music_streaming_app as app_module
+
+ROUTES = [
+    '/api/tracks',
+    '/api/tracks/1',
+    '/api/tracks/popular',
+    '/api/home',
+    '/api/tracks/user/1/likes',
+    '/api/playlists/user/1',
+    '/api/playlists/1',
+    '/api/playlists/1/expanded',
+    '/api/artists',
+    '/api/artists/1',
+    '/api/charts/tracks',
+    '/api/charts/artists',
+    '/api/analytics/tracks/1/likes',
+    '/api/analytics/artists/1/likes?bucket=hour',
+    '/api/tracks/1/duplicates',
+]
+
+def seed(db):
+    m = app_module
+    db.session.add_all([m.SubscriptionPlan(name='Free', price=0), m.SubscriptionPlan(name='Premium', price=199.99)])
+    db.session.add_all([m.Artist(name='Coldplay'), m.Artist(name='Adele')])
+    db.session.add_all([m.Album(title='Parachutes', artist_id=1), m.Album(title='25', artist_id=2)])
+    db.session.flush()
+    # More rows than QUERY_REPEAT_THRESHOLD, so a per-row query shows up as an N+1
+    for i in range(20):
+        db.session.add(m.Track(title=f'Track {i}', artist_id=1 + i % 2, album_id=1 + i % 2))
+    db.session.add(m.User(username='budget', email='budget@example.com', password='x', subscription_plan_id=1))
+    db.session.flush()
+    db.session.add_all([m.Playlist(user_id=1, title='Mix'), m.Playlist(user_id=1, title='Focus', parent_playlist_id=1)])
+    db.session.flush()
+    for i in range(1, 16):
+        db.session.add(m.TrackPlaylist(playlist_id=1, track_id=i, order_num=i))
+        db.session.add(m.Like(user_id=1, track_id=i))
+    for i in range(10, 21):
+        db.session.add(m.TrackPlaylist(playlist_id=2, track_id=i, order_num=i))
+    now = datetime.utcnow()
+    for i in range(1, 21):
+        db.session.add(m.PlayRollup(scope='track', entity_id=i, granularity='day', bucket_start=m.bucket_start(now, 'day'), plays=100 - i))
+    for scope, entity_id in (('artist', 1), ('artist', 2)):
+        db.session.add(m.PlayRollup(scope=scope, entity_id=entity_id, granularity='day', bucket_start=m.bucket_start(now, 'day'), plays=500))
+    for days in range(10):
+        db.session.add(m.LikeRollup(scope='track', entity_id=1, granularity='day', bucket_start=m.bucket_start(now - timedelta(days=days), 'day'), likes=days))
+    for hours in range(24):
+        db.session.add(m.LikeRollup(scope='artist', entity_id=1, granularity='hour', bucket_start=m.bucket_start(now - timedelta(hours=hours), 'hour'), likes=hours))
+    db.session.add(m.RollupWatermark(name='likes', through=now))
+    # Tracks 1-3 share a fingerprint, so track 1 has two duplicate candidates
+    for track_id in (1, 2, 3):
+        db.session.add(m.TrackFingerprint(track_id=track_id, hash_count=40, duration_ms=60000))
+        for frame in range(40):
+            db.session.add(m.FingerprintHash(hash=1000 + frame, track_id=track_id, frame=frame))
+    db.session.commit()
+
+def test_query_budgets():
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(app_module.Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tempfile.mkdtemp()}/budgets.db")
+        app = app_module.create_app()
+    # Small shard pages, so the paged likes and playlist reads fetch several pages
+    app.config.update(TESTING=True, QUERY_GUARD_MODE='strict', SHARD_SCAN_CHUNK=4)
+    db = app_module.db
+    with app.app_context():
+        db.create_all()
+        seed(db)
+        # A running worker already holds the shard map; its periodic reload is not the route's cost
+        app_module.get_shard_router()
+        token = app_module.create_access_token(identity='1')
+
+    client = app.test_client()
+    headers = {'Authorization': f'Bearer {token}'}
+    failures = {}
+    for path in ROUTES:
+        try:
+            response = client.get(path, headers=headers)
+            print(f"{response.headers.get('X-Query-Count', '?'):>4}  {response.status_code}  {path}")
+            # An error page is cheap and would pass the budget for the wrong reason
+            if response.status_code != 200:
+                failures[path] = f"status {response.status_code}"
+        except app_module.QueryBudgetExceeded as e:
+            failures[path] = str(e)
+            print(f"OVER  {e}")
+    assert not failures, f"Routes over budget or failing: {failures}"
+
+if __name__ == '__main__':
+    try:
+        test_query_budgets()
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
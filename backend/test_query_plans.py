@@ -0,0 +1,42 @@
+"""Query-plan regression guard: every hot query must be served by an index.
+
+Runs against the configured database after applying migrations:
+    python test_query_plans.py
+or against a throwaway SQLite schema built from the models (what pytest runs):
+    python test_query_plans.py --sqlite
+"""
+import sys
+import tempfile
+
+import pytest
+
+import music_streaming_app as app_module
+from migrations import apply_migrations, check_query_plans
+
+def check_plans(use_sqlite):
+    with pytest.MonkeyPatch.context() as mp:
+        if use_sqlite:
+            mp.setattr(app_module.Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tempfile.mkdtemp()}/plans.db")
+        app = app_module.create_app()
+        db = app_module.db
+        with app.app_context():
+            if use_sqlite:
+                db.create_all()
+            apply_migrations(db.engine, db.metadata)
+            with db.engine.connect() as connection:
+                failures = check_query_plans(connection, app_module.hot_queries())
+
+    for name, _ in app_module.hot_queries():
+        print(f"{'FULL SCAN' if name in failures else 'ok':>9}  {name}  {', '.join(failures.get(name, []))}")
+    assert not failures, f"Hot queries without an index: {sorted(failures)}"
+
+def test_query_plans():
+    # pytest checks the SQLite schema; run the script to EXPLAIN against the configured MySQL
+    check_plans(use_sqlite=True)
+
+if __name__ == '__main__':
+    try:
+        check_plans(use_sqlite='--sqlite' in sys.argv)
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
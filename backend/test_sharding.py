@@ -0,0 +1,79 @@
+"""Shard rebalancing keeps every like and playlist entry, including ones written mid-move.
+
+Builds a main SQLite database plus one shard and moves a bucket between them:
+    python test_sharding.py
+"""
+import sys
+import tempfile
+
+import pytest
+
+import music_streaming_app as app_module
+
+def users_in_bucket(router, bucket, count):
+    uids = (uid for uid in range(1, 10000) if router.bucket(uid) == bucket)
+    return [next(uids) for _ in range(count)]
+
+def test_rebalance_keeps_rows_written_during_the_move():
+    m = app_module
+    tmp = tempfile.mkdtemp()
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setattr(m.Config, 'SQLALCHEMY_DATABASE_URI', f"sqlite:///{tmp}/main.db")
+        mp.setattr(m.Config, 'SQLALCHEMY_BINDS', {'s1': f"sqlite:///{tmp}/s1.db"}, raising=False)
+        mp.setattr(m.Config, 'SHARD_BINDS', ('main', 's1'))
+        mp.setattr(m.Config, 'SHARD_BUCKETS', 4)
+        app = m.create_app()
+        db = m.db
+        with app.app_context():
+            db.create_all()
+            m.create_shard_tables()
+            db.session.add(m.Artist(name='Coldplay'))
+            db.session.add_all([m.Track(title=f'Track {i}', artist_id=1) for i in range(4)])
+            router = m.get_shard_router()
+            old_user, copy_user, settle_user = users_in_bucket(router, 0, 3)
+            for uid in (old_user, copy_user, settle_user):
+                db.session.add(m.User(user_id=uid, username=f'u{uid}', email=f'u{uid}@example.com', password='x'))
+            db.session.add(m.Playlist(playlist_id=1, user_id=old_user, title='Old'))
+            db.session.flush()
+            m.add_like(old_user, 1)
+            m.add_playlist_entry(db.session.get(m.Playlist, 1), 1)
+            db.session.commit()
+
+            # Writes from workers still on the old map land on the source, main
+            scan = m._bucket_keys
+            def scan_then_like(moves, router):
+                keys = scan(moves, router)
+                if not mp_state['copy_written']:
+                    mp_state['copy_written'] = True
+                    m.add_like(copy_user, 2)
+                    db.session.commit()
+                return keys
+            def settle(seconds):
+                m.add_like(settle_user, 3)
+                db.session.add(m.Playlist(playlist_id=2, user_id=settle_user, title='New'))
+                db.session.flush()
+                m.add_playlist_entry(db.session.get(m.Playlist, 2), 4)
+                db.session.commit()
+            mp_state = {'copy_written': False}
+            mp.setattr(m, '_bucket_keys', scan_then_like)
+            mp.setattr(m, 'sleep', settle)
+
+            m.move_buckets([(0, 'main', 's1')], 0)
+
+            router = m.get_shard_router()
+            assert router.bind_for(copy_user) == 's1'
+            for uid, track_id in ((old_user, 1), (copy_user, 2), (settle_user, 3)):
+                assert m.find_like(uid, track_id) is not None, f"like ({uid}, {track_id}) lost"
+            entries = {(pid, tid) for pid, tid in m.shard_execute('s1', m.select(m.TrackPlaylist.playlist_id, m.TrackPlaylist.track_id))}
+            assert entries == {(1, 1), (2, 4)}
+            # Nothing of the moved bucket is left behind on the source
+            assert m.shard_execute('main', m.select(m.func.count()).select_from(m.Like)).scalar() == 0
+            assert m.shard_execute('main', m.select(m.func.count()).select_from(m.TrackPlaylist)).scalar() == 0
+
+if __name__ == '__main__':
+    try:
+        test_rebalance_keeps_rows_written_during_the_move()
+        print('ok')
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
@@ -0,0 +1,82 @@
+"""S3Storage against moto's in-memory S3, and CachedStorage filling its disk cache from it.
+
+Needs boto3 and moto:
+    python test_storage.py
+"""
+import io
+import os
+import sys
+import tempfile
+from time import sleep
+
+import pytest
+
+pytest.importorskip('boto3')
+moto = pytest.importorskip('moto')
+
+import music_streaming_app as app_module
+
+MB = 1024 * 1024
+
+def make_storage():
+    import boto3
+    boto3.client('s3', region_name='us-east-1').create_bucket(Bucket='audio')
+    # moto, like S3, wants every part but the last to be at least 5 MB
+    return app_module.S3Storage('audio', 'uploads/', region='us-east-1', access_key='test', secret_key='test',
+                                multipart_threshold=5 * MB, part_size=5 * MB, chunk_size=64 * 1024)
+
+def test_s3_storage():
+    with moto.mock_aws():
+        storage = make_storage()
+        small = os.urandom(1000)
+        large = os.urandom(11 * MB + 123)  # three parts
+
+        assert storage.save('small.mp3', io.BytesIO(small), 'audio/mpeg') == len(small)
+        assert storage.save('large.flac', io.BytesIO(large)) == len(large)
+        assert storage.exists('small.mp3') and not storage.exists('missing.mp3')
+        assert storage.size('large.flac') == len(large)
+        assert storage.list_keys() == ['large.flac', 'small.mp3']
+
+        assert b''.join(storage.iter_range('small.mp3')) == small
+        assert b''.join(storage.iter_range('large.flac', 5 * MB - 10, 5 * MB + 9)) == large[5 * MB - 10:5 * MB + 10]
+        assert b''.join(storage.iter_range('large.flac', len(large) - 5)) == large[-5:]
+        assert storage.local_path('small.mp3') is None
+
+        storage.delete('small.mp3')
+        assert not storage.exists('small.mp3')
+
+def test_cached_storage_fills_from_s3():
+    with moto.mock_aws():
+        backend = make_storage()
+        data = os.urandom(300 * 1024)
+        backend.save('track.mp3', io.BytesIO(data))
+        cached = app_module.CachedStorage(backend, tempfile.mkdtemp(), max_bytes=10 * MB)
+
+        # A miss streams from S3 and queues a copy; the next read is local
+        assert cached.local_path('track.mp3') is None
+        assert b''.join(cached.iter_range('track.mp3', 10, 19)) == data[10:20]
+        for _ in range(100):
+            if cached.local_path('track.mp3'):
+                break
+            sleep(0.05)
+        path = cached.local_path('track.mp3')
+        assert path is not None
+        with open(path, 'rb') as f:
+            assert f.read() == data
+
+        # With the fill queue full, a miss is served without queueing another copy
+        backend.save('other.mp3', io.BytesIO(data))
+        cached.max_pending = 0
+        assert cached.local_path('other.mp3') is None and not cached._filling
+
+        cached.delete('track.mp3')
+        assert not cached.exists('track.mp3')
+
+if __name__ == '__main__':
+    try:
+        test_s3_storage()
+        test_cached_storage_fills_from_s3()
+        print('ok')
+    except AssertionError as e:
+        print(e)
+        sys.exit(1)
@@ -26,6 +26,16 @@ export const AuthProvider = ({ children }) => {
       if (res.ok) {
         const data = await res.json();
         setUser(data);
+      } else if (res.status === 401 && (await res.json().catch(() => ({}))).refresh) {
+        // Plan changed since this token was issued: swap it for one with the new plan
+        const refreshed = await fetch('http://localhost:5000/api/auth/refresh', {
+          method: 'POST',
+          headers: { 'Authorization': `Bearer ${token}`, 'Accept': 'application/json' }
+        });
+        if (!refreshed.ok) throw new Error('Token refresh failed');
+        const data = await refreshed.json();
+        localStorage.setItem('token', data.token);
+        setToken(data.token);
       } else {
         localStorage.removeItem('token');
         setToken(null);
@@ -435,60 +445,57 @@ const Home = () => {
     loadData();
   }, [user, token]);
 
+  // Live like counts and catalog changes, instead of refetching the listings
+  useEffect(() => {
+    const events = new EventSource('http://localhost:5000/api/events?topics=catalog,likes');
+    const byId = (updates) => Object.fromEntries(updates.map(u => [u.track_id, u.likes_count]));
+
+    events.addEventListener('likes', (e) => {
+      const counts = byId(JSON.parse(e.data).counts || []);
+      const apply = (track) => (track.track_id in counts ? { ...track, likes_count: counts[track.track_id] } : track);
+      setPopularTracks(prev => prev.map(apply));
+      setAllTracks(prev => prev.map(apply));
+    });
+    events.addEventListener('track.created', (e) => {
+      const track = JSON.parse(e.data);
+      setAllTracks(prev => (prev.some(t => t.track_id === track.track_id) ? prev : [track, ...prev]));
+    });
+    events.addEventListener('track.deleted', (e) => {
+      const { track_id } = JSON.parse(e.data);
+      setAllTracks(prev => prev.filter(t => t.track_id !== track_id));
+      setPopularTracks(prev => prev.filter(t => t.track_id !== track_id));
+    });
+    // The server missed events for us (long disconnect): fall back to one full reload
+    events.addEventListener('reset', () => loadData());
+
+    return () => events.close();
+  }, []);
+
   const loadData = async () => {
     setLoading(true);
     try {
       const headers = token ? { 'Authorization': `Bearer ${token}`, 'Accept': 'application/json' } : { 'Accept': 'application/json' };
 
-  const plansRes = await fetch('http://localhost:5000/api/subscription_plans', { headers });
-  const popularRes = await fetch('http://localhost:5000/api/tracks/popular?limit=10', { headers });
-  const allRes = await fetch('http://localhost:5000/api/tracks?page=1&limit=50', { headers });
-  const artistsRes = await fetch('http://localhost:5000/api/artists', { headers });
-
-      // handle popular
-      if (popularRes.ok) {
-        const popularData = await popularRes.json();
-        setPopularTracks(popularData.tracks || []);
-      } else {
-        const txt = await popularRes.text();
-        console.error('Failed to load popular tracks:', popularRes.status, txt);
-        setPopularTracks([]);
-      }
-
-      // handle subscription plans
-      if (plansRes && plansRes.ok) {
-        try {
-          const plansData = await plansRes.json();
-          setSubscriptionPlans(plansData.subscription_plans || []);
-        } catch (e) {
-          console.error('Failed to parse subscription plans JSON:', e);
-          setSubscriptionPlans([]);
-        }
-      } else if (plansRes) {
-        const txt = await plansRes.text();
-        console.error('Failed to load subscription plans:', plansRes.status, txt);
+      const homeRes = await fetch('http://localhost:5000/api/home', { headers });
+      if (!homeRes.ok) {
+        const txt = await homeRes.text();
+        console.error('Failed to load home feed:', homeRes.status, txt);
         setSubscriptionPlans([]);
-      }
-
-      // handle all tracks
-      if (allRes.ok) {
-        const allData = await allRes.json();
-        setAllTracks(allData.tracks || []);
-      } else {
-        const txt = await allRes.text();
-        console.error('Failed to load all tracks:', allRes.status, txt);
+        setPopularTracks([]);
         setAllTracks([]);
+        setArtists([]);
+        return;
       }
 
-      // handle artists
-      if (artistsRes.ok) {
-        const artistsData = await artistsRes.json();
-        setArtists(artistsData.artists || []);
-      } else {
-        const txt = await artistsRes.text();
-        console.error('Failed to load artists:', artistsRes.status, txt);
-        setArtists([]);
+      // Sections that timed out or failed on the server come back as null
+      const home = await homeRes.json();
+      if (home.timed_out?.length || home.failed?.length) {
+        console.warn('Home sections unavailable:', [...(home.timed_out || []), ...(home.failed || [])]);
       }
+      setSubscriptionPlans(home.subscription_plans || []);
+      setPopularTracks(home.popular_tracks || []);
+      setAllTracks(home.tracks?.tracks || []);
+      setArtists(home.artists?.artists || []);
     } catch (error) {
       console.error('Error loading data:', error);
     } finally {
@@ -534,9 +541,8 @@ const Home = () => {
   };
 
   const handleUploadSuccess = (newTrack) => {
-    setAllTracks(prev => [newTrack, ...prev]);
+    setAllTracks(prev => (prev.some(t => t.track_id === newTrack.track_id) ? prev : [newTrack, ...prev]));
     setShowUpload(false);
-    loadData();
   };
 
   const handleDeleteTrack = async (trackId) => {
@@ -692,35 +698,37 @@ const Library = ({ onNavigate }) => {
     setLoading(true);
     setError('');
     try {
-      const headers = { 'Authorization': `Bearer ${token}` };
-      
-      const [playlistsRes, likedRes] = await Promise.all([
-        fetch(`http://localhost:5000/api/playlists/user/${user.user_id}`, { headers }),
-        fetch(`http://localhost:5000/api/tracks/user/${user.user_id}/likes`, { headers })
-      ]);
+      const headers = { 'Authorization': `Bearer ${token}`, 'Content-Type': 'application/json' };
+
+      // Both reads go out in one round trip and run in parallel on the server
+      const res = await fetch('http://localhost:5000/api/batch', {
+        method: 'POST',
+        headers,
+        body: JSON.stringify({
+          requests: [
+            { id: 'playlists', method: 'GET', path: `/api/playlists/user/${user.user_id}` },
+            { id: 'liked', method: 'GET', path: `/api/tracks/user/${user.user_id}/likes` }
+          ]
+        })
+      });
+      if (!res.ok) {
+        throw new Error(`Batch request failed: ${res.status} ${await res.text()}`);
+      }
+      const { responses = [] } = await res.json();
+      const byId = Object.fromEntries(responses.map(r => [r.id, r]));
       let playlistsData = { playlists: [] };
       let likedData = {};
 
-      if (playlistsRes.ok) {
-        try {
-          playlistsData = await playlistsRes.json();
-        } catch (e) {
-          console.error('Failed to parse playlists JSON:', e, await playlistsRes.text());
-        }
+      if (byId.playlists && byId.playlists.status === 200) {
+        playlistsData = byId.playlists.body || playlistsData;
       } else {
-        const txt = await playlistsRes.text();
-        console.error('Failed to load playlists:', playlistsRes.status, txt);
+        console.error('Failed to load playlists:', byId.playlists);
       }
 
-      if (likedRes.ok) {
-        try {
-          likedData = await likedRes.json();
-        } catch (e) {
-          console.error('Failed to parse liked tracks JSON:', e, await likedRes.text());
-        }
+      if (byId.liked && byId.liked.status === 200) {
+        likedData = byId.liked.body || likedData;
       } else {
-        const txt = await likedRes.text();
-        console.error('Failed to load liked tracks:', likedRes.status, txt);
+        console.error('Failed to load liked tracks:', byId.liked);
       }
 
       // Accept multiple possible keys from the backend for liked tracks